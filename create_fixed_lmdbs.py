@@ -1,142 +1,275 @@
 #!/usr/bin/env python3
 """
 Create new LMDB databases with proper train/val/test splits (NO LEAKAGE)
+
+Every source is read exactly once. Each sample is routed by its scene to the LMDB of the split the scene belongs
+to, and written in batches, so memory use does not depend on the size of the splits.
+
+With --views, no image is copied: each split is written as a view (see strhub.data.split_view) listing the samples
+of the source LMDBs that belong to it. Only the image paths of the sources are read, so re-splitting takes seconds.
 """
 
-import lmdb
+import argparse
 import os
 import re
 from pathlib import Path
 from tqdm import tqdm
 
+from strhub.data.lmdb_utils import LmdbWriter, get_image, label_key, open_readonly, read_num_samples
+from strhub.data.metadata import SampleMetadata
+from strhub.data.split_view import SplitView, write_view
+
+# gt_<scene>_<crop>.jpg, as stored in the imagepath- keys of the ArT LMDBs
+ART_SCENE = re.compile(r'gt_(\d+)_\d+\.jpg')
+# <image name>_<crop>.jpg, as written by tools/convert_totaltext.py
+TOTALTEXT_SCENE = re.compile(r'(.+)_\d+\.jpg')
+
+SPLITS = ('train', 'val', 'test')
+
 def load_split_files(split_dir):
     """Load the split files"""
     split_dir = Path(split_dir)
-    
+
     splits = {}
-    
+
     # Total-Text
     with open(split_dir / "totaltext_train.txt") as f:
         splits['tt_train'] = set(line.strip() for line in f)
-    
+
     with open(split_dir / "totaltext_val.txt") as f:
         splits['tt_val'] = set(line.strip() for line in f)
-    
+
     with open(split_dir / "totaltext_test.txt") as f:
         splits['tt_test'] = set(line.strip() for line in f)
-    
+
     # ArT
     with open(split_dir / "art_train_scenes.txt") as f:
         splits['art_train'] = set(line.strip() for line in f)
-    
+
     with open(split_dir / "art_val_scenes.txt") as f:
         splits['art_val'] = set(line.strip() for line in f)
-    
+
     with open(split_dir / "art_test_scenes.txt") as f:
         splits['art_test'] = set(line.strip() for line in f)
-    
+
     return splits
 
-def create_totaltext_lmdb(old_lmdb_path, new_lmdb_path, image_files, split_name):
-    """Create new Total-Text LMDB with only specified images"""
-    print(f"\nCreating Total-Text {split_name} LMDB...")
-    print(f"  Source: {old_lmdb_path}")
-    print(f"  Target: {new_lmdb_path}")
-    print(f"  Images: {len(image_files)}")
-    
-    # We need to map from original LMDB to new one
-    # Since Total-Text doesn't have imagepath keys, we'll need to use the original train LMDB
-    # and filter based on some heuristic or rebuild from scratch
-    
-    # For now, let's note that we need the original image files
-    print(f"  ⚠️  Note: This requires access to original Total-Text images")
-    print(f"  ⚠️  You'll need to use the STR-HUB dataset creation tools")
-    
-    return len(image_files)
-
-def create_art_lmdb(old_lmdb_paths, new_lmdb_path, scene_ids, split_name):
-    """Create new ArT LMDB with only specified scenes"""
-    print(f"\nCreating ArT {split_name} LMDB...")
-    print(f"  Target: {new_lmdb_path}")
-    print(f"  Scenes: {len(scene_ids)}")
-    
-    # Create output directory
-    os.makedirs(new_lmdb_path, exist_ok=True)
-    
-    # Open new LMDB for writing
-    env_out = lmdb.open(new_lmdb_path, map_size=1099511627776)  # 1TB
-    
-    # Collect all samples from specified scenes
-    samples = []
-    
-    for old_lmdb_path in old_lmdb_paths:
-        if not os.path.exists(old_lmdb_path):
-            continue
-            
-        print(f"  Reading from: {old_lmdb_path}")
-        env_in = lmdb.open(old_lmdb_path, readonly=True, lock=False, readahead=False, meminit=False)
-        
-        with env_in.begin(write=False) as txn_in:
-            num_samples = int(txn_in.get('num-samples'.encode()))
-            
-            for i in tqdm(range(1, num_samples + 1), desc=f"  Scanning"):
-                path_key = f'imagepath-{i:09d}'.encode()
-                path = txn_in.get(path_key)
-                
-                if path:
-                    path_str = path.decode('utf-8')
-                    match = re.search(r'gt_(\d+)_\d+\.jpg', path_str)
-                    if match:
-                        scene_id = match.group(1)
-                        
-                        if scene_id in scene_ids:
-                            # Get all data for this sample
-                            image_key = f'image-{i:09d}'.encode()
-                            label_key = f'label-{i:09d}'.encode()
-                            
-                            image_data = txn_in.get(image_key)
-                            label_data = txn_in.get(label_key)
-                            
-                            if image_data and label_data:
-                                samples.append({
-                                    'image': image_data,
-                                    'label': label_data,
-                                    'path': path
-                                })
-        
-        env_in.close()
-    
-    print(f"  Collected {len(samples)} text crops from {len(scene_ids)} scenes")
-    
-    # Write to new LMDB
-    with env_out.begin(write=True) as txn_out:
-        for idx, sample in enumerate(tqdm(samples, desc="  Writing"), start=1):
-            image_key = f'image-{idx:09d}'.encode()
-            label_key = f'label-{idx:09d}'.encode()
-            path_key = f'imagepath-{idx:09d}'.encode()
-            
-            txn_out.put(image_key, sample['image'])
-            txn_out.put(label_key, sample['label'])
-            txn_out.put(path_key, sample['path'])
-        
-        # Write num-samples
-        txn_out.put('num-samples'.encode(), str(len(samples)).encode())
-    
-    env_out.close()
-    
-    print(f"  ✅ Created {new_lmdb_path} with {len(samples)} samples")
-    return len(samples)
+class SplitRouter:
+    """Routes samples to one LMDB per split, based on the scene they were cropped from"""
+
+    def __init__(self, outputs, scenes):
+        # outputs: split name -> LMDB path, scenes: split name -> set of scene ids
+        self.split_of = {scene: split for split, ids in scenes.items() for scene in ids}
+        self.writers = {split: LmdbWriter(path) for split, path in outputs.items()}
+
+    def write(self, scene, image, label, path):
+        """Write the sample to the LMDB of its split. Returns False if the scene is not part of any split."""
+        split = self.split_of.get(scene)
+        if split is None:
+            return False
+        writer = self.writers[split]
+        index = writer.write(image, label, path.decode('utf-8'))
+        writer.put(f'imagepath-{index:09d}'.encode(), path)
+        return True
+
+    def counts(self):
+        return {split: writer.num_samples for split, writer in self.writers.items()}
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+class ViewRouter:
+    """Assigns the samples of source LMDBs to one view per split, based on the scene they were cropped from"""
+
+    def __init__(self, outputs, scenes):
+        # outputs: split name -> view path, scenes: split name -> set of scene ids
+        self.split_of = {scene: split for split, ids in scenes.items() for scene in ids}
+        self.outputs = outputs
+        self.sources = []
+        self.samples = {split: ([], []) for split in outputs}
+
+    def add_source(self, lmdb_path, scene_pattern):
+        """Assign all samples of an LMDB. Returns the number of samples which are not part of any split."""
+        print(f"  Reading from: {lmdb_path}")
+        source = len(self.sources)
+        self.sources.append(lmdb_path)
+        skipped = 0
+        for index, scene in tqdm(lmdb_scenes(lmdb_path, scene_pattern), desc="  Routing"):
+            split = self.split_of.get(scene)
+            if split is None:
+                skipped += 1
+                continue
+            source_ids, indices = self.samples[split]
+            source_ids.append(source)
+            indices.append(index)
+        return skipped
+
+    def counts(self):
+        return {split: len(indices) for split, (_, indices) in self.samples.items()}
+
+    def close(self):
+        for split, (source_ids, indices) in self.samples.items():
+            write_view(self.outputs[split], self.sources, source_ids, indices)
+
+def lmdb_scenes(lmdb_path, scene_pattern):
+    """Yield (index, scene) of the samples of an LMDB, from its imagepath- keys, else from its metadata sidecar"""
+    with open_readonly(lmdb_path) as env, env.begin() as txn:
+        cursor = txn.cursor()
+        has_paths = False
+        found = cursor.set_range(b'imagepath-')
+        while found and cursor.key().startswith(b'imagepath-'):
+            has_paths = True
+            match = scene_pattern.search(cursor.value().decode('utf-8'))
+            yield int(cursor.key()[len(b'imagepath-'):]), match.group(1) if match else None
+            found = cursor.next()
+    if has_paths or not SampleMetadata.exists(lmdb_path):
+        return
+    meta = SampleMetadata(lmdb_path)
+    for i in range(1, len(meta) + 1):
+        match = scene_pattern.search(os.path.basename(meta.path(i)))
+        yield i, match.group(1) if match else None
+
+def route_lmdb(router, lmdb_path, scene_pattern):
+    """Route all samples of an LMDB with imagepath- keys"""
+    print(f"  Reading from: {lmdb_path}")
+    # Scene ids are already parsed in the metadata sidecar, if there is one
+    meta = SampleMetadata(lmdb_path) if SampleMetadata.exists(lmdb_path) else None
+    skipped = 0
+    with open_readonly(lmdb_path) as env_in, env_in.begin() as txn_in:
+        num_samples = read_num_samples(env_in)
+        for i in tqdm(range(1, num_samples + 1), desc="  Routing"):
+            if meta is not None:
+                scene = str(meta.scene_id[i - 1])
+                if scene not in router.split_of:
+                    # Not part of any split: nothing of this sample is read
+                    skipped += 1
+                    continue
+            path = txn_in.get(f'imagepath-{i:09d}'.encode())
+            if not path:
+                skipped += 1
+                continue
+            if meta is None:
+                match = scene_pattern.search(path.decode('utf-8'))
+                scene = match.group(1) if match else None
+            image_data = get_image(txn_in, i)
+            label_data = txn_in.get(label_key(i))
+            if not (image_data and label_data and router.write(scene, image_data, label_data, path)):
+                skipped += 1
+    return skipped
+
+def route_gt(router, gt_file, image_dir, scene_pattern):
+    """Route all crops listed in a gt file (one "<image path> <label>" per line)"""
+    print(f"  Reading from: {gt_file}")
+    skipped = 0
+    with open(gt_file, encoding='utf-8') as f:
+        for line in tqdm(f, desc="  Routing"):
+            image_path, label = line.rstrip('\n').split(' ', 1)
+            match = scene_pattern.search(os.path.basename(image_path))
+            if match is None or match.group(1) not in router.split_of:
+                skipped += 1
+                continue
+            with open(os.path.join(image_dir, image_path), 'rb') as img:
+                image_data = img.read()
+            router.write(match.group(1), image_data, label.encode(), image_path.encode())
+    return skipped
+
+def create_totaltext_lmdbs(sources, output_base, splits, views=False):
+    """Create the Total-Text train/val/test LMDBs in a single pass over the cropped words
+
+    sources: (gt file, image dir) pairs, or with views, the LMDBs written by tools/convert_totaltext.py --lmdb_root
+    """
+    outputs = {split: f"{output_base}/totaltext_lmdb/{split}/totaltext" for split in SPLITS}
+    # The split files list scene images (imgN.jpg). Crops are named after them: imgN_<crop>.jpg
+    scenes = {split: {os.path.splitext(name)[0] for name in splits[f'tt_{split}']} for split in SPLITS}
+    router = ViewRouter(outputs, scenes) if views else SplitRouter(outputs, scenes)
+    skipped = 0
+    try:
+        for source in sources:
+            if views:
+                if not os.path.exists(f"{source}/data.mdb"):
+                    print(f"  ⚠️  Missing: {source} (run tools/convert_totaltext.py --lmdb_root first)")
+                    continue
+                skipped += router.add_source(source, TOTALTEXT_SCENE)
+                continue
+            gt_file, image_dir = source
+            if not os.path.exists(gt_file):
+                print(f"  ⚠️  Missing: {gt_file} (run tools/convert_totaltext.py first)")
+                continue
+            skipped += route_gt(router, gt_file, image_dir, TOTALTEXT_SCENE)
+    finally:
+        router.close()
+    counts = router.counts()
+    for split in SPLITS:
+        print(f"  ✅ Created {outputs[split]} with {counts[split]} samples{' (view)' if views else ''}")
+    print(f"  Skipped {skipped} crops of scenes outside the splits")
+    return counts
+
+def create_art_lmdbs(old_lmdb_paths, output_base, splits, views=False):
+    """Create the ArT train/val/test LMDBs (or views) in a single pass over the source LMDBs"""
+    outputs = {split: f"{output_base}/art_lmdb/{split}/art" for split in SPLITS}
+    scenes = {split: splits[f'art_{split}'] for split in SPLITS}
+    router = ViewRouter(outputs, scenes) if views else SplitRouter(outputs, scenes)
+    skipped = 0
+    try:
+        for old_lmdb_path in old_lmdb_paths:
+            if not os.path.exists(old_lmdb_path):
+                continue
+            if views:
+                skipped += router.add_source(old_lmdb_path, ART_SCENE)
+            else:
+                skipped += route_lmdb(router, old_lmdb_path, ART_SCENE)
+    finally:
+        router.close()
+    counts = router.counts()
+    for split in SPLITS:
+        print(f"  ✅ Created {outputs[split]} with {counts[split]} samples{' (view)' if views else ''}")
+    print(f"  Skipped {skipped} samples of scenes outside the splits")
+    return counts
+
+def create_curved_mix(output_base):
+    """Link the Total-Text and ArT splits into curved_mix/<split>/{totaltext,art}"""
+    curved_mix_dir = f"{output_base}/curved_mix"
+    for split in SPLITS:
+        os.makedirs(f"{curved_mix_dir}/{split}", exist_ok=True)
+        for name, target in [("totaltext", f"{output_base}/totaltext_lmdb/{split}/totaltext"),
+                             ("art", f"{output_base}/art_lmdb/{split}/art")]:
+            link = f"{curved_mix_dir}/{split}/{name}"
+            if not (os.path.exists(f"{target}/data.mdb") or SplitView.exists(target)):
+                print(f"  ⚠️  Missing {target}, not linking {link}")
+                continue
+            if os.path.islink(link):
+                os.remove(link)
+            elif os.path.exists(link):
+                print(f"  ⚠️  {link} exists and is not a symlink, not replacing it")
+                continue
+            os.symlink(os.path.abspath(target), link)
+            print(f"  {link} -> {target}")
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--split_dir', default="/data1/vivek/parseq/dataset_splits")
+    parser.add_argument('--output_base', default="/data1/vivek/parseq/data_fixed")
+    parser.add_argument('--art_sources', nargs='+',
+                        default=["/data1/vivek/parseq/data/art_lmdb/train/art",
+                                 "/data1/vivek/parseq/data/art_lmdb/val"],
+                        help="ArT LMDBs with imagepath- keys")
+    parser.add_argument('--totaltext_crops', default="/data1/vivek/parseq/data/totaltext_crops",
+                        help="Output root of tools/convert_totaltext.py (<subset>_gt.txt and <subset>/)")
+    parser.add_argument('--totaltext_lmdb_root', default="/data1/vivek/parseq/data/totaltext_crops_lmdb",
+                        help="--lmdb_root of tools/convert_totaltext.py (<subset>/), used with --views")
+    parser.add_argument('--views', action='store_true',
+                        help="Write the splits as views of the source LMDBs instead of copying the samples")
+    args = parser.parse_args()
+
     print("=" * 100)
     print("CREATE NEW LMDB DATABASES (NO LEAKAGE)")
     print("=" * 100)
     print()
-    
+
     # Load splits
-    split_dir = "/data1/vivek/parseq/dataset_splits"
-    splits = load_split_files(split_dir)
-    
+    splits = load_split_files(args.split_dir)
+
     print("Loaded splits:")
     print(f"  Total-Text Train: {len(splits['tt_train'])} images")
     print(f"  Total-Text Val:   {len(splits['tt_val'])} images")
@@ -145,86 +278,57 @@ def main():
     print(f"  ArT Val:          {len(splits['art_val'])} scenes")
     print(f"  ArT Test:         {len(splits['art_test'])} scenes")
     print()
-    
+
     # Create output directory
-    output_base = "/data1/vivek/parseq/data_fixed"
+    output_base = args.output_base
     os.makedirs(output_base, exist_ok=True)
-    
+
     # ===== ArT LMDB Creation =====
     print("=" * 100)
     print("Creating ArT LMDBs")
     print("=" * 100)
-    
-    art_sources = [
-        "/data1/vivek/parseq/data/art_lmdb/train/art",
-        "/data1/vivek/parseq/data/art_lmdb/val"
-    ]
-    
-    art_train_count = create_art_lmdb(
-        art_sources,
-        f"{output_base}/art_lmdb/train/art",
-        splits['art_train'],
-        "Train"
-    )
-    
-    art_val_count = create_art_lmdb(
-        art_sources,
-        f"{output_base}/art_lmdb/val/art",
-        splits['art_val'],
-        "Val"
-    )
-    
-    art_test_count = create_art_lmdb(
-        art_sources,
-        f"{output_base}/art_lmdb/test/art",
-        splits['art_test'],
-        "Test"
-    )
-    
-    # ===== Total-Text Note =====
+
+    art_counts = create_art_lmdbs(args.art_sources, output_base, splits, args.views)
+
+    # ===== Total-Text LMDB Creation =====
     print("\n" + "=" * 100)
-    print("Total-Text LMDB Creation")
+    print("Creating Total-Text LMDBs")
     print("=" * 100)
-    print()
-    print("⚠️  Total-Text LMDB creation requires original image files.")
-    print("   The existing LMDB doesn't have imagepath keys, so we can't filter it.")
-    print()
-    print("   You have two options:")
-    print("   1. Use STR-HUB's create_lmdb_dataset.py with the split files")
-    print("   2. Manually create LMDB from Total-Text images using the split lists")
-    print()
-    print("   Split files are in: /data1/vivek/parseq/dataset_splits/")
-    print()
-    
+
+    # The original Train/Test subsets are re-split by scene, so route crops from both
+    if args.views:
+        tt_sources = [f"{args.totaltext_lmdb_root}/{subset}" for subset in ("Train", "Test")]
+    else:
+        tt_sources = [(f"{args.totaltext_crops}/{subset}_gt.txt", f"{args.totaltext_crops}/{subset}")
+                      for subset in ("Train", "Test")]
+    tt_counts = create_totaltext_lmdbs(tt_sources, output_base, splits, args.views)
+
     # ===== Create Curved Mix =====
-    print("=" * 100)
+    print("\n" + "=" * 100)
     print("Creating Curved Mix Dataset")
     print("=" * 100)
     print()
     print("Creating symlinks for curved_mix (Total-Text + ArT)...")
-    
-    curved_mix_dir = f"{output_base}/curved_mix"
-    os.makedirs(f"{curved_mix_dir}/train", exist_ok=True)
-    os.makedirs(f"{curved_mix_dir}/val", exist_ok=True)
-    os.makedirs(f"{curved_mix_dir}/test", exist_ok=True)
-    
-    # Create symlinks (will need Total-Text LMDBs first)
-    print("  ⚠️  Curved mix will be created after Total-Text LMDBs are ready")
-    
+
+    create_curved_mix(output_base)
+
     # ===== Summary =====
     print("\n" + "=" * 100)
     print("SUMMARY")
     print("=" * 100)
     print()
-    print("✅ ArT LMDBs created:")
-    print(f"   - Train: {art_train_count:,} text crops from {len(splits['art_train'])} scenes")
-    print(f"   - Val:   {art_val_count:,} text crops from {len(splits['art_val'])} scenes")
-    print(f"   - Test:  {art_test_count:,} text crops from {len(splits['art_test'])} scenes")
+    kind = "views" if args.views else "LMDBs"
+    print(f"✅ ArT {kind} created:")
+    print(f"   - Train: {art_counts['train']:,} text crops from {len(splits['art_train'])} scenes")
+    print(f"   - Val:   {art_counts['val']:,} text crops from {len(splits['art_val'])} scenes")
+    print(f"   - Test:  {art_counts['test']:,} text crops from {len(splits['art_test'])} scenes")
     print()
-    print("⚠️  Total-Text LMDBs need to be created separately")
-    print("   Use the split files in: /data1/vivek/parseq/dataset_splits/")
+    print(f"✅ Total-Text {kind} created:")
+    print(f"   - Train: {tt_counts['train']:,} text crops from {len(splits['tt_train'])} images")
+    print(f"   - Val:   {tt_counts['val']:,} text crops from {len(splits['tt_val'])} images")
+    print(f"   - Test:  {tt_counts['test']:,} text crops from {len(splits['tt_test'])} images")
     print()
-    print("Output directory: /data1/vivek/parseq/data_fixed/")
+    print(f"Output directory: {output_base}/")
     print()
     print("=" * 100)
 
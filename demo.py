@@ -9,8 +9,11 @@ import torch
 import numpy as np
 from PIL import Image
 import string
+import time
+from contextlib import contextmanager
 from pathlib import Path
 
+from strhub.data.module import SceneTextDataModule
 from strhub.models.parseq.system import PARSeq
 from strhub.models.parseq.system_finetune import PARSeqFineTuneDecoder
 from strhub.models.parseq.system_fullfinetune import PARSeqFullFineTune
@@ -22,6 +25,7 @@ FULL_FINETUNE_CKPT = "outputs/parseq_fullfinetune/2025-11-21_14-21-29/checkpoint
 
 # Global model cache
 models_cache = {}
+runner_cache = {}
 
 def load_models():
     """Load all models into cache"""
@@ -65,54 +69,89 @@ def load_models():
     print("All models loaded!")
     return models_cache
 
-def preprocess_image(image):
-    """Preprocess image for model input"""
-    if isinstance(image, np.ndarray):
-        image = Image.fromarray(image)
-    
-    # Convert to RGB if needed
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    
-    # Resize to model input size (32x128)
-    image = image.resize((128, 32), Image.LANCZOS)
-    
-    # Convert to tensor
-    img_array = np.array(image).astype(np.float32) / 255.0
-    img_tensor = torch.from_numpy(img_array).permute(2, 0, 1).unsqueeze(0)
-    
-    if torch.cuda.is_available():
-        img_tensor = img_tensor.cuda()
-    
-    return img_tensor
-
-def predict_with_model(model, image_tensor):
-    """Run prediction with a model"""
-    with torch.no_grad():
-        logits = model(image_tensor)
-        probs = logits.softmax(-1)
-        preds, confs = model.tokenizer.decode(probs)
-    
-    pred_text = preds[0]
-    confidence = float(np.mean(confs[0])) if len(confs[0]) > 0 else 0.0
-    
-    return pred_text, confidence
+def same_weights(a, b):
+    """True if two modules have the same parameters and buffers"""
+    a, b = a.state_dict(), b.state_dict()
+    return a.keys() == b.keys() and all(
+        a[k].shape == b[k].shape and torch.equal(a[k], b[k].to(a[k].device)) for k in a
+    )
+
+@contextmanager
+def cached_encoding(model, memory):
+    """Make the model's decoding use an already computed encoder output"""
+    model.model.encode = lambda img: memory
+    try:
+        yield
+    finally:
+        del model.model.encode  # back to the class method
+
+class SharedEncoderRunner:
+    """Runs several models on the same image, computing each distinct encoder only once.
+
+    Models whose encoders have identical weights (e.g. the baseline and the decoder-only
+    fine-tune, which keeps the encoder frozen) and the same input size form a group: the
+    image is encoded once per group and the memory is fanned out to the group's decoders.
+    """
+
+    def __init__(self, models):
+        self.models = models
+        self.groups = []  # lists of model names
+        for name, model in models.items():
+            for group in self.groups:
+                first = models[group[0]]
+                if first.hparams.img_size == model.hparams.img_size and same_weights(
+                    first.model.encoder, model.model.encoder
+                ):
+                    group.append(name)
+                    break
+            else:
+                self.groups.append([name])
+        self.transforms = {
+            tuple(group): SceneTextDataModule.get_transform(models[group[0]].hparams.img_size)
+            for group in self.groups
+        }
+        print(f"Encoder groups: {self.groups}")
+
+    @torch.inference_mode()
+    def __call__(self, image):
+        """Prediction and confidence of each model for a PIL image"""
+        results = {}
+        for group in self.groups:
+            first = self.models[group[0]]
+            img_tensor = self.transforms[tuple(group)](image).unsqueeze(0).to(first.device)
+            memory = first.model.encode(img_tensor)
+            for name in group:
+                model = self.models[name]
+                with cached_encoding(model, memory):
+                    probs = model(img_tensor).softmax(-1)
+                preds, confs = model.tokenizer.decode(probs)
+                confidence = confs[0].mean().item() if len(confs[0]) > 0 else 0.0
+                results[name] = (preds[0], confidence)
+        return results
+
+def get_runner():
+    """Shared-encoder runner over the cached models"""
+    if not runner_cache:
+        runner_cache['runner'] = SharedEncoderRunner(load_models())
+    return runner_cache['runner']
 
 def predict_all_models(image):
     """Run prediction with all models"""
     if image is None:
-        return "Please upload an image", "", "", "", "", ""
-    
-    # Load models
-    models = load_models()
+        return "Please upload an image", "", "", ""
     
-    # Preprocess image
-    img_tensor = preprocess_image(image)
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    image = image.convert('RGB')
     
-    # Get predictions
-    baseline_text, baseline_conf = predict_with_model(models['baseline'], img_tensor)
-    decoder_text, decoder_conf = predict_with_model(models['decoder_ft'], img_tensor)
-    full_text, full_conf = predict_with_model(models['full_ft'], img_tensor)
+    # Get predictions (the encoder is shared where the weights are the same)
+    runner = get_runner()
+    start = time.perf_counter()
+    results = runner(image)
+    elapsed = time.perf_counter() - start
+    baseline_text, baseline_conf = results['baseline']
+    decoder_text, decoder_conf = results['decoder_ft']
+    full_text, full_conf = results['full_ft']
     
     # Format results
     baseline_result = f"**Prediction:** {baseline_text}\n**Confidence:** {baseline_conf:.2%}"
@@ -129,6 +168,8 @@ def predict_all_models(image):
 | Decoder Fine-tuned | `{decoder_text}` | {decoder_conf:.2%} |
 | **Full Fine-tuned** | `{full_text}` | {full_conf:.2%} |
 
+Inference time: {elapsed * 1000:.0f} ms ({len(runner.groups)} encoder passes for 3 models)
+
 **Accuracy on Total-Text:**
 - Baseline: 93.02%
 - Decoder Fine-tuned: 93.52% (+0.50%)
@@ -164,7 +205,7 @@ def create_demo():
                 - Upload images with **curved or distorted text**
                 - Works best with **single-line text**
                 - Supports **alphanumeric characters**
-                - Image will be resized to 32x128
+                - Image will be resized to the model input size (32x128)
                 """)
         
             with gr.Column(scale=2):
@@ -219,7 +260,7 @@ if __name__ == "__main__":
     print("Loading models (this may take a minute)...")
     
     # Pre-load models
-    load_models()
+    get_runner()
     
     # Create and launch demo
     demo = create_demo()
@@ -14,37 +14,148 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Read the text in images, one by one or in bulk.
+
+Inputs can be image files, directories (searched recursively), glob patterns and lists of files. Images are decoded
+and transformed by a pool of workers while the model runs on the previous batch. Predictions are printed, or streamed
+to a JSONL or CSV file with their confidence.
+"""
+
 import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from contextlib import nullcontext
 
 from PIL import Image
+from tqdm import tqdm
 
 import torch
+from torch.utils.data import DataLoader, Dataset
 
 from strhub.data.module import SceneTextDataModule
 from strhub.models.utils import load_from_checkpoint, parse_model_args
 
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+
+def find_images(inputs: list[str], file_list: str = None) -> list[str]:
+    """Expand directories (recursively, sorted) and glob patterns, and add the paths listed in `file_list`."""
+    paths = []
+    for spec in inputs:
+        if os.path.isdir(spec):
+            for dirpath, dirnames, filenames in os.walk(spec):
+                dirnames.sort()
+                paths += [os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith(IMAGE_EXTENSIONS)]
+        elif glob.has_magic(spec):
+            paths += sorted(glob.glob(spec, recursive=True))
+        else:
+            paths.append(spec)
+    if file_list is not None:
+        # Do not close stdin
+        with open(file_list) if file_list != '-' else nullcontext(sys.stdin) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    return paths
+
+
+class ImageFiles(Dataset):
+    """Images to read, decoded and transformed. Unreadable images give None and the error message."""
+
+    def __init__(self, paths: list[str], transform):
+        self.paths = paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        try:
+            image = Image.open(self.paths[index]).convert('RGB')
+        except (IOError, ValueError) as e:
+            return None, index, str(e)
+        return self.transform(image), index, None
+
+
+def collate(batch):
+    """Stack the readable images; pass the failures through."""
+    images = [image for image, _, _ in batch if image is not None]
+    indices = [index for image, index, _ in batch if image is not None]
+    failed = [(index, error) for image, index, error in batch if image is None]
+    return (torch.stack(images) if images else None), indices, failed
+
+
+class ResultWriter:
+    """Streams results to a JSONL or CSV file, or prints them."""
+
+    def __init__(self, path: str = None, fmt: str = None):
+        self.fmt = fmt or ('csv' if path is not None and path.lower().endswith('.csv') else 'jsonl')
+        self.file = open(path, 'w', newline='') if path is not None else None
+        if self.file is not None and self.fmt == 'csv':
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(['path', 'text', 'confidence', 'error'])
+
+    def write(self, path: str, text: str = None, confidence: float = None, char_confidences: list = None, error=None):
+        if self.file is None:
+            print(f'{path}: {text}' if error is None else f'{path}: ERROR {error}')
+        elif self.fmt == 'csv':
+            self.csv.writerow([path, text, confidence, error])
+        else:
+            result = {'path': path, 'text': text, 'confidence': confidence, 'char_confidences': char_confidences}
+            self.file.write(json.dumps(result if error is None else {'path': path, 'error': error}) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
 
 @torch.inference_mode()
 def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('checkpoint', help="Model checkpoint (or 'pretrained=<model_id>')")
-    parser.add_argument('--images', nargs='+', help='Images to read')
+    parser.add_argument('--images', nargs='+', default=[], help='Images to read: files, directories or globs')
+    parser.add_argument('--file_list', help="File with one image path per line ('-' for stdin)")
+    parser.add_argument('--output', help='Write the results to this JSONL or CSV file instead of printing them')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='Output format (default: from the extension)')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=4, help='Processes decoding and transforming the images')
     parser.add_argument('--device', default='cuda')
     args, unknown = parser.parse_known_args()
     kwargs = parse_model_args(unknown)
     print(f'Additional keyword arguments: {kwargs}')
 
+    paths = find_images(args.images, args.file_list)
     model = load_from_checkpoint(args.checkpoint, **kwargs).eval().to(args.device)
     img_transform = SceneTextDataModule.get_transform(model.hparams.img_size)
 
-    for fname in args.images:
-        # Load image and prepare for input
-        image = Image.open(fname).convert('RGB')
-        image = img_transform(image).unsqueeze(0).to(args.device)
-
-        p = model(image).softmax(-1)
-        pred, p = model.tokenizer.decode(p)
-        print(f'{fname}: {pred[0]}')
+    dataloader = DataLoader(
+        ImageFiles(paths, img_transform),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        collate_fn=collate,
+        pin_memory=args.device.startswith('cuda'),
+    )
+    writer = ResultWriter(args.output, args.format)
+    num_failed = 0
+    try:
+        # The workers prepare the next batches while the model runs on this one
+        for images, indices, failed in tqdm(dataloader, disable=args.output is None, unit='batch'):
+            for index, error in failed:
+                writer.write(paths[index], error=error)
+            num_failed += len(failed)
+            if images is None:
+                continue
+            p = model(images.to(args.device, non_blocking=True)).softmax(-1)
+            preds, probs = model.tokenizer.decode(p)
+            for index, pred, prob in zip(indices, preds, probs):
+                # Same confidence as test.py: the product of the character probabilities, end-of-sequence included
+                char_confidences = prob[: len(pred)].tolist()
+                writer.write(paths[index], pred, prob.prod().item(), char_confidences)
+    finally:
+        writer.close()
+    if args.output is not None:
+        print(f'Read {len(paths) - num_failed} images to {args.output} ({num_failed} could not be opened)')
 
 
 if __name__ == '__main__':
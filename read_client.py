@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read the text in images through a warm serve.py daemon, like read.py but without loading anything.
+
+The client only uses the standard library: it sends the image paths over the daemon's Unix socket and prints the
+predictions. With --start, the daemon is started in the background first if it is not running yet (the first call
+then pays for loading the model once).
+
+Each call still starts a Python process, which takes a good part of a second. Scripts reading many images should not
+run one client per image: give all the images (or a --file_list) to one call, or use --stream, which reads paths from
+stdin and prints each result as soon as it is ready, taking milliseconds per image.
+
+Example:
+    ./read_client.py --start pretrained=parseq image1.jpg image2.jpg
+    ./read_client.py image3.jpg
+    find crops/ -name '*.jpg' | ./read_client.py --stream
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import closing, nullcontext
+
+DEFAULT_SOCKET = os.environ.get('STRHUB_SOCKET', os.path.join(tempfile.gettempdir(), f'strhub-{os.getuid()}.sock'))
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(conn: http.client.HTTPConnection, method: str, url: str, payload=None):
+    """Send one request on the (kept-alive) connection and return the decoded JSON response."""
+    body = json.dumps(payload).encode() if payload is not None else None
+    conn.request(method, url, body=body, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    result = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f'{url}: {result.get("error", response.status)}')
+    return result
+
+
+def is_running(sock_path: str) -> bool:
+    try:
+        with closing(UnixHTTPConnection(sock_path, timeout=5)) as conn:
+            request(conn, 'GET', '/health')
+    except (OSError, RuntimeError):
+        return False
+    return True
+
+
+def start_daemon(sock_path: str, checkpoint: str, serve_args: list[str], timeout: float) -> None:
+    """Start serve.py in the background on `sock_path` and wait until it answers."""
+    serve = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+    cmd = [sys.executable, serve, checkpoint, '--unix_socket', sock_path, '--report_interval', '0'] + serve_args
+    log_path = sock_path + '.log'
+    with open(log_path, 'ab') as log:
+        # A new session: the daemon outlives this client and its terminal
+        process = subprocess.Popen(cmd, stdout=log, stderr=log, stdin=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while not is_running(sock_path):
+        if process.poll() is not None:
+            sys.exit(f'The daemon exited with status {process.returncode}, see {log_path}')
+        if time.monotonic() > deadline:
+            sys.exit(f'The daemon did not start within {timeout:.0f} s, see {log_path}')
+        time.sleep(0.1)
+    print(f'Started the daemon (pid {process.pid}) on {sock_path}', file=sys.stderr)
+
+
+def print_result(path: str, result: dict, as_json: bool) -> None:
+    if as_json:
+        print(json.dumps({**result, 'path': path}))
+    elif 'error' in result:
+        print(f'{path}: ERROR {result["error"]}')
+    else:
+        print(f'{path}: {result["text"]}')
+
+
+def read_paths(conn: http.client.HTTPConnection, paths: list[str]) -> list[dict]:
+    # The daemon has its own working directory
+    return request(conn, 'POST', '/read_paths', {'paths': [os.path.abspath(path) for path in paths]})['results']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='*', help='Images to read')
+    parser.add_argument('--file_list', help="File with one image path per line ('-' for stdin)")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket of the daemon (env: STRHUB_SOCKET)')
+    parser.add_argument('--start', metavar='CHECKPOINT', help='Start the daemon with this model if it is not running')
+    parser.add_argument('--serve_args', default='', help="Further arguments to serve.py, e.g. '--max_batch_size 16'")
+    parser.add_argument('--start_timeout', type=float, default=300)
+    parser.add_argument(
+        '--stream', action='store_true', help='Read image paths from stdin, printing each result as soon as it is ready'
+    )
+    parser.add_argument('--json', action='store_true', help='Print one JSON object per image, with the confidence')
+    parser.add_argument('--stats', action='store_true', help="Print the daemon's latency and batch size stats")
+    args = parser.parse_args()
+    if args.stream and args.file_list == '-':
+        parser.error('--stream reads the image paths from stdin: it cannot be combined with --file_list -')
+
+    if args.start is not None and not is_running(args.socket):
+        start_daemon(args.socket, args.start, shlex.split(args.serve_args), args.start_timeout)
+
+    paths = list(args.images)
+    if args.file_list is not None:
+        # Do not close stdin
+        with open(args.file_list) if args.file_list != '-' else nullcontext(sys.stdin) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    try:
+        # One connection, kept alive for all requests
+        with closing(UnixHTTPConnection(args.socket)) as conn:
+            if paths:
+                for path, result in zip(paths, read_paths(conn, paths)):
+                    print_result(path, result, args.json)
+            if args.stream:
+                for line in sys.stdin:
+                    if line.strip():
+                        (result,) = read_paths(conn, [line.strip()])
+                        print_result(line.strip(), result, args.json)
+                        sys.stdout.flush()
+            if args.stats:
+                print(json.dumps(request(conn, 'GET', '/stats'), indent=2))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(f'No daemon on {args.socket}: start one with --start CHECKPOINT, or serve.py --unix_socket')
+
+
+if __name__ == '__main__':
+    main()
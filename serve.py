@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve a model over HTTP (TCP and/or a Unix socket), gathering concurrent requests into micro-batches.
+
+Example:
+    ./serve.py pretrained=parseq --port 8000
+    curl --data-binary @image.jpg http://localhost:8000/read
+    curl http://localhost:8000/stats
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+import torch
+
+from strhub.data.module import SceneTextDataModule
+from strhub.models.utils import load_from_checkpoint, parse_model_args
+from strhub.serving import InferenceServer, MicroBatcher, model_inference
+
+
+async def report_stats(stats, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(stats.report()), flush=True)
+
+
+async def serve(server, args):
+    if args.report_interval > 0:
+        asyncio.create_task(report_stats(server.batcher.stats, args.report_interval))
+    await server.serve(args.host, args.port, args.unix_socket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('checkpoint', help="Model checkpoint (or 'pretrained=<model_id>')")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='TCP port to listen on')
+    parser.add_argument('--unix_socket', help='Path of a Unix socket to listen on')
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='Longest wait for a batch to fill up')
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(), help='Threads used by torch')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--report_interval', type=float, default=60, help='Print the stats every N seconds (0: never)')
+    args, unknown = parser.parse_known_args()
+    if args.port is None and args.unix_socket is None:
+        parser.error('give --port and/or --unix_socket')
+    kwargs = parse_model_args(unknown)
+    print(f'Additional keyword arguments: {kwargs}')
+
+    torch.set_num_threads(args.num_threads)
+    model = load_from_checkpoint(args.checkpoint, **kwargs).eval().to(args.device)
+    transform = SceneTextDataModule.get_transform(model.hparams.img_size)
+    batcher = MicroBatcher(model_inference(model, args.device), args.max_batch_size, args.max_wait_ms / 1000)
+    server = InferenceServer(batcher, transform)
+    listening = [f'http://{args.host}:{args.port}'] if args.port is not None else []
+    listening += [f'unix:{args.unix_socket}'] if args.unix_socket is not None else []
+    print(f'Listening on {", ".join(listening)}', flush=True)
+    try:
+        asyncio.run(serve(server, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-disk index of large COCO-style annotation files (TextOCR, COCO-Text v2, OpenImages text spotting).
+
+The JSON file is scanned once, in fixed-size chunks, recording the byte range of every image and annotation record.
+The ranges are kept in an SQLite database next to the JSON file (``<json>.index.sqlite``), which is rebuilt when the
+JSON file changes. Converters then hand out image positions to their workers, which read just the records they need
+straight from the JSON file. Memory use does not depend on the size of the annotation file.
+"""
+
+import json
+import os
+import re
+import sqlite3
+from contextlib import closing
+from typing import Any, BinaryIO, Iterator, Optional
+
+_VERSION = 1
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+_SCALAR = re.compile(rb'[^,\]}\s]+')
+
+
+class _Scanner:
+    """Walks the members of top-level JSON values, reading the file in chunks."""
+
+    def __init__(self, f: BinaryIO, chunk_size: int = 1 << 22):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = b''
+        self.base = 0  # file offset of buf[0]
+        self.pos = 0  # read position in buf
+
+    def _more(self) -> None:
+        data = self.f.read(self.chunk_size)
+        if not data:
+            raise ValueError(f'Unexpected end of JSON at offset {self.base + len(self.buf)}')
+        self.buf += data
+
+    def _compact(self, keep_from: Optional[int] = None) -> int:
+        """Drop the buffer before `keep_from` (default: the read position), but only once that is most of the buffer,
+        so that the copying stays linear in the file size. Returns the number of bytes dropped."""
+        keep_from = self.pos if keep_from is None else keep_from
+        if keep_from <= len(self.buf) // 2:
+            return 0
+        self.base += keep_from
+        self.buf = self.buf[keep_from:]
+        self.pos -= keep_from
+        return keep_from
+
+    def _skip_whitespace(self) -> None:
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return
+            self._compact()
+            self._more()
+
+    def _expect(self, chars: bytes) -> bytes:
+        self._skip_whitespace()
+        c = self.buf[self.pos : self.pos + 1]
+        if c not in chars:
+            raise ValueError(f'Expected one of {chars!r} at offset {self.base + self.pos}, got {c!r}')
+        self.pos += 1
+        return c
+
+    def _string(self) -> str:
+        while (m := _STRING.match(self.buf, self.pos)) is None:
+            self._more()
+        self.pos = m.end()
+        return json.loads(m.group())
+
+    def _value(self, keep: bool = True) -> tuple[int, Optional[bytes]]:
+        """Skip over one value. Returns its file offset and raw bytes (None unless `keep`).
+
+        Without `keep`, the part of a container scanned so far is dropped as more is read, so skipping a large value
+        takes no more memory than a few chunks.
+        """
+        self._skip_whitespace()
+        start = self.pos
+        offset = self.base + start
+        c = self.buf[start : start + 1]
+        if c == b'"':
+            self._string()
+        elif c in b'{[':
+            depth, i = 0, start
+
+            def more(scanned):
+                nonlocal start, i
+                shift = self._compact(start if keep else scanned)
+                start -= shift
+                i = scanned - shift
+                self._more()
+
+            while True:
+                m = _STRUCTURE.search(self.buf, i)
+                if m is None:
+                    more(len(self.buf))
+                    continue
+                t = m.group()
+                if t == b'"':
+                    s = _STRING.match(self.buf, m.start())
+                    if s is None:
+                        more(m.start())
+                        continue
+                    i = s.end()
+                    continue
+                i = m.end()
+                depth += 1 if t in b'{[' else -1
+                if depth == 0:
+                    break
+            self.pos = i
+        else:
+            while (m := _SCALAR.match(self.buf, start)) is None or m.end() == len(self.buf):
+                self._more()
+            self.pos = m.end()
+        return offset, self.buf[start : self.pos] if keep else None
+
+    def members(self, sections: set[str]) -> Iterator[tuple[str, Any, int, bytes]]:
+        """Yield (section, member key or list position, file offset, raw value) for the members of each of the given
+        top-level keys. Other top-level values are skipped without decoding."""
+        self._expect(b'{')
+        if self._expect(b'"}') == b'}':
+            return
+        while True:
+            self.pos -= 1
+            section = self._string()
+            self._expect(b':')
+            if section not in sections:
+                self._value(keep=False)
+                self._compact()
+            else:
+                opening = self._expect(b'{[')
+                closing = b'}' if opening == b'{' else b']'
+                n = 0
+                while True:
+                    self._skip_whitespace()
+                    if self.buf[self.pos : self.pos + 1] == closing:
+                        self.pos += 1
+                        break
+                    if n:
+                        self._expect(b',')
+                    if opening == b'{':
+                        self._expect(b'"')
+                        self.pos -= 1
+                        key = self._string()
+                        self._expect(b':')
+                    else:
+                        key = n
+                    offset, value = self._value()
+                    yield section, key, offset, value
+                    n += 1
+                    self._compact()
+            if self._expect(b',}') == b'}':
+                return
+            self._expect(b'"')
+
+
+class AnnotationIndex:
+    """Index of the images of an annotation file and the annotations of each.
+
+    Args:
+        json_path: Annotation file
+        images: Top-level key of the image records (an object or a list)
+        anns: Top-level key of the annotation records (an object or a list)
+        img_to_anns: Top-level key of the image id -> annotation ids mapping, if the file has one. It determines the
+            order of the annotations of an image. Otherwise, annotations are grouped by their ``image_id`` field, in
+            file order.
+
+    Image ids are compared as strings. Instances can be sent to worker processes; connections are opened lazily.
+    """
+
+    def __init__(self, json_path: str, images: str, anns: str, img_to_anns: Optional[str] = None):
+        self.json_path = json_path
+        self.index_path = json_path + '.index.sqlite'
+        self.sections = {'images': images, 'anns': anns, 'img_to_anns': img_to_anns}
+        self._db = None
+        self._file = None
+        if not self._is_valid():
+            self._build()
+
+    def __getstate__(self):
+        return {**self.__dict__, '_db': None, '_file': None}
+
+    def _source_info(self) -> str:
+        stat = os.stat(self.json_path)
+        return json.dumps({'version': _VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, **self.sections})
+
+    def _is_valid(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with closing(sqlite3.connect(self.index_path)) as db:
+                (info,) = db.execute('SELECT info FROM source').fetchone()
+        except (sqlite3.Error, TypeError):
+            return False
+        return info == self._source_info()
+
+    def _build(self) -> None:
+        tmp = self.index_path + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        db.executescript(
+            """
+            CREATE TABLE source (info TEXT);
+            CREATE TABLE images (pos INTEGER PRIMARY KEY, id TEXT, offset INTEGER, length INTEGER);
+            CREATE TABLE anns (key TEXT, image_id TEXT, offset INTEGER, length INTEGER);
+            CREATE TABLE img_to_anns (image_id TEXT PRIMARY KEY, ann_keys TEXT);
+            """
+        )
+        names = {key: name for name, key in self.sections.items() if key is not None}
+        batches = {'images': [], 'anns': [], 'img_to_anns': []}
+        inserts = {
+            'images': 'INSERT INTO images VALUES (?, ?, ?, ?)',
+            'anns': 'INSERT INTO anns VALUES (?, ?, ?, ?)',
+            'img_to_anns': 'INSERT INTO img_to_anns VALUES (?, ?)',
+        }
+        num_images = 0
+        with open(self.json_path, 'rb') as f:
+            for section, key, offset, value in _Scanner(f).members(set(names)):
+                name = names[section]
+                if name == 'images':
+                    image_id = str(json.loads(value)['id'])
+                    batches['images'].append((num_images, image_id, offset, len(value)))
+                    num_images += 1
+                elif name == 'anns':
+                    image_id = None if self.sections['img_to_anns'] else str(json.loads(value)['image_id'])
+                    batches['anns'].append((str(key), image_id, offset, len(value)))
+                else:
+                    batches['img_to_anns'].append((str(key), json.dumps([str(k) for k in json.loads(value)])))
+                if len(batches[name]) >= 100000:
+                    db.executemany(inserts[name], batches[name])
+                    batches[name] = []
+        for name, rows in batches.items():
+            db.executemany(inserts[name], rows)
+        db.execute('CREATE INDEX anns_key ON anns (key)')
+        db.execute('CREATE INDEX anns_image_id ON anns (image_id)')
+        db.execute('INSERT INTO source VALUES (?)', (self._source_info(),))
+        db.commit()
+        db.close()
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _num_rows(db: sqlite3.Connection, table: str) -> int:
+        return db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True)
+            self._file = open(self.json_path, 'rb')
+        return self._db
+
+    def _read(self, offset: int, length: int) -> Any:
+        self._file.seek(offset)
+        return json.loads(self._file.read(length))
+
+    def __len__(self):
+        return self._num_rows(self._connect(), 'images')
+
+    def image(self, pos: int) -> tuple[dict, list[dict]]:
+        """Return the record of the image at the given position in the file, and the records of its annotations."""
+        db = self._connect()
+        image_id, offset, length = db.execute('SELECT id, offset, length FROM images WHERE pos = ?', (pos,)).fetchone()
+        img_info = self._read(offset, length)
+        if self.sections['img_to_anns']:
+            row = db.execute('SELECT ann_keys FROM img_to_anns WHERE image_id = ?', (image_id,)).fetchone()
+            ann_keys = json.loads(row[0]) if row else []
+            found = {}
+            # In batches below the SQLite limit on the number of parameters
+            for i in range(0, len(ann_keys), 500):
+                batch = ann_keys[i : i + 500]
+                query = f'SELECT key, offset, length FROM anns WHERE key IN ({", ".join("?" * len(batch))})'
+                found.update((key, (offset, length)) for key, offset, length in db.execute(query, batch))
+            ranges = [found[k] for k in ann_keys if k in found]
+        else:
+            ranges = db.execute(
+                'SELECT offset, length FROM anns WHERE image_id = ? ORDER BY rowid', (image_id,)
+            ).fetchall()
+        return img_info, [self._read(offset, length) for offset, length in ranges]
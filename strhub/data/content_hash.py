@@ -0,0 +1,183 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-image hashes of an LMDB dataset, cached next to the LMDB.
+
+The hashes of all samples are stored as one raw array of fixed-size items in ``<lmdb>/<name>.bin`` (row ``i`` holds
+the hash of sample ``i + 1``; all zeros if the sample has no image). ``<name>.json`` records what the cache was
+computed from: the hash parameters, and the `build-id` of the LMDB if it has one, else the size and mtime of
+``data.mdb``. The cache is recomputed whenever these no longer match.
+
+Split views (see strhub.data.split_view) are resolved into their source samples: the hashes of a view are gathered
+from the (cached) hashes of its sources.
+"""
+
+import hashlib
+import json
+import os
+import warnings
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, Optional
+
+import numpy as np
+
+from strhub.data.lmdb_utils import iter_images, open_readonly, read_build_id, read_num_samples
+from strhub.data.split_view import SplitView
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DIGEST_SIZE = 16
+# A digest viewed as two integers, which numpy can sort, compare and set-intersect
+HASH_DTYPE = np.dtype([('hi', '<u8'), ('lo', '<u8')])
+CACHE_NAME = 'content_hash'
+
+
+def _blake2b(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+# All produce DIGEST_SIZE bytes. xxh3_128 is several times faster than BLAKE2b but needs the optional xxhash package.
+DIGESTS = {'blake2b': _blake2b}
+if xxhash is not None:
+    DIGESTS['xxh3_128'] = xxhash.xxh3_128_digest
+DEFAULT_DIGEST = 'xxh3_128' if xxhash is not None else 'blake2b'
+
+_env = None
+
+
+def _init_worker(lmdb_path):
+    global _env
+    _env = open_readonly(lmdb_path)
+
+
+def _hash_chunk(chunk, hash_fn, itemsize):
+    """Hash the images of the index range, walking the keys with cursors. Runs in the workers."""
+    start, end = chunk
+    hashes = bytearray((end - start + 1) * itemsize)
+    with _env.begin(buffers=True) as txn:
+        # Missing samples are skipped; their rows stay zero.
+        for index, value in iter_images(txn, start, end):
+            offset = (index - start) * itemsize
+            hashes[offset : offset + itemsize] = hash_fn(value)
+    return start, bytes(hashes)
+
+
+def _source_info(lmdb_path: str, **params) -> dict:
+    with open_readonly(lmdb_path) as env:
+        num_samples = read_num_samples(env)
+        build_id = read_build_id(env)
+    info = {**params, 'num_samples': num_samples}
+    if build_id is not None:
+        info['build_id'] = build_id
+    else:
+        stat = os.stat(os.path.join(lmdb_path, 'data.mdb'))
+        info['size'] = stat.st_size
+        info['mtime_ns'] = stat.st_mtime_ns
+    return info
+
+
+def _load_cache(lmdb_path: str, name: str, info: dict, dtype: np.dtype) -> Optional[np.ndarray]:
+    try:
+        with open(os.path.join(lmdb_path, name + '.json')) as f:
+            if json.load(f) != info:
+                return None
+        hashes = np.fromfile(os.path.join(lmdb_path, name + '.bin'), dtype)
+    except (OSError, ValueError):
+        return None
+    return hashes if len(hashes) == info['num_samples'] else None
+
+
+def _save_cache(lmdb_path: str, name: str, info: dict, hashes: np.ndarray) -> None:
+    try:
+        hashes.tofile(os.path.join(lmdb_path, name + '.bin'))
+        tmp = os.path.join(lmdb_path, name + '.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+        # The info file is written last, so a partially written cache is never considered valid.
+        os.replace(tmp, os.path.join(lmdb_path, name + '.json'))
+    except OSError as e:
+        warnings.warn(f'Could not cache the {name} of {lmdb_path}: {e}')
+
+
+def hash_images(
+    lmdb_path: str,
+    name: str,
+    hash_fn: Callable[[bytes], bytes],
+    dtype: np.dtype,
+    params: dict,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 10000,
+    refresh: bool = False,
+) -> np.ndarray:
+    """Apply `hash_fn` to all images of the LMDB, with caching. Returns an array of `num-samples` items of `dtype`.
+
+    `hash_fn` must return ``dtype.itemsize`` bytes per image and be picklable. The result is cached as ``<name>.bin``
+    together with `params`, which must describe `hash_fn` fully. The cache is used if it is still valid, unless
+    `refresh` is set. Otherwise, the images are hashed by `num_workers` processes, each walking a range of keys with
+    a cursor.
+
+    `lmdb_path` can also be a split view, whose samples get the hashes of the source samples they refer to.
+    """
+    if SplitView.exists(lmdb_path):
+        view = SplitView(lmdb_path)
+        hashes = np.zeros(len(view), dtype)
+        for source, path in enumerate(view.sources):
+            source_hashes = hash_images(path, name, hash_fn, dtype, params, num_workers, chunk_size, refresh)
+            positions = np.flatnonzero(view.source_ids == source)
+            indices = view.indices[positions].astype(np.int64)
+            if len(indices) and indices.max() > len(source_hashes):
+                raise ValueError(f'The view {lmdb_path} refers to samples beyond the end of {path}')
+            hashes[positions] = source_hashes[indices - 1]
+        return hashes
+    # Read everything needed from the LMDB before forking: an environment must not be inherited by the workers.
+    info = _source_info(lmdb_path, **params)
+    if not refresh:
+        hashes = _load_cache(lmdb_path, name, info, dtype)
+        if hashes is not None:
+            return hashes
+    num_samples = info['num_samples']
+    hashes = bytearray(num_samples * dtype.itemsize)
+    chunks = [(start, min(start + chunk_size - 1, num_samples)) for start in range(1, num_samples + 1, chunk_size)]
+    if chunks:
+        work = partial(_hash_chunk, hash_fn=hash_fn, itemsize=dtype.itemsize)
+        with Pool(min(num_workers or os.cpu_count(), len(chunks)), _init_worker, (lmdb_path,)) as pool:
+            for start, chunk_hashes in pool.imap_unordered(work, chunks):
+                offset = (start - 1) * dtype.itemsize
+                hashes[offset : offset + len(chunk_hashes)] = chunk_hashes
+    hashes = np.frombuffer(hashes, dtype)
+    _save_cache(lmdb_path, name, info, hashes)
+    return hashes
+
+
+def content_hashes(
+    lmdb_path: str,
+    digest: str = DEFAULT_DIGEST,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 10000,
+    refresh: bool = False,
+) -> np.ndarray:
+    """Return the digests of all images of the LMDB, as an array of `num-samples` items of HASH_DTYPE."""
+    return hash_images(
+        lmdb_path, CACHE_NAME, DIGESTS[digest], HASH_DTYPE, {'digest': digest}, num_workers, chunk_size, refresh
+    )
+
+
+def valid_hashes(hashes: np.ndarray) -> np.ndarray:
+    """Drop the rows of samples without an image."""
+    return hashes[(hashes['hi'] != 0) | (hashes['lo'] != 0)]
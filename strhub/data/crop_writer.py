@@ -0,0 +1,192 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming of word crops from the dataset converters (tools/*_converter.py) to image files and/or an LMDB.
+
+The converters crop the words of each source image in worker processes. Each worker returns the encoded crops of
+its image, which the parent writes to the LMDB in task order, as they arrive. Writing image files plus a gt file for
+`create_lmdb_dataset.py` is optional; when enabled, the workers write the image files themselves.
+
+Crops are cut from a `SceneImage`. By default, the source image is decoded and each crop is re-encoded with the
+quantization tables of the source. With ``lossless=True`` and the optional PyTurboJPEG package (plus libturbojpeg),
+axis-aligned crops of JPEG sources are instead cut in the DCT domain: the crop origin is moved to the enclosing
+iMCU boundary (8 or 16 px), the coefficients of that region are copied without decoding, and only the few rows and
+columns in front of the requested box are trimmed by decoding and re-encoding the (small) crop. The source image is
+only decoded if some crop needs its pixels.
+"""
+
+import io
+import os
+import warnings
+from contextlib import nullcontext
+from multiprocessing import Pool
+from typing import Callable, Iterable, Optional
+
+from PIL import Image
+from tqdm import tqdm
+
+from strhub.data.image_header import check_image
+from strhub.data.lmdb_utils import LmdbWriter
+
+try:
+    from turbojpeg import TurboJPEG, tjMCUHeight, tjMCUWidth
+except ImportError:
+    TurboJPEG = None
+
+# (image path relative to the gt file, encoded image, label)
+Crop = tuple[str, bytes, str]
+
+
+def encode_crop(img: Image.Image, qtables=None) -> Optional[bytes]:
+    """Encode a crop as JPEG, with the quantization tables of the source image if given. None if the crop is empty."""
+    if img.width == 0 or img.height == 0:
+        return None
+    buf = io.BytesIO()
+    if qtables:
+        img.save(buf, 'JPEG', qtables=qtables)
+    else:
+        img.save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+_turbojpeg = None
+
+
+def _get_turbojpeg():
+    """The TurboJPEG instance of this process, or None if PyTurboJPEG or libturbojpeg is not available."""
+    global _turbojpeg
+    if _turbojpeg is None and TurboJPEG is not None:
+        try:
+            _turbojpeg = TurboJPEG()
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f'libturbojpeg could not be loaded ({e}), falling back to decoding the source images')
+            _turbojpeg = False
+    return _turbojpeg or None
+
+
+class SceneImage:
+    """A source image from which word crops are cut.
+
+    Args:
+        path: Path to the image
+        lossless: Cut axis-aligned crops of JPEG images in the DCT domain if PyTurboJPEG is available
+        max_slack: Keep up to this many extra pixels on the left and top of a lossless crop (due to iMCU alignment)
+            instead of trimming them. A crop is encoded losslessly (no decode at all) if it needs no trimming.
+    """
+
+    def __init__(self, path: str, lossless: bool = False, max_slack: int = 0):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.max_slack = max_slack
+        self._image = None
+        self._mcu = None
+        jpeg = _get_turbojpeg() if lossless else None
+        if jpeg is not None:
+            try:
+                width, height, subsample, _ = jpeg.decode_header(self.data)
+            except OSError:  # not a JPEG
+                pass
+            else:
+                self.size = width, height
+                self._mcu = tjMCUWidth[subsample], tjMCUHeight[subsample]
+        if self._mcu is None:
+            self.size = self.image.size
+
+    @property
+    def image(self) -> Image.Image:
+        """The decoded image. Only decoded on first access."""
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+        return self._image
+
+    def crop(self, box: tuple[float, float, float, float]) -> Optional[bytes]:
+        """Cut the (left, upper, right, lower) box out of the image as a JPEG. None if the crop is empty.
+
+        Same as ``encode_crop(image.crop(box), image.quantization)``, except for lossless crops. Boxes extending
+        past the image are padded with black, and thus always take the decoding path.
+        """
+        x1, y1, x2, y2 = (int(round(v)) for v in box)
+        width, height = self.size
+        if self._mcu is None or not (0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height):
+            return encode_crop(self.image.crop((x1, y1, x2, y2)), getattr(self.image, 'quantization', None))
+        mcu_w, mcu_h = self._mcu
+        dx, dy = x1 % mcu_w, y1 % mcu_h
+        # The end of the region need not be aligned.
+        image_bin = _get_turbojpeg().crop(self.data, x1 - dx, y1 - dy, x2 - x1 + dx, y2 - y1 + dy, copynone=True)
+        if dx <= self.max_slack and dy <= self.max_slack:
+            return image_bin
+        crop = Image.open(io.BytesIO(image_bin))
+        return encode_crop(crop.crop((dx, dy, crop.width, crop.height)), crop.quantization)
+
+    def close(self) -> None:
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+
+def save_crop(image_bin: bytes, dst_image_root: Optional[str], dst_img_name: str) -> str:
+    """Write the crop to an image file unless `dst_image_root` is None. Returns its path relative to the gt file."""
+    if dst_image_root is not None:
+        with open(os.path.join(dst_image_root, dst_img_name), 'wb') as f:
+            f.write(image_bin)
+        return f'{os.path.basename(dst_image_root)}/{dst_img_name}'
+    return dst_img_name
+
+
+def split_lmdb(lmdb_root: Optional[str], split: str) -> Optional[str]:
+    return os.path.join(lmdb_root, split) if lmdb_root else None
+
+
+def stream_crops(
+    process_img: Callable[..., list[Crop]],
+    tasks: Iterable,
+    nproc: int = 1,
+    lmdb_path: Optional[str] = None,
+    num_tasks: Optional[int] = None,
+    chunksize: int = 8,
+    gt: bool = False,
+) -> tuple[int, list[str]]:
+    """Run `process_img` over `tasks` in `nproc` processes and write the crops to `lmdb_path` (if given).
+
+    The crops are consumed as they are produced, in task order. Like `create_lmdb_dataset.py` (with its default
+    `checkValid`), labels are stripped, and crops with an empty label or an invalid image are skipped. The LMDB
+    records the path of each crop in its ``imagepath-`` keys. Returns the number of crops kept and, if `gt` is set,
+    their gt lines (``<image path> <label>``); otherwise, nothing is accumulated and memory does not grow with the
+    dataset.
+    """
+    num_crops, num_skipped = 0, 0
+    gt_lines = []
+    with Pool(nproc) as pool, LmdbWriter(lmdb_path) if lmdb_path else nullcontext() as writer:
+        for crops in tqdm(pool.imap(process_img, tasks, chunksize), total=num_tasks):
+            for path, image_bin, label in crops:
+                label = label.strip()
+                try:
+                    size = check_image(image_bin)
+                except IOError:
+                    size = (0, 0)
+                if not label or size[0] * size[1] == 0:
+                    num_skipped += 1
+                    continue
+                if writer is not None:
+                    index = writer.write(image_bin, label, path=path, size=size)
+                    writer.put(f'imagepath-{index:09d}'.encode(), path.encode())
+                if gt:
+                    gt_lines.append(f'{path} {label}')
+                num_crops += 1
+    if num_skipped:
+        print(f'Skipped {num_skipped} crops with an empty label or an invalid image')
+    if lmdb_path:
+        print(f'Wrote {num_crops} crops to {lmdb_path}')
+    return num_crops, gt_lines
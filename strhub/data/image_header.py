@@ -0,0 +1,89 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read image dimensions from JPEG and PNG headers without decoding the pixel data."""
+
+import io
+from typing import Optional
+
+from PIL import Image
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_PNG_TRAILER = b'IEND\xaeB`\x82'
+# Start-of-frame markers which carry the image dimensions. DHT (C4), JPG (C8) and DAC (CC) are excluded.
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers which are not followed by a length field.
+_JPEG_STANDALONE = frozenset(range(0xD0, 0xD9)) | {0x01}
+
+
+def _jpeg_size(buf: memoryview) -> Optional[tuple[int, int]]:
+    pos = 2
+    end = len(buf)
+    while pos + 4 <= end:
+        if buf[pos] != 0xFF:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in _JPEG_STANDALONE:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):  # EOI or SOS reached before any SOF
+            return None
+        if marker in _JPEG_SOF:
+            if pos + 9 > end:
+                return None
+            h = (buf[pos + 5] << 8) | buf[pos + 6]
+            w = (buf[pos + 7] << 8) | buf[pos + 8]
+            return w, h
+        pos += 2 + ((buf[pos + 2] << 8) | buf[pos + 3])
+    return None
+
+
+def get_image_size(buf) -> Optional[tuple[int, int]]:
+    """Return (width, height) parsed from the JPEG SOF or PNG IHDR header, or None for other/malformed data."""
+    buf = memoryview(buf)
+    if len(buf) >= 24 and buf[:8] == _PNG_SIGNATURE and buf[12:16] == b'IHDR':
+        w = int.from_bytes(buf[16:20], 'big')
+        h = int.from_bytes(buf[20:24], 'big')
+        return w, h
+    if len(buf) >= 4 and buf[0] == 0xFF and buf[1] == 0xD8:
+        return _jpeg_size(buf)
+    return None
+
+
+def has_trailer(buf) -> bool:
+    """Check for the end-of-image marker (JPEG EOI or PNG IEND), i.e. a cheap test for truncated files."""
+    buf = memoryview(buf)
+    if buf[:8] == _PNG_SIGNATURE:
+        return buf[-8:] == _PNG_TRAILER
+    return buf[-2:] == b'\xff\xd9'
+
+
+def check_image(buf, full_decode: bool = False) -> tuple[int, int]:
+    """Validate an encoded image and return its (width, height).
+
+    Complete JPEG and PNG files are validated from their headers alone. Anything else (other formats, missing
+    trailers, unusual headers) falls back to a full decode with PIL, same as when `full_decode` is set.
+
+    Raises:
+        IOError: if PIL fails to decode the image.
+    """
+    if not full_decode:
+        size = get_image_size(buf)
+        if size is not None and has_trailer(buf):
+            return size
+    return Image.open(io.BytesIO(buf)).convert('RGB').size
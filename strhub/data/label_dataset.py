@@ -0,0 +1,134 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+
+from PIL import Image
+
+from torch.utils.data import Dataset
+
+from strhub.data.image_header import get_image_size
+from strhub.data.lmdb_utils import get_image, open_readonly, read_num_samples
+from strhub.data.metadata import SampleMetadata, preprocess_label
+
+
+def find_lmdbs(root: str) -> list[str]:
+    """The LMDB at `root`, or all LMDBs below it (in sorted order)."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames.sort()
+        if 'data.mdb' in filenames:
+            paths.append(dirpath)
+    return paths
+
+
+def read_labels(lmdb_path: str) -> list[str]:
+    """Raw labels of all samples of the LMDB, in index order. Walks the ``label-`` keys only.
+
+    Raises ValueError if a sample has no label: the labels would no longer line up with the sample indices.
+    """
+    with open_readonly(lmdb_path) as env, env.begin() as txn:
+        num_samples = read_num_samples(env)
+        cursor = txn.cursor()
+        labels = []
+        if num_samples and cursor.set_range(b'label-'):
+            for key, label in cursor:
+                # Stops at the end of the label- keys (e.g. at num-samples), or at the first missing label
+                if len(labels) == num_samples or key != f'label-{len(labels) + 1:09d}'.encode():
+                    break
+                labels.append(label.decode())
+    if len(labels) != num_samples:
+        raise ValueError(f'{lmdb_path}: sample {len(labels) + 1} of {num_samples} has no label')
+    return labels
+
+
+def _image_sizes(lmdb_path: str, indices: list[int]) -> list[tuple[int, int]]:
+    sizes = []
+    # Zero-copy reads: only the pages holding the image headers are touched.
+    with open_readonly(lmdb_path) as env, env.begin(buffers=True) as txn:
+        for index in indices:
+            image_bin = get_image(txn, index)
+            size = get_image_size(image_bin) if image_bin is not None else (0, 0)
+            if size is None:
+                # Other formats: PIL only parses the header here
+                try:
+                    size = Image.open(io.BytesIO(image_bin)).size
+                except IOError:
+                    size = (0, 0)
+            sizes.append(size)
+    return sizes
+
+
+class LabelDataset(Dataset):
+    """The labels of LMDB datasets, without their images: for LM evaluation, charset statistics, label auditing.
+
+    `root` is an LMDB, or a directory of LMDBs which are concatenated (e.g. ``<data_root>/test/<name>``). Labels are
+    preprocessed and filtered exactly like `LmdbDataset`, so the samples are the same as those of the image dataset,
+    in the same order. Only the ``label-`` keys are read, or the labels in the metadata sidecar when it has the same
+    normalization. For `min_image_dim`, the image sizes come from the sidecar, else from the image headers alone.
+
+    Items are labels, so the batches of a default `DataLoader` are lists of labels. Nothing is decoded, so
+    ``num_workers=0`` is fastest.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        charset: str,
+        max_label_len: int,
+        min_image_dim: int = 0,
+        remove_whitespace: bool = True,
+        normalize_unicode: bool = True,
+    ):
+        from strhub.data.utils import CharsetAdapter
+
+        self.charset_adapter = CharsetAdapter(charset)
+        self.labels = []
+        for lmdb_path in find_lmdbs(root):
+            self.labels += self._preprocess_labels(
+                lmdb_path, remove_whitespace, normalize_unicode, max_label_len, min_image_dim
+            )
+
+    def _preprocess_labels(self, lmdb_path, remove_whitespace, normalize_unicode, max_label_len, min_image_dim):
+        meta = SampleMetadata(lmdb_path) if SampleMetadata.exists(lmdb_path) else None
+        if meta is not None and remove_whitespace and normalize_unicode:
+            # The sidecar labels are normalized the same way
+            raw_labels = [meta.label(index) for index in range(1, len(meta) + 1)]
+            remove_whitespace = normalize_unicode = False
+        else:
+            raw_labels = read_labels(lmdb_path)
+        labels, indices = [], []
+        for index, label in enumerate(raw_labels, 1):
+            label = preprocess_label(label, self.charset_adapter, max_label_len, remove_whitespace, normalize_unicode)
+            if not label:
+                continue
+            labels.append(label)
+            indices.append(index)
+        if min_image_dim > 0:
+            # Filter images that are too small.
+            if meta is not None:
+                rows = [index - 1 for index in indices]
+                sizes = zip(meta.width[rows].tolist(), meta.height[rows].tolist())
+            else:
+                sizes = _image_sizes(lmdb_path, indices)
+            labels = [label for label, size in zip(labels, sizes) if min(size) >= min_image_dim]
+        return labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return self.labels[index]
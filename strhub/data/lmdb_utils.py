@@ -0,0 +1,338 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for reading and writing LMDB datasets in the standard ``image-%09d``/``label-%09d`` layout.
+
+In the deduplicated layout, the bytes of each distinct image are stored once under ``blob-<content hash>``, and each
+sample has an ``imageref-%09d`` key holding the hash instead of an ``image-%09d`` key. Read images with `get_image()`
+or `iter_images()`, which handle both layouts (and LMDBs mixing them).
+
+For integrity checks without decoding any image, each sample has a ``crc-%09d`` key holding the CRC-32 of its image
+and of its label (two ``<u4``). The ``manifest`` key records the number of samples, the `build-id`, and the CRC-32 of
+all ``crc-`` values in index order. See tools/verify_lmdb.py.
+
+Pseudo-labeled datasets (see tools/pseudo_label.py) have a ``confidence-%09d`` key with the confidence of the model
+in each label, as ASCII text.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import uuid
+import warnings
+import zlib
+from typing import Any, Iterator, Optional, Union
+
+import lmdb
+
+from strhub.data.metadata import METADATA_DIR, MetadataWriter
+
+NUM_SAMPLES_KEY = b'num-samples'
+# Build checkpoint. A JSON object mapping each input source to the caller-defined progress made on it.
+PROGRESS_KEY = b'build-progress'
+# Random id written on every commit. Caches derived from the content of an LMDB are valid as long as it is unchanged.
+BUILD_ID_KEY = b'build-id'
+
+BLOB_PREFIX = b'blob-'
+IMAGE_REF_PREFIX = b'imageref-'
+CHECKSUM_PREFIX = b'crc-'
+CONFIDENCE_PREFIX = b'confidence-'
+MANIFEST_KEY = b'manifest'
+
+_MIN_MAP_SIZE = 64 * 1024**2
+
+
+def image_key(index: int) -> bytes:
+    return f'image-{index:09d}'.encode()
+
+
+def label_key(index: int) -> bytes:
+    return f'label-{index:09d}'.encode()
+
+
+def image_ref_key(index: int) -> bytes:
+    return b'%s%09d' % (IMAGE_REF_PREFIX, index)
+
+
+def confidence_key(index: int) -> bytes:
+    return b'%s%09d' % (CONFIDENCE_PREFIX, index)
+
+
+def checksum_key(index: int) -> bytes:
+    return b'%s%09d' % (CHECKSUM_PREFIX, index)
+
+
+def record_checksum(image_bin: bytes, label: bytes) -> bytes:
+    """Value of the ``crc-`` key of a sample: CRC-32 of the image and of the (UTF-8) label."""
+    return struct.pack('<II', zlib.crc32(image_bin), zlib.crc32(label))
+
+
+def make_manifest(num_samples: int, build_id: Optional[str], checksum: int) -> bytes:
+    """`checksum` is the CRC-32 of the ``crc-`` values of all samples, concatenated in index order."""
+    info = {'version': 1, 'num_samples': num_samples, 'build_id': build_id, 'checksum': checksum}
+    return json.dumps(info).encode()
+
+
+def content_ref(image_bin: bytes) -> bytes:
+    """Reference of an image in the deduplicated layout: the hex BLAKE2b-128 digest of its bytes."""
+    return hashlib.blake2b(image_bin, digest_size=16).hexdigest().encode()
+
+
+def get_image(txn: lmdb.Transaction, index: int) -> Optional[bytes]:
+    """Encoded image of the sample with the given (1-based) index, in either layout. None if it has none."""
+    image_bin = txn.get(image_key(index))
+    if image_bin is None:
+        ref = txn.get(image_ref_key(index))
+        if ref is not None:
+            image_bin = txn.get(BLOB_PREFIX + bytes(ref))
+    return image_bin
+
+
+def iter_images(txn: lmdb.Transaction, start: int = 1, end: Optional[int] = None) -> Iterator[tuple[int, bytes]]:
+    """Yield (index, encoded image) of the samples in the index range, in order, walking the keys with cursors.
+
+    Samples without an image are skipped.
+    """
+    streams = []
+    for prefix in (b'image-', IMAGE_REF_PREFIX):
+        cursor = txn.cursor()
+        if cursor.set_range(b'%s%09d' % (prefix, start)):
+            streams.append((prefix, cursor))
+    heads = {}
+    for prefix, cursor in streams:
+        key = bytes(cursor.key())
+        if key.startswith(prefix):
+            heads[prefix] = (int(key[len(prefix) :]), cursor)
+    while heads:
+        prefix = min(heads, key=lambda p: heads[p][0])
+        index, cursor = heads[prefix]
+        if end is not None and index > end:
+            return
+        value = cursor.value()
+        yield index, value if prefix == b'image-' else txn.get(BLOB_PREFIX + bytes(value))
+        key = bytes(cursor.key()) if cursor.next() else b''
+        if key.startswith(prefix):
+            heads[prefix] = (int(key[len(prefix) :]), cursor)
+        else:
+            del heads[prefix]
+
+
+def open_readonly(path: str, **kwargs) -> lmdb.Environment:
+    """Open an existing LMDB for lock-free, read-only access."""
+    kwargs = {'readonly': True, 'lock': False, 'readahead': False, 'meminit': False, **kwargs}
+    return lmdb.open(path, create=False, **kwargs)
+
+
+def read_num_samples(env: lmdb.Environment) -> int:
+    with env.begin() as txn:
+        num_samples = txn.get(NUM_SAMPLES_KEY)
+    return 0 if num_samples is None else int(num_samples)
+
+
+def read_progress(env: lmdb.Environment) -> dict[str, Any]:
+    with env.begin() as txn:
+        progress = txn.get(PROGRESS_KEY)
+    return {} if progress is None else json.loads(progress)
+
+
+def read_build_id(env: lmdb.Environment) -> Optional[str]:
+    with env.begin() as txn:
+        build_id = txn.get(BUILD_ID_KEY)
+    return None if build_id is None else build_id.decode()
+
+
+def read_manifest(env: lmdb.Environment) -> Optional[dict[str, Any]]:
+    with env.begin() as txn:
+        manifest = txn.get(MANIFEST_KEY)
+    return None if manifest is None else json.loads(manifest)
+
+
+def used_bytes(env: lmdb.Environment) -> int:
+    """Bytes of the memory map actually in use by the database."""
+    return (env.info()['last_pgno'] + 1) * env.stat()['psize']
+
+
+class LmdbWriter:
+    """Buffered, single-writer LMDB dataset builder.
+
+    Samples are numbered sequentially starting from 1. Writes are buffered and committed in large transactions
+    with keys inserted in sorted order. The map starts small and grows with the data actually written, so no
+    upfront size estimate (or a sparse 1 TB map) is needed. `num-samples` is updated on every commit, hence an
+    interrupted build is still a valid (partial) dataset.
+
+    By default, any existing content of the LMDB is discarded. In append mode, numbering continues from the existing
+    `num-samples` instead. Callers can record how far they got in each input source with `set_progress()`; the
+    checkpoint is committed atomically with the samples, so `get_progress()` tells exactly where to resume. A commit
+    only ever happens between samples (at the start of `write()`, or on `commit()`/`close()`): whatever is `put()`
+    or recorded after a `write()` is committed together with that sample. Closing a writer which wrote nothing does
+    not commit, so the `build-id` of an unchanged LMDB stays the same.
+
+    Unless disabled, the per-sample metadata sidecar (see `strhub.data.metadata`) is written alongside. Otherwise (or
+    if an LMDB appended to has no complete sidecar), any existing sidecar is deleted, since it would be stale.
+
+    Unless disabled, the checksum of every sample and the manifest are written too. Appending to an LMDB without a
+    (matching) manifest disables them.
+
+    With `dedup`, images are written in the deduplicated layout: the bytes of an image already in the LMDB are not
+    stored again. `num_duplicates` and `duplicate_bytes` count what was saved.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        commit_interval: int = 10000,
+        commit_bytes: int = 256 * 1024**2,
+        map_size: int = _MIN_MAP_SIZE,
+        append: bool = False,
+        metadata: bool = True,
+        dedup: bool = False,
+        checksums: bool = True,
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+        self.env = lmdb.open(path, map_size=max(map_size, _MIN_MAP_SIZE), meminit=False)
+        if append:
+            self.num_samples = read_num_samples(self.env)
+            self._progress = read_progress(self.env)
+        else:
+            with self.env.begin(write=True) as txn:
+                txn.drop(self.env.open_db(), delete=False)
+            self.num_samples = 0
+            self._progress = {}
+        self.metadata = MetadataWriter.resume(path, self.num_samples, read_build_id(self.env)) if metadata else None
+        if self.metadata is None:
+            shutil.rmtree(os.path.join(path, METADATA_DIR), ignore_errors=True)
+        self.checksums = checksums
+        self._checksum = 0
+        if checksums and self.num_samples:
+            manifest = read_manifest(self.env)
+            if manifest is not None and manifest['num_samples'] == self.num_samples:
+                self._checksum = manifest['checksum']
+            else:
+                warnings.warn(f'{path} has no checksums for its existing samples; not writing any')
+                self.checksums = False
+        self.dedup = dedup
+        self.num_duplicates = 0
+        self.duplicate_bytes = 0
+        self._cache = {}
+        self._cache_bytes = 0
+        self._cache_samples = 0
+        # A new LMDB must be committed at least once, even if empty
+        self._dirty = not append
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def put(self, key: bytes, value: bytes) -> None:
+        """Buffer an arbitrary key-value pair. It is written together with the next commit."""
+        self._cache[key] = value
+        self._cache_bytes += len(key) + len(value)
+        self._dirty = True
+
+    def get_progress(self, source: str) -> Optional[Any]:
+        return self._progress.get(source)
+
+    def set_progress(self, source: str, progress: Any) -> None:
+        """Record the progress made on `source`. It must describe exactly the samples written so far."""
+        self._progress[source] = progress
+        self._dirty = True
+
+    def write(
+        self,
+        image_bin: bytes,
+        label: Union[str, bytes],
+        path: Optional[str] = None,
+        size: Optional[tuple[int, int]] = None,
+    ) -> int:
+        """Append one sample and return its (1-based) index.
+
+        `path` (the source of the image) and `size` (width, height) only go into the metadata sidecar. The size is
+        read from the image header if not given.
+        """
+        # Commit before adding the sample, never after: the caller has yet to record its progress and extra keys.
+        if self._cache_samples >= self.commit_interval or self._cache_bytes >= self.commit_bytes:
+            self.commit()
+        self.num_samples += 1
+        index = self.num_samples
+        if self.metadata is not None:
+            self.metadata.add(image_bin, label.decode() if isinstance(label, bytes) else label, path, size)
+        if isinstance(label, str):
+            label = label.encode()
+        if self.checksums:
+            checksum = record_checksum(image_bin, label)
+            self.put(checksum_key(index), checksum)
+            self._checksum = zlib.crc32(checksum, self._checksum)
+        if self.dedup:
+            ref = content_ref(image_bin)
+            self.put(image_ref_key(index), ref)
+            if self._has(BLOB_PREFIX + ref):
+                self.num_duplicates += 1
+                self.duplicate_bytes += len(image_bin)
+            else:
+                self.put(BLOB_PREFIX + ref, image_bin)
+        else:
+            self.put(image_key(index), image_bin)
+        self.put(label_key(index), label)
+        self._cache_samples += 1
+        return index
+
+    def _has(self, key: bytes) -> bool:
+        if key in self._cache:
+            return True
+        with self.env.begin() as txn:
+            return txn.get(key) is not None
+
+    def _reserve(self, nbytes: int) -> None:
+        # B-tree pages are not completely full, so leave ample headroom for the pending batch.
+        required = used_bytes(self.env) + 2 * nbytes + _MIN_MAP_SIZE
+        map_size = self.env.info()['map_size']
+        if required > map_size:
+            self.env.set_mapsize(max(required, int(map_size * 1.5)))
+
+    def commit(self) -> None:
+        if not self._dirty:
+            return
+        self.put(NUM_SAMPLES_KEY, str(self.num_samples).encode())
+        build_id = uuid.uuid4().hex
+        self.put(BUILD_ID_KEY, build_id.encode())
+        if self.checksums:
+            self.put(MANIFEST_KEY, make_manifest(self.num_samples, build_id, self._checksum))
+        if self._progress:
+            self.put(PROGRESS_KEY, json.dumps(self._progress).encode())
+        self._reserve(self._cache_bytes)
+        if self.metadata is not None:
+            self.metadata.flush()
+        with self.env.begin(write=True) as txn:
+            txn.cursor().putmulti(sorted(self._cache.items()))
+        if self.metadata is not None:
+            self.metadata.commit(self.num_samples, build_id)
+        self._cache = {}
+        self._cache_bytes = 0
+        self._cache_samples = 0
+        self._dirty = False
+
+    def close(self) -> None:
+        if self.env is None:
+            return
+        self.commit()
+        self.env.close()
+        self.env = None
@@ -0,0 +1,334 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Columnar per-sample metadata stored next to an LMDB dataset.
+
+The sidecar lives in ``<lmdb>/metadata/``. Every column is a raw little-endian array (one row per sample, row ``i``
+describes sample ``i + 1``) which is memory-mapped on load. Labels and source paths are stored as concatenated
+UTF-8 blobs addressed by end offsets. ``meta.json`` holds the number of committed rows; rows past it are leftovers
+of an interrupted build and are ignored. It also records the `build-id` of the LMDB the rows were committed with: a
+sidecar whose `build-id` or number of rows does not match the LMDB is stale and is not used.
+"""
+
+import io
+import json
+import os
+import re
+import string
+import unicodedata
+import warnings
+from contextlib import nullcontext
+from typing import Any, Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+from strhub.data.image_header import get_image_size
+
+METADATA_DIR = 'metadata'
+
+COLUMNS = {
+    'width': '<u4',
+    'height': '<u4',
+    'label_length': '<u2',  # length of the normalized label
+    'label_end': '<u8',  # end offset of the normalized label in labels.bin
+    'charsets': 'u1',  # bitmask, see CHARSETS
+    'num_bytes': '<u4',  # size of the encoded image
+    'scene_id': '<i8',  # -1 if the source path does not follow a known naming scheme
+    'path_end': '<u8',  # end offset of the source path in paths.bin
+}
+BLOBS = {'label_end': 'labels.bin', 'path_end': 'paths.bin'}
+
+# Bit i of the `charsets` column is set if the normalized label only has characters from the i-th charset (after
+# lowercasing, for the case-insensitive charset). Same as configs/charset/.
+CHARSETS = {
+    '36_lowercase': string.digits + string.ascii_lowercase,
+    '62_mixed-case': string.digits + string.ascii_lowercase + string.ascii_uppercase,
+    '94_full': string.digits + string.ascii_lowercase + string.ascii_uppercase + string.punctuation,
+}
+_CHARSET_SETS = [frozenset(c) for c in CHARSETS.values()]
+
+# Crops named after their scene, e.g. gt_123_4.jpg (ArT) or img123_4.jpg (Total-Text)
+SCENE_PATTERN = re.compile(r'(?:gt_|img)(\d+)_\d+\.(?:jpe?g|png)', re.IGNORECASE)
+
+
+def normalize_label(label: str) -> str:
+    """Whitespace removal and Unicode normalization, as done by default when loading LMDB datasets."""
+    label = ''.join(label.split())
+    return unicodedata.normalize('NFKD', label).encode('ascii', 'ignore').decode()
+
+
+def preprocess_label(
+    label: str,
+    charset_adapter: Callable[[str], str],
+    max_label_len: int,
+    remove_whitespace: bool = True,
+    normalize_unicode: bool = True,
+) -> str:
+    """Label preprocessing shared by the datasets. Returns the label to train on, or '' to filter the sample out."""
+    # Normally, whitespace is removed from the labels.
+    if remove_whitespace:
+        label = ''.join(label.split())
+    # Normalize unicode composites (if any) and convert to compatible ASCII characters
+    if normalize_unicode:
+        label = unicodedata.normalize('NFKD', label).encode('ascii', 'ignore').decode()
+    # Filter by length before removing unsupported characters. The original label might be too long.
+    if len(label) > max_label_len:
+        return ''
+    # Samples without any supported characters are filtered out too
+    return charset_adapter(label)
+
+
+def charset_mask(label: str) -> int:
+    mask = 0
+    chars = set(label)
+    if set(label.lower()).issubset(_CHARSET_SETS[0]):
+        mask |= 1
+    for bit, charset in enumerate(_CHARSET_SETS[1:], 1):
+        if chars.issubset(charset):
+            mask |= 1 << bit
+    return mask
+
+
+def parse_scene_id(path: Optional[str]) -> int:
+    m = SCENE_PATTERN.search(path) if path else None
+    return int(m.group(1)) if m else -1
+
+
+def _column_path(root: str, name: str) -> str:
+    return os.path.join(root, name + '.bin')
+
+
+def _write_info(root: str, num_samples: int, build_id: Optional[str]) -> None:
+    info = {'version': 1, 'num_samples': num_samples, 'build_id': build_id, 'charsets': list(CHARSETS)}
+    tmp = os.path.join(root, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, os.path.join(root, 'meta.json'))
+
+
+class MetadataWriter:
+    """Appends rows to the sidecar of an LMDB. Use through `LmdbWriter`, which keeps both in sync.
+
+    `num_samples` and `build_id` describe the LMDB as it is when the writer is created.
+    """
+
+    def __init__(self, lmdb_path: str, num_samples: int = 0, build_id: Optional[str] = None):
+        self.root = os.path.join(lmdb_path, METADATA_DIR)
+        os.makedirs(self.root, exist_ok=True)
+        ends = {name: 0 for name in BLOBS}
+        for name, dtype in COLUMNS.items():
+            itemsize = np.dtype(dtype).itemsize
+            path = _column_path(self.root, name)
+            if not num_samples:
+                open(path, 'wb').close()
+                continue
+            if os.path.getsize(path) < num_samples * itemsize:
+                raise ValueError(f'{self.root} has fewer than {num_samples} rows')
+            os.truncate(path, num_samples * itemsize)
+            if name in BLOBS:
+                ends[name] = int(np.fromfile(path, dtype, count=1, offset=(num_samples - 1) * itemsize)[0])
+        for name, filename in BLOBS.items():
+            with open(os.path.join(self.root, filename), 'ab') as f:
+                f.truncate(ends[name])
+        self._ends = ends
+        self._rows = {name: [] for name in COLUMNS}
+        self._blobs = {name: bytearray() for name in BLOBS}
+        _write_info(self.root, num_samples, build_id)
+
+    @classmethod
+    def resume(cls, lmdb_path: str, num_samples: int, build_id: Optional[str] = None) -> Optional['MetadataWriter']:
+        """Continue the sidecar of an existing LMDB. Returns None if the LMDB was built without (a complete) one."""
+        try:
+            return cls(lmdb_path, num_samples, build_id)
+        except (OSError, ValueError):
+            if num_samples:
+                warnings.warn(f'{lmdb_path} has no complete metadata sidecar; not writing one for the new samples')
+                return None
+            raise
+
+    def add(self, image_bin: bytes, label: str, path: Optional[str] = None, size: Optional[tuple] = None) -> None:
+        if size is None:
+            size = get_image_size(image_bin)
+        if size is None:
+            try:
+                size = Image.open(io.BytesIO(image_bin)).size
+            except IOError:
+                size = (0, 0)
+        label = normalize_label(label)
+        label_bin = label.encode()
+        path_bin = path.encode() if path else b''
+        self._ends['label_end'] += len(label_bin)
+        self._ends['path_end'] += len(path_bin)
+        self._blobs['label_end'] += label_bin
+        self._blobs['path_end'] += path_bin
+        row = self._rows
+        row['width'].append(size[0])
+        row['height'].append(size[1])
+        row['label_length'].append(min(len(label), 0xFFFF))
+        row['label_end'].append(self._ends['label_end'])
+        row['charsets'].append(charset_mask(label))
+        row['num_bytes'].append(len(image_bin))
+        row['scene_id'].append(parse_scene_id(path))
+        row['path_end'].append(self._ends['path_end'])
+
+    def flush(self) -> None:
+        """Write buffered rows. Call before committing the corresponding samples to the LMDB."""
+        for name, dtype in COLUMNS.items():
+            with open(_column_path(self.root, name), 'ab') as f:
+                np.asarray(self._rows[name], dtype=dtype).tofile(f)
+            self._rows[name] = []
+        for name, filename in BLOBS.items():
+            with open(os.path.join(self.root, filename), 'ab') as f:
+                f.write(self._blobs[name])
+            self._blobs[name] = bytearray()
+
+    def commit(self, num_samples: int, build_id: Optional[str] = None) -> None:
+        """Mark the first `num_samples` rows as valid for the `build_id` of the LMDB. Call after the LMDB commit."""
+        _write_info(self.root, num_samples, build_id)
+
+
+def _is_current(info: dict[str, Any], lmdb_path: str, env=None) -> bool:
+    """Whether the sidecar info matches the LMDB (`env`, if already open)."""
+    from strhub.data.lmdb_utils import open_readonly, read_build_id, read_num_samples
+
+    with nullcontext(env) if env is not None else open_readonly(lmdb_path) as env:
+        num_samples, build_id = read_num_samples(env), read_build_id(env)
+    # Sidecars written before the build-id was recorded can only be checked by their size
+    return info['num_samples'] == num_samples and info.get('build_id', build_id) == build_id
+
+
+class SampleMetadata:
+    """Memory-mapped, read-only view of the metadata sidecar of an LMDB dataset.
+
+    Columns are exposed as numpy arrays named after `COLUMNS`, indexed by ``sample index - 1``. Raises ValueError if
+    the sidecar is stale (see `exists()`). Pass the environment of the LMDB if it is already open in this process.
+    """
+
+    def __init__(self, lmdb_path: str, env=None):
+        self.root = os.path.join(lmdb_path, METADATA_DIR)
+        with open(os.path.join(self.root, 'meta.json')) as f:
+            info = json.load(f)
+        if not _is_current(info, lmdb_path, env):
+            raise ValueError(f'The metadata sidecar of {lmdb_path} does not match the LMDB')
+        self.num_samples = info['num_samples']
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, self._load(name + '.bin', dtype))
+        self._labels = self._load('labels.bin', 'u1', -1)
+        self._paths = self._load('paths.bin', 'u1', -1)
+
+    def _load(self, filename: str, dtype: str, shape: int = None) -> np.ndarray:
+        path = os.path.join(self.root, filename)
+        shape = self.num_samples if shape is None else shape
+        if shape == 0 or os.path.getsize(path) == 0:
+            return np.empty(0, dtype)
+        array = np.memmap(path, dtype, mode='r')
+        return array if shape < 0 else array[:shape]
+
+    @staticmethod
+    def exists(lmdb_path: str, env=None) -> bool:
+        """Whether the LMDB has a sidecar which matches its current content. Warns about a stale one."""
+        try:
+            with open(os.path.join(lmdb_path, METADATA_DIR, 'meta.json')) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not _is_current(info, lmdb_path, env):
+            warnings.warn(f'The metadata sidecar of {lmdb_path} does not match the LMDB; ignoring it')
+            return False
+        return True
+
+    def __len__(self):
+        return self.num_samples
+
+    @staticmethod
+    def _blob_item(blob: np.ndarray, ends: np.ndarray, index: int) -> str:
+        start = ends[index - 2] if index > 1 else 0
+        return blob[start : ends[index - 1]].tobytes().decode()
+
+    def label(self, index: int) -> str:
+        """Normalized label of the sample with the given (1-based) index."""
+        return self._blob_item(self._labels, self.label_end, index)
+
+    def path(self, index: int) -> str:
+        """Source path of the sample with the given (1-based) index, or '' if unknown."""
+        return self._blob_item(self._paths, self.path_end, index)
+
+    def charset_bit(self, charset: str) -> Optional[int]:
+        for bit, chars in enumerate(_CHARSET_SETS):
+            if set(charset) == chars:
+                return 1 << bit
+        return None
+
+    def select(self, charset: str, max_label_len: int, min_image_dim: int = 0) -> np.ndarray:
+        """Return the (1-based) indices of the samples kept by the label preprocessing of the LMDB dataset.
+
+        Same rules as loading the LMDB with whitespace removal and Unicode normalization enabled: labels longer than
+        `max_label_len` are dropped, as are labels left without any character supported by `charset` and images
+        smaller than `min_image_dim`. Only labels which are not fully covered by a known charset are inspected.
+        """
+        from strhub.data.utils import CharsetAdapter
+
+        keep = self.label_length <= max_label_len
+        if min_image_dim > 0:
+            keep &= (self.width >= min_image_dim) & (self.height >= min_image_dim)
+        bit = self.charset_bit(charset)
+        covered = np.zeros_like(keep) if bit is None else (self.charsets & bit) != 0
+        keep &= ~covered | (self.label_length > 0)
+        charset_adapter = CharsetAdapter(charset)
+        for i in np.flatnonzero(keep & ~covered):
+            # The sidecar labels are already normalized
+            if not preprocess_label(self.label(i + 1), charset_adapter, max_label_len, False, False):
+                keep[i] = False
+        return np.flatnonzero(keep) + 1
+
+
+def _gather_blob(blobs: list[np.ndarray], ends: list[np.ndarray], sources: np.ndarray, rows: np.ndarray):
+    """Concatenate the blob items of the given (source, row) pairs. Returns the new blob and end offsets."""
+    starts = [np.concatenate([[0], e[:-1]]).astype(np.int64) for e in ends]
+    # Offset of each source blob in the concatenation of all of them
+    base = np.cumsum([0] + [len(b) for b in blobs[:-1]], dtype=np.int64)
+    item_starts = np.empty(len(rows), np.int64)
+    item_lengths = np.empty(len(rows), np.int64)
+    for s in range(len(blobs)):
+        mask = sources == s
+        item_starts[mask] = starts[s][rows[mask]] + base[s]
+        item_lengths[mask] = ends[s][rows[mask]].astype(np.int64) - starts[s][rows[mask]]
+    new_ends = np.cumsum(item_lengths)
+    shift = np.repeat(item_starts - (new_ends - item_lengths), item_lengths)
+    return np.concatenate(blobs)[np.arange(len(shift)) + shift], new_ends
+
+
+def merge_metadata(
+    lmdb_paths: list[str], output_path: str, sources: np.ndarray, indices: np.ndarray, build_id: Optional[str]
+) -> None:
+    """Write the sidecar of an LMDB whose i-th sample is sample ``indices[i]`` of ``lmdb_paths[sources[i]]``.
+    `build_id` is the one of the output LMDB."""
+    metas = [SampleMetadata(path) for path in lmdb_paths]
+    rows = np.asarray(indices, np.int64) - 1
+    root = os.path.join(output_path, METADATA_DIR)
+    os.makedirs(root, exist_ok=True)
+    for name, dtype in COLUMNS.items():
+        if name in BLOBS:
+            blob, values = _gather_blob(
+                [m._load(BLOBS[name], 'u1', -1) for m in metas], [getattr(m, name) for m in metas], sources, rows
+            )
+            blob.tofile(os.path.join(root, BLOBS[name]))
+        else:
+            values = np.concatenate([getattr(m, name) for m in metas])[
+                rows + np.cumsum([0] + [len(m) for m in metas[:-1]])[sources]
+            ]
+        np.asarray(values, dtype=dtype).tofile(_column_path(root, name))
+    _write_info(root, len(rows), build_id)
@@ -0,0 +1,187 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Perceptual hashes of LMDB images and a Hamming-distance index for finding near-duplicates.
+
+Re-encoded, slightly re-cropped or resized copies of an image have different content hashes but (nearly) the same
+difference hash (dHash): the signs of the horizontal gradients of a 9x8 grayscale thumbnail, packed into 64 bits.
+"""
+
+import io
+import itertools
+import math
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from strhub.data.content_hash import hash_images
+
+HASH_BITS = 64
+_HASH_SIZE = 8  # HASH_BITS = _HASH_SIZE**2
+# Bands up to this width get a table of the start of each value in the band's sorted hashes, for O(1) lookups, unless
+# the table would be much larger than the index
+_MAX_TABLE_BITS = 22
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image_bin: bytes) -> bytes:
+    """64-bit difference hash of an encoded image, big-endian. All zeros if the image can't be decoded."""
+    try:
+        img = Image.open(io.BytesIO(image_bin))
+        # Let the JPEG decoder downscale in the DCT domain; the thumbnail is tiny anyway.
+        img.draft('L', (4 * _HASH_SIZE, 4 * _HASH_SIZE))
+        img = img.convert('L').resize((_HASH_SIZE + 1, _HASH_SIZE), Image.BOX)
+    except (IOError, ValueError):
+        return bytes(HASH_BITS // 8)
+    pixels = np.asarray(img, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes()
+
+
+def perceptual_hashes(
+    lmdb_path: str, num_workers: Optional[int] = None, chunk_size: int = 10000, refresh: bool = False
+) -> np.ndarray:
+    """Return the dHash of all images of the LMDB as uint64, cached like the content hashes."""
+    hashes = hash_images(
+        lmdb_path, 'dhash', dhash, np.dtype('>u8'), {'hash': f'dhash-{HASH_BITS}'}, num_workers, chunk_size, refresh
+    )
+    return hashes.astype(np.uint64)
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Element-wise number of differing bits of two uint64 arrays."""
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype='<u8')
+    return _POPCOUNT[xor.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.uint8)
+
+
+def _band_masks(bits: int, radius: int) -> np.ndarray:
+    """All `bits`-bit values with at most `radius` bits set, in order of their number of bits set."""
+    masks = [0]
+    for k in range(1, radius + 1):
+        masks += [sum(1 << b for b in c) for c in itertools.combinations(range(bits), k)]
+    return np.array(masks, dtype=np.uint64)
+
+
+def _num_probes(bits: int, radius: int) -> int:
+    return sum(math.comb(bits, k) for k in range(radius + 1))
+
+
+class MultiIndexHash:
+    """Index for finding all hashes within a Hamming radius of a query, using multi-index hashing.
+
+    The 64 bits are split into m bands. By the pigeonhole principle, two hashes within `radius` of each other differ
+    by at most ``radius // m`` bits in at least one band. Each band is a sorted array, in which a query looks up all
+    values within that many bits of its own band. The number of bands is chosen for the size of the index: bands of
+    about log2(N) bits hold few hashes per value, which keeps the number of candidates (and of lookups) per query
+    small. See Norouzi et al., "Fast Search in Hamming Space with Multi-Index Hashing" (CVPR 2012).
+    """
+
+    def __init__(self, hashes: np.ndarray, radius: int, num_bands: Optional[int] = None):
+        if not 0 <= radius < HASH_BITS // 2:
+            raise ValueError(f'radius must be in [0, {HASH_BITS // 2})')
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+        num_bands = num_bands or self._best_num_bands(len(self.hashes), radius)
+        self.bounds = np.linspace(0, HASH_BITS, num_bands + 1).astype(int)
+        self.band_radius = radius // num_bands
+        self.bands = []
+        for i in range(num_bands):
+            bits = self.bounds[i + 1] - self.bounds[i]
+            keys = self._band(self.hashes, i)
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            if self._has_table(i):
+                keys = np.searchsorted(keys, np.arange(2**bits + 1, dtype=np.uint64))
+            self.bands.append((keys, order, _band_masks(bits, self.band_radius)))
+
+    @staticmethod
+    def _best_num_bands(n: int, radius: int) -> int:
+        """Number of bands with the least expected work per query: lookups plus candidates (for random hashes)."""
+
+        def cost(m):
+            bits = HASH_BITS // m
+            return m * _num_probes(bits, radius // m) * (1 + n / 2**bits)
+
+        return min(range(1, HASH_BITS + 1), key=cost)
+
+    def _has_table(self, i: int) -> bool:
+        bits = self.bounds[i + 1] - self.bounds[i]
+        return bits <= _MAX_TABLE_BITS and 2**bits <= 64 * max(len(self.hashes), 1024)
+
+    def _band(self, hashes: np.ndarray, i: int) -> np.ndarray:
+        lo, hi = self.bounds[i], self.bounds[i + 1]
+        return (hashes >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+
+    def query(
+        self, queries: np.ndarray, batch_size: int = 4096, max_candidates: int = 1 << 22
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find all (query, indexed hash) pairs within the radius.
+
+        Queries are processed `batch_size` at a time, and their candidates at most `max_candidates` at a time (unless
+        a single lookup has more), which bounds the memory used.
+
+        Returns the query positions, the positions of the matching hashes in the index and their distances.
+        """
+        queries = np.asarray(queries, dtype=np.uint64)
+        results = []
+        for batch_start in range(0, len(queries), batch_size):
+            batch = queries[batch_start : batch_start + batch_size]
+            # keys: the sorted band values, or the table of where each value starts in them
+            for i, (keys, order, masks) in enumerate(self.bands):
+                probes = (self._band(batch, i)[:, None] ^ masks).ravel()
+                if self._has_table(i):
+                    left = keys[probes]
+                    counts = keys[probes + np.uint64(1)] - left
+                else:
+                    left = np.searchsorted(keys, probes, 'left')
+                    counts = np.searchsorted(keys, probes, 'right') - left
+                hits = np.flatnonzero(counts)
+                if not len(hits):
+                    continue
+                total = np.cumsum(counts[hits])
+                splits = np.searchsorted(total, np.arange(max_candidates, total[-1], max_candidates), 'right')
+                for part in np.split(hits, np.unique(splits)):
+                    if not len(part):
+                        continue
+                    part_counts = counts[part]
+                    q_pos = np.repeat(part // len(masks), part_counts)
+                    offsets = np.arange(len(q_pos)) - np.repeat(np.cumsum(part_counts) - part_counts, part_counts)
+                    match = order[np.repeat(left[part], part_counts) + offsets]
+                    # Report each pair only for the first band in which it is within reach
+                    first = np.ones(len(q_pos), dtype=bool)
+                    for j in range(i):
+                        band_distance = hamming_distance(self._band(batch[q_pos], j), self._band(self.hashes[match], j))
+                        first &= band_distance > self.band_radius
+                    q_pos, match = q_pos[first], match[first]
+                    distance = hamming_distance(batch[q_pos], self.hashes[match])
+                    near = distance <= self.radius
+                    results.append((q_pos[near] + batch_start, match[near], distance[near]))
+        if not results:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.uint8)
+        return tuple(np.concatenate(r) for r in zip(*results))
+
+
+def near_duplicate_pairs(
+    hashes_a: np.ndarray, hashes_b: np.ndarray, radius: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """All pairs of positions (i, j) with hashes_a[i] and hashes_b[j] within `radius` bits, and their distances.
+
+    Zero hashes (undecodable or completely flat images) match each other trivially and are ignored.
+    """
+    valid_a = np.flatnonzero(hashes_a)
+    valid_b = np.flatnonzero(hashes_b)
+    index = MultiIndexHash(hashes_b[valid_b], radius)
+    i, j, distance = index.query(hashes_a[valid_a])
+    return valid_a[i], valid_b[j], distance
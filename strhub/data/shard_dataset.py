@@ -0,0 +1,138 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import random
+import warnings
+from typing import Callable, Optional
+
+from PIL import Image
+
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from strhub.data.image_header import get_image_size
+from strhub.data.metadata import preprocess_label
+from strhub.data.shards import ShardIndex, read_shard
+
+
+class ShardDataset(IterableDataset):
+    """Streaming dataset over tar shards (see strhub.data.shards and tools/export_shards.py). Shards are only ever
+    read sequentially, from start to end.
+
+    Every epoch, the shard order is shuffled with a seed derived from `seed` and the epoch (call `set_epoch()` before
+    each epoch), identically on all ranks. The shards are then dealt out round-robin to the (rank, worker) pairs, so
+    each shard is read by exactly one of them: every epoch covers the same set of samples, each once. Within each
+    worker, samples go through a shuffle buffer of `shuffle_buffer` samples. Keep the number of shards well above
+    ``world_size * num_workers`` for a good mix and an even split.
+
+    Labels are preprocessed and filtered exactly like `LmdbDataset`, on the fly. `min_image_dim` filtering uses the
+    image headers.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        charset: str,
+        max_label_len: int,
+        min_image_dim: int = 0,
+        remove_whitespace: bool = True,
+        normalize_unicode: bool = True,
+        transform: Optional[Callable] = None,
+        shuffle: bool = True,
+        shuffle_buffer: int = 1000,
+        seed: int = 0,
+    ):
+        from strhub.data.utils import CharsetAdapter
+
+        self.index = ShardIndex(root)
+        self.charset_adapter = CharsetAdapter(charset)
+        self.max_label_len = max_label_len
+        self.min_image_dim = min_image_dim
+        self.remove_whitespace = remove_whitespace
+        self.normalize_unicode = normalize_unicode
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Select the shuffle of the given epoch. Persistent workers do not see the change: do not use them."""
+        self.epoch = epoch
+
+    def __len__(self):
+        # Number of samples before filtering: an upper bound of what an epoch yields
+        return len(self.index)
+
+    def _preprocess_label(self, label: str) -> str:
+        return preprocess_label(
+            label, self.charset_adapter, self.max_label_len, self.remove_whitespace, self.normalize_unicode
+        )
+
+    def _image_too_small(self, image_bin: bytes) -> bool:
+        size = get_image_size(image_bin)
+        if size is None:
+            # Other formats: PIL only parses the header here
+            size = Image.open(io.BytesIO(image_bin)).size
+        return min(size) < self.min_image_dim
+
+    def assigned_shards(self, rank: int, world_size: int, worker: int, num_workers: int) -> list[str]:
+        """Shards read by the given worker of the given rank in the current epoch, in reading order."""
+        shards = list(self.index.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        num_consumers = world_size * num_workers
+        if len(shards) < num_consumers:
+            warnings.warn(f'{len(shards)} shards for {num_consumers} workers in total: some of them will be idle')
+        return shards[rank * num_workers + worker :: num_consumers]
+
+    def _samples(self, shards):
+        for shard in shards:
+            for _, image_bin, label in read_shard(shard):
+                label = self._preprocess_label(label)
+                if not label:
+                    continue
+                if self.min_image_dim > 0 and self._image_too_small(image_bin):
+                    continue
+                yield image_bin, label
+
+    def __iter__(self):
+        rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+        worker_info = get_worker_info()
+        worker, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        samples = self._samples(self.assigned_shards(rank, world_size, worker, num_workers))
+        if self.shuffle and self.shuffle_buffer > 1:
+            rng = random.Random(f'{self.seed}-{self.epoch}-{rank}-{worker}')
+            samples = _shuffled(samples, self.shuffle_buffer, rng)
+        for image_bin, label in samples:
+            img = Image.open(io.BytesIO(image_bin)).convert('RGB')
+            if self.transform is not None:
+                img = self.transform(img)
+            yield img, label
+
+
+def _shuffled(samples, buffer_size, rng):
+    """Reservoir-style shuffle: yield a random element of a buffer of `buffer_size`, refilled from `samples`."""
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
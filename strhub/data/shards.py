@@ -0,0 +1,146 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Datasets stored as size-bounded tar shards, for purely sequential reads.
+
+A shard directory has:
+
+- ``shard-%06d.tar``: plain (uncompressed) tar files. Each sample is two consecutive members sharing a key: the
+  encoded image (``<key>.jpg``, ``<key>.png`` or ``<key>.img``) and the UTF-8 label (``<key>.txt``). This is the
+  WebDataset layout, so the shards can be read by other tools as well.
+- ``shards.json``: the shard file names with their number of samples and size, and the sources. Written last.
+
+Shards never have to be seeked: a reader streams them from start to end.
+"""
+
+import io
+import json
+import os
+import tarfile
+from typing import Iterator
+
+INDEX_FILE = 'shards.json'
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _image_ext(image_bin: bytes) -> str:
+    if image_bin[:8] == _PNG_SIGNATURE:
+        return 'png'
+    if image_bin[:2] == b'\xff\xd8':
+        return 'jpg'
+    return 'img'
+
+
+def _tar_info(name: str, size: int) -> tarfile.TarInfo:
+    # Fixed metadata, so that exporting the same data twice gives identical shards
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o444
+    info.mtime = 0
+    return info
+
+
+class ShardWriter:
+    """Writes samples into shards of at most `shard_bytes` each (a single larger sample gets a shard of its own)."""
+
+    def __init__(self, root: str, shard_bytes: int, sources: list[str] = ()):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.shard_bytes = shard_bytes
+        self.sources = list(sources)
+        self.shards = []
+        self.num_samples = 0
+        self._tar = None
+        self._shard_samples = 0
+        # Invalidate any previous export until this one is complete
+        if os.path.exists(os.path.join(root, INDEX_FILE)):
+            os.remove(os.path.join(root, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._tar is not None:
+            self._tar.close()
+
+    def write(self, image_bin: bytes, label: str) -> None:
+        label_bin = label.encode()
+        # Upper bound: each member takes a 512-byte header and is padded to a multiple of 512 bytes. Closing the file
+        # adds the end-of-archive marker, padded to a full record.
+        nbytes = 4 * tarfile.BLOCKSIZE + len(image_bin) + len(label_bin) + tarfile.RECORDSIZE
+        if self._tar is not None and self._tar.offset + nbytes > self.shard_bytes:
+            self._close_shard()
+        if self._tar is None:
+            path = os.path.join(self.root, f'shard-{len(self.shards):06d}.tar')
+            self._tar = tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT)
+        key = f'{self.num_samples:09d}'
+        self._tar.addfile(_tar_info(f'{key}.{_image_ext(image_bin)}', len(image_bin)), io.BytesIO(image_bin))
+        self._tar.addfile(_tar_info(f'{key}.txt', len(label_bin)), io.BytesIO(label_bin))
+        self.num_samples += 1
+        self._shard_samples += 1
+
+    def _close_shard(self) -> None:
+        name = os.path.basename(self._tar.name)
+        self._tar.close()
+        self.shards.append({'name': name, 'num_samples': self._shard_samples, 'bytes': os.path.getsize(self._tar.name)})
+        self._tar = None
+        self._shard_samples = 0
+
+    def finish(self) -> None:
+        """Close the last shard, then mark the export as complete."""
+        if self._tar is not None:
+            self._close_shard()
+        info = {'version': 1, 'num_samples': self.num_samples, 'shards': self.shards, 'sources': self.sources}
+        tmp = os.path.join(self.root, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp, os.path.join(self.root, INDEX_FILE))
+
+
+class ShardIndex:
+    """The list of shards of an export."""
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            self.info = json.load(f)
+        self.num_samples = self.info['num_samples']
+        self.shards = [os.path.join(root, shard['name']) for shard in self.info['shards']]
+        self.shard_sizes = [shard['num_samples'] for shard in self.info['shards']]
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.isfile(os.path.join(root, INDEX_FILE))
+
+    def __len__(self):
+        return self.num_samples
+
+
+def read_shard(path: str) -> Iterator[tuple[str, bytes, str]]:
+    """Stream the samples of a shard in order, as (key, image_bin, label)."""
+    key, image_bin = None, None
+    # Stream mode: the file is read strictly sequentially, without seeking back to the member headers
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            name, _, ext = member.name.rpartition('.')
+            data = tar.extractfile(member).read()
+            if ext == 'txt':
+                if name != key:
+                    raise ValueError(f'{path}: label {member.name} without an image')
+                yield key, image_bin, data.decode()
+                key, image_bin = None, None
+            else:
+                key, image_bin = name, data
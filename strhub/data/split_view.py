@@ -0,0 +1,177 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Split views: datasets defined as a list of samples of existing LMDBs, without copying them.
+
+A view is a directory with:
+
+- ``source.bin``: ``<u2`` source LMDB of each sample of the view
+- ``index.bin``: ``<u4`` (1-based) index of the sample in its source LMDB
+- ``view.json``: number of samples, and the path (relative to the view) and `build-id` of each source LMDB
+
+Creating a view only writes 6 bytes per sample, so splits, subsets and debug samples are instant to create and take
+no disk space. Since samples are referenced by index, a view is only valid as long as its sources are unchanged:
+`SplitView` warns if the `build-id` of a source differs from the one recorded when the view was created.
+"""
+
+import json
+import os
+import warnings
+from contextlib import nullcontext
+from typing import Any, Callable, Optional, Sequence
+
+import lmdb
+import numpy as np
+
+from strhub.data.lmdb_utils import get_image, label_key, open_readonly, read_build_id
+from strhub.data.metadata import SampleMetadata
+
+VIEW_FILE = 'view.json'
+_COLUMNS = {'source': '<u2', 'index': '<u4'}
+
+# An LMDB can only be opened once per process, so all views of this process share their environments.
+_envs = {}
+_envs_pid = None
+
+
+def _shared_env(path: str) -> lmdb.Environment:
+    """The environment of the LMDB at `path`, opened once per process and kept open."""
+    global _envs_pid
+    if _envs_pid != os.getpid():
+        # Environments inherited from the parent process must not be used
+        _envs.clear()
+        _envs_pid = os.getpid()
+    if path not in _envs:
+        _envs[path] = open_readonly(path)
+    return _envs[path]
+
+
+def open_source(path: str):
+    """The shared environment if already open in this process, else one which is closed after use."""
+    env = _envs.get(path) if _envs_pid == os.getpid() else None
+    return nullcontext(env) if env is not None else open_readonly(path)
+
+
+def write_view(root: str, sources: Sequence[str], source_ids: Sequence[int], indices: Sequence[int]) -> None:
+    """Create (or replace) the view at `root` of the given samples: sample ``i`` of the view is sample ``indices[i]``
+    of the LMDB ``sources[source_ids[i]]``."""
+    os.makedirs(root, exist_ok=True)
+    # Invalidate any previous view until this one is complete
+    if os.path.exists(os.path.join(root, VIEW_FILE)):
+        os.remove(os.path.join(root, VIEW_FILE))
+    source_ids = np.asarray(source_ids, dtype=_COLUMNS['source'])
+    indices = np.asarray(indices, dtype=_COLUMNS['index'])
+    if len(source_ids) != len(indices):
+        raise ValueError('source_ids and indices must have the same length')
+    source_ids.tofile(os.path.join(root, 'source.bin'))
+    indices.tofile(os.path.join(root, 'index.bin'))
+    source_info = []
+    for path in sources:
+        with open_source(path) as env:
+            build_id = read_build_id(env)
+        rel_path = os.path.relpath(os.path.realpath(path), os.path.realpath(root))
+        source_info.append({'path': rel_path, 'build_id': build_id})
+    info = {'version': 1, 'num_samples': len(indices), 'sources': source_info}
+    tmp = os.path.join(root, VIEW_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, os.path.join(root, VIEW_FILE))
+
+
+class SplitView:
+    """Read-only access to the samples of a view. The source LMDBs are opened lazily, once per process, so instances
+    can be sent to worker processes."""
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, VIEW_FILE)) as f:
+            self.info = json.load(f)
+        self.num_samples = self.info['num_samples']
+        # Source paths are relative to the view itself, not to any symlink to it
+        real_root = os.path.realpath(root)
+        self.sources = [os.path.normpath(os.path.join(real_root, s['path'])) for s in self.info['sources']]
+        self.source_ids = np.fromfile(os.path.join(root, 'source.bin'), _COLUMNS['source'])
+        self.indices = np.fromfile(os.path.join(root, 'index.bin'), _COLUMNS['index'])
+        for path in self.stale_sources():
+            warnings.warn(f'{path} changed since the view {root} was created, the view is probably invalid')
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.isfile(os.path.join(root, VIEW_FILE))
+
+    def __len__(self):
+        return self.num_samples
+
+    def stale_sources(self) -> list[str]:
+        """Sources whose `build-id` differs from the one recorded in the view."""
+        stale = []
+        for path, info in zip(self.sources, self.info['sources']):
+            with open_source(path) as env:
+                if read_build_id(env) != info['build_id']:
+                    stale.append(path)
+        return stale
+
+    def locate(self, pos: int) -> tuple[int, int]:
+        """(source, 1-based index in the source) of the sample at the given (0-based) position of the view."""
+        return int(self.source_ids[pos]), int(self.indices[pos])
+
+    def get(self, pos: int) -> tuple[bytes, str]:
+        """Encoded image and raw label of the sample at the given (0-based) position of the view."""
+        return self.get_many([pos])[0]
+
+    def get_many(self, positions: Sequence[int], decode: Optional[Callable[[memoryview], Any]] = None) -> list:
+        """(image, raw label) of the samples at the given positions, in the same order.
+
+        The lookups are done sorted by source and index, so that they follow the page order of the sources, in one
+        ``buffers=True`` transaction per source. The image is ``decode(buffer)``, called on a zero-copy buffer of the
+        encoded image which is only valid during the call; without `decode`, a copy of the encoded image. None for
+        samples without an image.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        source_ids, indices = self.source_ids[positions], self.indices[positions]
+        order = np.lexsort((indices, source_ids))
+        source_ids, indices = source_ids[order], indices[order]
+        samples = [None] * len(positions)
+        for source in np.unique(source_ids).tolist():
+            lo, hi = np.searchsorted(source_ids, [source, source + 1])
+            with _shared_env(self.sources[source]).begin(buffers=True) as txn:
+                for i, index in zip(order[lo:hi].tolist(), indices[lo:hi].tolist()):
+                    # Label first: each read invalidates the buffer of the previous one
+                    label = str(txn.get(label_key(index)), 'utf-8')
+                    image_bin = get_image(txn, index)
+                    if image_bin is not None:
+                        image_bin = decode(image_bin) if decode is not None else bytes(image_bin)
+                    samples[i] = image_bin, label
+        return samples
+
+    def labels(self) -> list[str]:
+        """Raw labels of all samples, in view order. Reads each source in key order, without touching the images.
+
+        Sources not opened yet are opened only for the duration of the call, so it is safe to fork afterwards.
+        """
+        labels = [''] * self.num_samples
+        for source, path in enumerate(self.sources):
+            positions = np.flatnonzero(self.source_ids == source)
+            positions = positions[np.argsort(self.indices[positions], kind='stable')]
+            with open_source(path) as env, env.begin() as txn:
+                for pos in positions:
+                    labels[pos] = txn.get(label_key(int(self.indices[pos]))).decode()
+        return labels
+
+    def metadata(self, source: int) -> Optional[SampleMetadata]:
+        """Metadata sidecar of a source LMDB, if it has one."""
+        path = self.sources[source]
+        with open_source(path) as env:
+            return SampleMetadata(path, env) if SampleMetadata.exists(path, env) else None
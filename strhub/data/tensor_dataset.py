@@ -0,0 +1,90 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Callable, Optional
+
+from PIL import Image
+
+import torch
+from torch import Tensor
+from torch.utils.data import Dataset
+
+from strhub.data.metadata import preprocess_label
+from strhub.data.tensor_store import TensorStore
+
+
+class TensorStoreDataset(Dataset):
+    """Dataset backed by a pre-decoded `TensorStore` (see tools/create_tensor_store.py).
+
+    Labels are preprocessed and filtered exactly like `LmdbDataset`, without touching the images.
+
+    Without a transform, samples are returned as uint8 HWC tensors sharing memory with the store: no decode, no
+    resize, no copy. Batch them with the default collate function and convert with `to_model_input()`, ideally on the
+    GPU. With a transform (e.g. augmentation followed by `T.ToTensor()` and `T.Normalize()`), it is applied to a PIL
+    view of the stored image, which is already at the model input size.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        charset: str,
+        max_label_len: int,
+        min_image_dim: int = 0,
+        remove_whitespace: bool = True,
+        normalize_unicode: bool = True,
+        transform: Optional[Callable] = None,
+    ):
+        self.store = TensorStore(root)
+        self.transform = transform
+        self.labels = []
+        self.filtered_index_list = []
+        self.num_samples = self._preprocess_labels(
+            charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim
+        )
+
+    def _preprocess_labels(self, charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim):
+        from strhub.data.utils import CharsetAdapter
+
+        charset_adapter = CharsetAdapter(charset)
+        invalid = set(self.store.invalid)
+        sizes = self.store.sizes
+        for index in range(1, len(self.store) + 1):
+            if index in invalid:
+                continue
+            label = self.store.label(index)
+            label = preprocess_label(label, charset_adapter, max_label_len, remove_whitespace, normalize_unicode)
+            if not label:
+                continue
+            # Filter images that are too small, based on the size of the original image.
+            if min_image_dim > 0 and min(sizes[index - 1]) < min_image_dim:
+                continue
+            self.labels.append(label)
+            self.filtered_index_list.append(index)
+        return len(self.labels)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        label = self.labels[index]
+        img = self.store.image(self.filtered_index_list[index])
+        if self.transform is None:
+            return torch.from_numpy(img), label
+        return self.transform(Image.fromarray(img)), label
+
+
+def to_model_input(images: Tensor) -> Tensor:
+    """Batch equivalent of `T.ToTensor()` followed by `T.Normalize(0.5, 0.5)`: NHWC uint8 to NCHW float."""
+    return images.permute(0, 3, 1, 2).float().div_(127.5).sub_(1.0)
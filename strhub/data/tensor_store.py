@@ -0,0 +1,149 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Datasets stored as pre-decoded, pre-resized images in one memory-mapped uint8 array.
+
+A store is a directory with:
+
+- ``images.bin``: ``(num_samples, height, width, 3)`` uint8 RGB images, resized the same way as by
+  `SceneTextDataModule.get_transform` (bicubic, no aspect ratio preservation)
+- ``labels.bin``/``label_end.bin``: the raw labels as concatenated UTF-8, addressed by ``<u8`` end offsets
+- ``width.bin``/``height.bin``: ``<u4`` size of the original images, for `min_image_dim` filtering
+- ``meta.json``: shape, resize method, sources, and the indices of images which could not be decoded
+
+Reading a sample is a slice of the memory map: nothing is decoded or resized.
+"""
+
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+META_FILE = 'meta.json'
+IMAGES_FILE = 'images.bin'
+_COLUMNS = {'label_end': '<u8', 'width': '<u4', 'height': '<u4'}
+
+
+def resize(img: Image.Image, img_size: tuple[int, int]) -> np.ndarray:
+    """Resize to (height, width) like `T.Resize(img_size, T.InterpolationMode.BICUBIC)` on a PIL image."""
+    return np.asarray(img.convert('RGB').resize(img_size[::-1], Image.BICUBIC))
+
+
+class TensorStoreWriter:
+    """Creates a store for `num_samples` images. The rows of the image array can be filled by several processes."""
+
+    def __init__(self, root: str, num_samples: int, img_size: tuple[int, int], sources: list[str] = ()):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.num_samples = num_samples
+        self.img_size = tuple(img_size)
+        self.sources = list(sources)
+        # Invalidate any previous store until this one is complete
+        if os.path.exists(os.path.join(root, META_FILE)):
+            os.remove(os.path.join(root, META_FILE))
+        with open(os.path.join(root, IMAGES_FILE), 'wb') as f:
+            f.truncate(num_samples * self.img_size[0] * self.img_size[1] * 3)
+
+    @staticmethod
+    def open_images(root: str, num_samples: int, img_size: tuple[int, int]) -> np.ndarray:
+        """Writable memory map of the image array. Use in each writer process."""
+        return np.memmap(os.path.join(root, IMAGES_FILE), np.uint8, 'r+', shape=(num_samples, *img_size, 3))
+
+    def finish(self, labels: list[str], sizes: list[tuple[int, int]], invalid: list[int] = ()) -> None:
+        """Write the labels and original (width, height) of all samples, then mark the store as complete."""
+        label_bins = [label.encode() for label in labels]
+        with open(os.path.join(self.root, 'labels.bin'), 'wb') as f:
+            f.write(b''.join(label_bins))
+        sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        columns = {
+            'label_end': np.cumsum([len(b) for b in label_bins], dtype=np.int64),
+            'width': sizes[:, 0],
+            'height': sizes[:, 1],
+        }
+        for name, dtype in _COLUMNS.items():
+            np.asarray(columns[name], dtype=dtype).tofile(os.path.join(self.root, name + '.bin'))
+        info = {
+            'version': 1,
+            'num_samples': self.num_samples,
+            'img_size': list(self.img_size),
+            'resize': 'bicubic',
+            'sources': self.sources,
+            'invalid': sorted(invalid),
+        }
+        tmp = os.path.join(self.root, META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp, os.path.join(self.root, META_FILE))
+
+
+class TensorStore:
+    """Read-only view of a store. The memory maps are opened lazily, so instances can be sent to worker processes."""
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, META_FILE)) as f:
+            self.info = json.load(f)
+        self.num_samples = self.info['num_samples']
+        self.img_size = tuple(self.info['img_size'])
+        self._maps = None
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.isfile(os.path.join(root, META_FILE))
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        return {**self.__dict__, '_maps': None}
+
+    def _load(self) -> dict:
+        if self._maps is None:
+            # Copy-on-write mapping: the arrays are writable (as torch.from_numpy() wants) without copying anything
+            maps = {'images': np.memmap(os.path.join(self.root, IMAGES_FILE), np.uint8, 'c')}
+            maps['images'] = maps['images'].reshape(self.num_samples, *self.img_size, 3)
+            for name, dtype in _COLUMNS.items():
+                maps[name] = np.fromfile(os.path.join(self.root, name + '.bin'), dtype)
+            maps['labels'] = np.fromfile(os.path.join(self.root, 'labels.bin'), np.uint8)
+            self._maps = maps
+        return self._maps
+
+    @property
+    def images(self) -> np.ndarray:
+        """``(num_samples, height, width, 3)`` uint8 array, indexed by ``sample index - 1``."""
+        return self._load()['images']
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """``(num_samples, 2)`` original (width, height) of the images."""
+        maps = self._load()
+        return np.stack([maps['width'], maps['height']], axis=1)
+
+    @property
+    def invalid(self) -> list[int]:
+        """(1-based) indices of the samples whose image could not be decoded. Their rows are all zeros."""
+        return self.info['invalid']
+
+    def label(self, index: int) -> str:
+        """Raw label of the sample with the given (1-based) index."""
+        maps = self._load()
+        ends = maps['label_end']
+        start = ends[index - 2] if index > 1 else 0
+        return maps['labels'][start : ends[index - 1]].tobytes().decode()
+
+    def image(self, index: int) -> np.ndarray:
+        """HWC view of the image of the sample with the given (1-based) index."""
+        return self.images[index - 1]
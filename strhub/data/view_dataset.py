@@ -0,0 +1,131 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+from functools import partial
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+from torch.utils.data import Dataset
+
+from strhub.data.image_header import get_image_size
+from strhub.data.lmdb_utils import get_image
+from strhub.data.metadata import preprocess_label
+from strhub.data.split_view import SplitView, open_source
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class SplitViewDataset(Dataset):
+    """Dataset backed by a `SplitView` (see strhub.data.split_view), i.e. a subset of samples of existing LMDBs.
+
+    Labels are preprocessed and filtered exactly like `LmdbDataset`. The sizes needed for `min_image_dim` come from
+    the metadata sidecars of the sources if they have one, else from the image headers. Images are decoded with PIL,
+    like `LmdbDataset`, or with OpenCV if `opencv_decode` is set (see `decode_image`).
+    """
+
+    def __init__(
+        self,
+        root: str,
+        charset: str,
+        max_label_len: int,
+        min_image_dim: int = 0,
+        remove_whitespace: bool = True,
+        normalize_unicode: bool = True,
+        transform: Optional[Callable] = None,
+        opencv_decode: bool = False,
+    ):
+        if opencv_decode and cv2 is None:
+            raise ImportError('opencv_decode requires OpenCV (pip install opencv-python)')
+        self.view = SplitView(root)
+        self.transform = transform
+        self.decode = partial(decode_image, opencv=opencv_decode)
+        self.labels = []
+        self.filtered_index_list = []
+        self.num_samples = self._preprocess_labels(
+            charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim
+        )
+
+    def _image_sizes(self) -> np.ndarray:
+        """(width, height) of the images of all samples, in view order."""
+        sizes = np.zeros((len(self.view), 2), dtype=np.int64)
+        for source, path in enumerate(self.view.sources):
+            positions = np.flatnonzero(self.view.source_ids == source)
+            rows = self.view.indices[positions].astype(np.int64) - 1
+            meta = self.view.metadata(source)
+            if meta is not None:
+                sizes[positions, 0] = meta.width[rows]
+                sizes[positions, 1] = meta.height[rows]
+                continue
+            with open_source(path) as env, env.begin(buffers=True) as txn:
+                for pos, row in sorted(zip(positions, rows), key=lambda p: p[1]):
+                    sizes[pos] = get_image_size(get_image(txn, int(row) + 1)) or (0, 0)
+        return sizes
+
+    def _preprocess_labels(self, charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim):
+        from strhub.data.utils import CharsetAdapter
+
+        charset_adapter = CharsetAdapter(charset)
+        sizes = self._image_sizes() if min_image_dim > 0 else None
+        for pos, label in enumerate(self.view.labels()):
+            label = preprocess_label(label, charset_adapter, max_label_len, remove_whitespace, normalize_unicode)
+            if not label:
+                continue
+            # Filter images that are too small.
+            if sizes is not None and min(sizes[pos]) < min_image_dim:
+                continue
+            self.labels.append(label)
+            self.filtered_index_list.append(pos)
+        return len(self.labels)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        """Batch fetch, used by the `DataLoader` (torch >= 2.1) instead of one `__getitem__` call per sample.
+
+        The samples are looked up in page order, and each image is decoded from the memory map.
+        """
+        positions = [self.filtered_index_list[index] for index in indices]
+        samples = []
+        for (img, _), index in zip(self.view.get_many(positions, self.decode), indices):
+            if self.transform is not None:
+                img = self.transform(img)
+            samples.append((img, self.labels[index]))
+        return samples
+
+
+def decode_image(buf: memoryview, opencv: bool = False) -> Image.Image:
+    """RGB image from a buffer of the encoded image, like ``Image.open(...).convert('RGB')``.
+
+    With `opencv`, JPEG and PNG images are decoded by OpenCV straight from the buffer, which is faster for small crops.
+    The pixels may differ slightly from PIL's, depending on the libjpeg builds: check the accuracy before training or
+    evaluating with it.
+    """
+    if opencv:
+        # No copy of the encoded image. Like PIL, ignore the EXIF orientation.
+        img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img is not None:
+            return Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    # Formats OpenCV cannot read, and errors
+    return Image.open(io.BytesIO(buf)).convert('RGB')
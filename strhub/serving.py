@@ -0,0 +1,288 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio inference server with dynamic batching, using the standard library only.
+
+Concurrent requests are gathered into micro-batches: a batch is run as soon as it has `max_batch_size` images, or
+`max_wait` seconds after its first image arrived. Inference runs in a separate thread, so requests keep being accepted
+(and the next batch keeps filling up) while a batch is running.
+
+Endpoints, over HTTP/1.1 on TCP and/or a Unix socket:
+
+- ``POST /read``: the body is an encoded image. Returns ``{"text": ..., "confidence": ...}``.
+- ``POST /read_paths``: the body is ``{"paths": [...]}``, absolute paths of images on the server's filesystem, for
+  local clients (see read_client.py). Returns ``{"results": [...]}``, one result (or ``{"error": ...}``) per path.
+  Only served on the Unix socket, which only the user running the server can connect to.
+- ``GET /stats``: request latency percentiles (ms) and the histogram of batch sizes.
+- ``GET /health``
+"""
+
+import asyncio
+import io
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+# Raised for images which cannot be read. Pillow raises DecompressionBombError for images with too many pixels.
+_IMAGE_ERRORS = (IOError, ValueError, Image.DecompressionBombError)
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class Stats:
+    """Latencies of the last `window` requests, and the sizes of all batches."""
+
+    def __init__(self, window: int = 10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+
+    def add_request(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.num_requests += 1
+
+    def add_batch(self, size: int) -> None:
+        self.batch_sizes[size] += 1
+
+    def report(self) -> dict[str, Any]:
+        latencies = 1000 * np.asarray(self.latencies)
+        percentiles = {}
+        if len(latencies):
+            for q in (50, 90, 95, 99):
+                percentiles[f'p{q}'] = round(float(np.percentile(latencies, q)), 3)
+            percentiles['max'] = round(float(latencies.max()), 3)
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            'requests': self.num_requests,
+            'latency_ms': percentiles,
+            'batches': num_batches,
+            'mean_batch_size': sum(k * v for k, v in self.batch_sizes.items()) / max(num_batches, 1),
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+        }
+
+
+class MicroBatcher:
+    """Gathers submitted items into batches for `infer`, which maps a list of items to a list of results.
+
+    Call `run()` as a task of the event loop which calls `submit()`.
+    """
+
+    def __init__(self, infer: Callable[[list], list], max_batch_size: int, max_wait: float, stats: Stats = None):
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats or Stats()
+        self._queue = None
+        # A single thread: batches run one after the other, and the event loop stays responsive meanwhile
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='inference')
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # Created in the event loop which uses it
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def submit(self, item) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already queued without waiting
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            items = [item for item, _ in batch]
+            self.stats.add_batch(len(items))
+            try:
+                results = await loop.run_in_executor(self._executor, self.infer, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+def model_inference(model, device: str = 'cpu') -> Callable[[list], list]:
+    """`infer` function for a model: batch of transformed images -> list of (text, confidence)."""
+    import torch
+
+    @torch.inference_mode()
+    def infer(images):
+        p = model(torch.stack(images).to(device)).softmax(-1)
+        preds, probs = model.tokenizer.decode(p)
+        # Same confidence as test.py: the product of the character probabilities, end-of-sequence included
+        return [(pred, prob.prod().item()) for pred, prob in zip(preds, probs)]
+
+    return infer
+
+
+class InferenceServer:
+    """HTTP front end of a `MicroBatcher`. `transform` turns a PIL image into a model input; it runs in the default
+    thread pool of the event loop, so decoding overlaps with inference."""
+
+    def __init__(self, batcher: MicroBatcher, transform: Callable, max_body_bytes: int = 16 * 1024**2):
+        self.batcher = batcher
+        self.transform = transform
+        self.max_body_bytes = max_body_bytes
+
+    def _prepare(self, image_bin: bytes):
+        return self.transform(Image.open(io.BytesIO(image_bin)).convert('RGB'))
+
+    async def read(self, image_bin: bytes) -> dict[str, Any]:
+        """Text and confidence for one encoded image."""
+        start = time.perf_counter()
+        image = await asyncio.get_running_loop().run_in_executor(None, self._prepare, image_bin)
+        text, confidence = await self.batcher.submit(image)
+        self.batcher.stats.add_request(time.perf_counter() - start)
+        return {'text': text, 'confidence': confidence}
+
+    async def read_paths(self, paths: list[str]) -> list[dict[str, Any]]:
+        """Text and confidence for each image file. Their batches are formed together with all other requests."""
+
+        async def read_path(path):
+            try:
+                image_bin = await asyncio.get_running_loop().run_in_executor(None, Path(path).read_bytes)
+                return {'path': path, **await self.read(image_bin)}
+            except _IMAGE_ERRORS as e:
+                return {'path': path, 'error': str(e)}
+
+        return await asyncio.gather(*(read_path(path) for path in paths))
+
+    async def _route(self, method: str, path: str, body: bytes, local: bool) -> tuple[int, dict]:
+        if path == '/read':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                return 200, await self.read(body)
+            except _IMAGE_ERRORS as e:
+                return 400, {'error': f'cannot read the image: {e}'}
+        if path == '/read_paths' and local:
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                paths = json.loads(body)['paths']
+            except (ValueError, KeyError, TypeError):
+                return 400, {'error': 'expected {"paths": [...]}'}
+            return 200, {'results': await self.read_paths(paths)}
+        if path == '/stats':
+            return 200, self.batcher.stats.report()
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'no such endpoint: {path}'}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, local: bool = False) -> None:
+        """Serve the requests of one connection (kept alive unless the client asks otherwise). Endpoints reading files
+        of the server are only served on `local` (Unix socket) connections."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed request line'}, False)
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed Content-Length'}, False)
+                    break
+                if length > self.max_body_bytes:
+                    await self._respond(writer, 400, {'error': 'request body too large'}, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                try:
+                    status, payload = await self._route(method, target.split('?', 1)[0], body, local)
+                except Exception as e:
+                    status, payload = 500, {'error': repr(e)}
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool) -> None:
+        body = json.dumps(payload).encode()
+        head = (
+            f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        )
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def serve(
+        self, host: Optional[str] = None, port: Optional[int] = None, unix_socket: Optional[str] = None
+    ) -> None:
+        """Serve forever on TCP ``host:port`` and/or the Unix socket at `unix_socket`."""
+        servers = []
+        if port is not None:
+            servers.append(await asyncio.start_server(self.handle, host, port))
+        if unix_socket is not None:
+            # Only the owner may connect: the socket gives access to the files readable by the server. It is created
+            # with these permissions, rather than changed after binding, when others could already connect.
+            umask = os.umask(0o177)
+            try:
+                servers.append(await asyncio.start_unix_server(partial(self.handle, local=True), unix_socket))
+            finally:
+                os.umask(umask)
+        if not servers:
+            raise ValueError('Nothing to listen on: give a port and/or a Unix socket')
+        batcher = asyncio.create_task(self.batcher.run())
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            batcher.cancel()
@@ -0,0 +1,59 @@
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+from strhub.data.lmdb_utils import LmdbWriter, label_key, open_readonly, read_build_id, read_num_samples
+
+NUM_LINES = 30
+ROOT = Path(__file__).resolve().parents[1]
+
+# Writes one sample per "line" with a checkpoint after each, like the resumable tools. Exits without any cleanup
+# once `kill_after` samples have been written (in this run), as if the process had been killed.
+BUILD = textwrap.dedent(
+    '''
+    import os, sys
+    from strhub.data.lmdb_utils import LmdbWriter
+
+    path, kill_after = sys.argv[1], int(sys.argv[2])
+    writer = LmdbWriter(path, commit_interval=4, append=True, metadata=False)
+    start = (writer.get_progress('gt') or {'lines': 0})['lines']
+    for i, line in enumerate(range(start, %d)):
+        if i == kill_after:
+            os._exit(1)
+        writer.write(b'image%%d' %% line, 'word%%d' %% line)
+        writer.set_progress('gt', {'lines': line + 1})
+    writer.close()
+    '''
+    % NUM_LINES
+)
+
+
+def _build(path, kill_after):
+    return subprocess.run([sys.executable, '-c', BUILD, str(path), str(kill_after)], cwd=ROOT).returncode
+
+
+def _labels(path):
+    with open_readonly(str(path)) as env, env.begin() as txn:
+        return [bytes(txn.get(label_key(i))).decode() for i in range(1, read_num_samples(env) + 1)]
+
+
+def test_resume_after_hard_kill(tmp_path):
+    path = tmp_path / 'out'
+    # Killed after 9 samples: the first two commits (4 and 8 samples) made it to disk
+    assert _build(path, 9) == 1
+    assert _labels(path) == [f'word{i}' for i in range(8)]
+    assert _build(path, NUM_LINES) == 0
+    assert _labels(path) == [f'word{i}' for i in range(NUM_LINES)]
+
+
+def test_close_without_changes_keeps_build_id(tmp_path):
+    path = str(tmp_path / 'out')
+    with LmdbWriter(path, metadata=False) as writer:
+        writer.write(b'image', 'word')
+    with open_readonly(path) as env:
+        build_id = read_build_id(env)
+    with LmdbWriter(path, append=True, metadata=False):
+        pass
+    with open_readonly(path) as env:
+        assert read_build_id(env) == build_id
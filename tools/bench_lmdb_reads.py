@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Benchmark the per-worker read throughput of LMDB datasets: per-sample lookups vs batched zero-copy lookups.
+
+The per-sample path is what a dataset does without batch fetching: one read transaction and one copying lookup per
+image and label, in shuffled order. The batched path is `SplitViewDataset.__getitems__`: the lookups of each batch
+sorted by key, in one ``buffers=True`` transaction per batch and source (`SplitView.get_many()`), and each image
+decoded from the memory map. Both paths use the same decoder (PIL, or OpenCV with --opencv) and read the same
+shuffled batches, each run in a fresh process (i.e. one data loader worker).
+
+With --cold, the sources are dropped from the page cache before each run, which shows the effect of the lookup order
+on storage that is not cached (first epoch, datasets larger than memory, network filesystems).
+"""
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from strhub.data.lmdb_utils import get_image, label_key, open_readonly, read_num_samples
+from strhub.data.split_view import SplitView, open_source, write_view
+from strhub.data.view_dataset import cv2, decode_image
+
+
+def per_sample(view, batches, decode):
+    with ExitStack() as stack:
+        envs = [stack.enter_context(open_source(path)) for path in view.sources]
+        for batch in batches:
+            for pos in batch:
+                source, index = view.locate(pos)
+                with envs[source].begin() as txn:
+                    image_bin = get_image(txn, index)
+                    # Read the label too, like the dataset does
+                    txn.get(label_key(index)).decode()
+                if decode is not None:
+                    decode(image_bin)
+
+
+def batched(view, batches, decode):
+    for batch in batches:
+        view.get_many(batch, decode)
+
+
+def _evict(path):
+    """Drop the LMDB from the page cache. Only works for pages which no process has mapped."""
+    fd = os.open(os.path.join(path, 'data.mdb'), os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _timed_run(fn, root, batches, decode):
+    """Runs in a fresh worker process, which opens the sources itself, like a data loader worker."""
+    view = SplitView(root)
+    start = time.perf_counter()
+    fn(view, batches, decode)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('input', help='Path to a split view or an LMDB')
+    parser.add_argument('--batch_size', type=int, default=384)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--no_decode', action='store_true', help='Only read the images, do not decode them')
+    parser.add_argument('--opencv', action='store_true', help='Decode with OpenCV instead of PIL (both paths)')
+    parser.add_argument(
+        '--cold', action='store_true', help='Drop the sources from the page cache before each run (no root needed)'
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs of each path')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.opencv and cv2 is None:
+        parser.error('--opencv requires OpenCV (pip install opencv-python)')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.input
+        if not SplitView.exists(root):
+            # A view of the whole LMDB
+            with open_readonly(args.input) as env:
+                num_samples = read_num_samples(env)
+            root = os.path.join(tmp, 'view')
+            write_view(root, [args.input], np.zeros(num_samples), np.arange(1, num_samples + 1))
+        view = SplitView(root)
+        rng = np.random.default_rng(args.seed)
+        perm = rng.permutation(len(view))
+        batches = [perm[i : i + args.batch_size] for i in range(0, len(perm), args.batch_size)][: args.num_batches]
+        num_read = sum(len(batch) for batch in batches)
+        decode = None if args.no_decode else partial(decode_image, opencv=args.opencv)
+        results = {}
+        for name, fn in (('per-sample', per_sample), ('batched', batched)):
+            times = []
+            # Without --cold, the first run only warms up the page cache
+            for run in range(args.repeat + (not args.cold)):
+                if args.cold:
+                    for path in view.sources:
+                        _evict(path)
+                with Pool(1) as pool:
+                    elapsed = pool.apply(_timed_run, (fn, root, batches, decode))
+                if args.cold or run > 0:
+                    times.append(elapsed)
+            results[name] = num_read / min(times)
+            print(f'{name:>10}: {results[name]:10.0f} samples/s')
+    print(f'Speedup: {results["batched"] / results["per-sample"]:.2f}x ({num_read} samples per run)')
+
+
+if __name__ == '__main__':
+    main()
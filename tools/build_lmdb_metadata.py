@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Write the metadata sidecar (see strhub.data.metadata) for LMDBs which were built without one."""
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from strhub.data.lmdb_utils import iter_images, label_key, open_readonly, read_build_id, read_num_samples
+from strhub.data.metadata import MetadataWriter
+
+
+def build_metadata(lmdb_path: str) -> int:
+    with open_readonly(lmdb_path) as env:
+        num_samples = read_num_samples(env)
+        build_id = read_build_id(env)
+        writer = MetadataWriter(lmdb_path, build_id=build_id)
+        # Walk the images, imagepath- and label- ranges in key order with cursors. buffers=True avoids copying the
+        # images; only their headers are touched.
+        with env.begin(buffers=True) as txn:
+            images = iter_images(txn)
+            image = next(images, None)
+            paths, labels = txn.cursor(), txn.cursor()
+            paths.set_range(b'imagepath-')
+            labels.set_range(b'label-')
+            for index in tqdm(range(1, num_samples + 1), desc=lmdb_path):
+                if bytes(labels.key()) != label_key(index):
+                    raise ValueError(f'{lmdb_path}: sample {index} of {num_samples} has no label')
+                # Samples without an imagepath- key have no path
+                path = None
+                if bytes(paths.key()) == f'imagepath-{index:09d}'.encode():
+                    path = bytes(paths.value()).decode()
+                    paths.next()
+                # iter_images skips samples without an image: those get an empty row (size 0x0) to keep the rows
+                # aligned with the sample indices.
+                has_image = image is not None and image[0] == index
+                writer.add(image[1] if has_image else b'', bytes(labels.value()).decode(), path)
+                if has_image:
+                    image = next(images, None)
+                labels.next()
+        writer.flush()
+        writer.commit(num_samples, build_id)
+    return num_samples
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to LMDBs')
+    args = parser.parse_args()
+    for lmdb_path in args.inputs:
+        num_samples = build_metadata(lmdb_path)
+        print(f'Wrote metadata for {num_samples} samples of {lmdb_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,10 @@ import os
 import os.path as osp
 from functools import partial
 
-import mmcv
 from mmocr.utils.fileio import list_to_file
-from PIL import Image
+
+from strhub.data.annotation_index import AnnotationIndex
+from strhub.data.crop_writer import SceneImage, save_crop, split_lmdb, stream_crops
 
 
 def parse_args():
@@ -17,16 +18,34 @@ def parse_args():
     )
     parser.add_argument('root_path', help='Root dir path of TextOCR')
     parser.add_argument('n_proc', default=1, type=int, help='Number of processes to run')
+    parser.add_argument('--lmdb_root', help='Also write the crops of each split to an LMDB in this directory')
+    parser.add_argument(
+        '--no_images', action='store_true', help='Do not write the crops as image files (requires --lmdb_root)'
+    )
+    parser.add_argument(
+        '--lossless_crop', action='store_true', help='Cut crops in the DCT domain when possible (needs PyTurboJPEG)'
+    )
+    parser.add_argument(
+        '--max_slack',
+        type=int,
+        default=0,
+        help='With --lossless_crop, keep up to this many extra pixels left of and above a crop instead of trimming',
+    )
     args = parser.parse_args()
+    if args.no_images and not args.lmdb_root:
+        parser.error('--no_images requires --lmdb_root')
     return args
 
 
-def process_img(args, src_image_root, dst_image_root):
-    # Dirty hack for multiprocessing
-    img_idx, img_info, anns = args
-    src_img = Image.open(osp.join(src_image_root, 'train2014', img_info['file_name']))
-    src_w, src_h = src_img.size
-    labels = []
+def process_img(pos, index, img_start_idx, split, src_image_root, dst_image_root, lossless=False, max_slack=0):
+    # Only the position of the image is sent to the workers; its annotations are read from the file here.
+    img_info, anns = index.image(pos)
+    if img_info['set'] != split:
+        return []
+    img_idx = pos + img_start_idx
+    src = SceneImage(osp.join(src_image_root, 'train2014', img_info['file_name']), lossless, max_slack)
+    src_w, src_h = src.size
+    crops = []
     for ann_idx, ann in enumerate(anns):
         text_label = html.unescape(ann['utf8_string'].strip())
 
@@ -52,17 +71,27 @@ def process_img(args, src_image_root, dst_image_root):
         x, y = max(0, math.floor(x) - pad), max(0, math.floor(y) - pad)
         w, h = math.ceil(w), math.ceil(h)
         x2, y2 = min(src_w, x + w + 2 * pad), min(src_h, y + h + 2 * pad)
-        dst_img = src_img.crop((x, y, x2, y2))
+        image_bin = src.crop((x, y, x2, y2))
+        if image_bin is None:
+            continue
         dst_img_name = f'img_{img_idx}_{ann_idx}.jpg'
-        dst_img_path = osp.join(dst_image_root, dst_img_name)
-        # Preserve JPEG quality
-        dst_img.save(dst_img_path, qtables=src_img.quantization)
-        labels.append(f'{osp.basename(dst_image_root)}/{dst_img_name}' f' {text_label}')
-    src_img.close()
-    return labels
-
-
-def convert_textocr(root_path, dst_image_path, dst_label_filename, annotation_filename, img_start_idx=0, nproc=1):
+        crops.append((save_crop(image_bin, dst_image_root, dst_img_name), image_bin, text_label))
+    src.close()
+    return crops
+
+
+def convert_textocr(
+    root_path,
+    dst_image_path,
+    dst_label_filename,
+    annotation_filename,
+    img_start_idx=0,
+    nproc=1,
+    lmdb_path=None,
+    save_images=True,
+    lossless=False,
+    max_slack=0,
+):
     annotation_path = osp.join(root_path, annotation_filename)
     if not osp.exists(annotation_path):
         raise Exception(f'{annotation_path} not exists, please check and try again.')
@@ -70,27 +99,28 @@ def convert_textocr(root_path, dst_image_path, dst_label_filename, annotation_fi
 
     # outputs
     dst_label_file = osp.join(root_path, dst_label_filename)
-    dst_image_root = osp.join(root_path, dst_image_path)
-    os.makedirs(dst_image_root, exist_ok=True)
+    dst_image_root = osp.join(root_path, dst_image_path) if save_images else None
+    if save_images:
+        os.makedirs(dst_image_root, exist_ok=True)
 
-    annotation = mmcv.load(annotation_path)
+    index = AnnotationIndex(annotation_path, 'imgs', 'anns', 'imgToAnns')
     split = 'train' if 'train' in dst_label_filename else 'val'
 
-    process_img_with_path = partial(process_img, src_image_root=src_image_root, dst_image_root=dst_image_root)
-    tasks = []
-    for img_idx, img_info in enumerate(annotation['imgs'].values()):
-        if img_info['set'] != split:
-            continue
-        ann_ids = annotation['imgToAnns'][str(img_info['id'])]
-        anns = [annotation['anns'][str(ann_id)] for ann_id in ann_ids]
-        tasks.append((img_idx + img_start_idx, img_info, anns))
-
-    labels_list = mmcv.track_parallel_progress(process_img_with_path, tasks, keep_order=True, nproc=nproc)
-    final_labels = []
-    for label_list in labels_list:
-        final_labels += label_list
-    list_to_file(dst_label_file, final_labels)
-    return len(annotation['imgs'])
+    process_img_with_path = partial(
+        process_img,
+        index=index,
+        img_start_idx=img_start_idx,
+        split=split,
+        src_image_root=src_image_root,
+        dst_image_root=dst_image_root,
+        lossless=lossless,
+        max_slack=max_slack,
+    )
+    num_imgs = len(index)
+    _, labels = stream_crops(process_img_with_path, range(num_imgs), nproc, lmdb_path, num_imgs, gt=save_images)
+    if save_images:
+        list_to_file(dst_label_file, labels)
+    return num_imgs
 
 
 def main():
@@ -103,6 +133,10 @@ def main():
         dst_label_filename='train_label.txt',
         annotation_filename='cocotext.v2.json',
         nproc=args.n_proc,
+        lmdb_path=split_lmdb(args.lmdb_root, 'train'),
+        save_images=not args.no_images,
+        lossless=args.lossless_crop,
+        max_slack=args.max_slack,
     )
     print('Processing validation set...')
     convert_textocr(
@@ -112,6 +146,10 @@ def main():
         annotation_filename='cocotext.v2.json',
         img_start_idx=num_train_imgs,
         nproc=args.n_proc,
+        lmdb_path=split_lmdb(args.lmdb_root, 'val'),
+        save_images=not args.no_images,
+        lossless=args.lossless_crop,
+        max_slack=args.max_slack,
     )
     print('Finish')
 
@@ -1,156 +1,171 @@
+import argparse
+import ast
 import os
+import re
+from functools import partial
+
 import cv2
 import numpy as np
-import ast
-from pathlib import Path
-import tqdm
+
+from strhub.data.crop_writer import stream_crops
+
+# Format: x: [[...]], y: [[...]], ornt: [...], transcriptions: [...]
+# The coordinates are space separated (no commas), so they are split by hand rather than with ast.literal_eval.
+ANNOTATION = re.compile(r"x: \[\[([^\]]*)\]\], y: \[\[([^\]]*)\]\], ornt: \[[^\]]*\], transcriptions: \[(.*)\]")
+TRANSCRIPTION = re.compile(r"""u?('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
 
 def parse_line(line):
-    # Format: x: [[...]], y: [[...]], ornt: [...], transcriptions: [...]
-    # We want x, y, and transcriptions
-    
-    # Extract x
-    x_str = line.split('x: ')[1].split(']],')[0] + ']]'
-    # The string is like "[[1 2 3]]". 
-    # It might be space separated. ast.literal_eval might fail if it's "[[1 2 3]]" (no commas)
-    # So we manually parse it.
-    x_vals = x_str.replace('[', '').replace(']', '').strip().split()
-    x = [int(v) for v in x_vals]
-    
-    # Extract y
-    y_str = line.split('y: ')[1].split(']],')[0] + ']]'
-    y_vals = y_str.replace('[', '').replace(']', '').strip().split()
-    y = [int(v) for v in y_vals]
-    
-    # Extract transcription
-    # Find "transcriptions: "
-    trans_part = line.split('transcriptions: ')[1].strip()
-    # It is a list like [u'TEXT']
+    m = ANNOTATION.match(line)
+    if m is None:
+        raise ValueError(f"Unexpected annotation: {line}")
+    x = np.array(m.group(1).split(), np.int32)
+    y = np.array(m.group(2).split(), np.int32)
+    if len(x) != len(y) or not len(x):
+        raise ValueError(f"Mismatched polygon: {line}")
+
+    trans_part = m.group(3)
+    t = TRANSCRIPTION.match(trans_part)
     try:
-        trans = ast.literal_eval(trans_part)
-        text = trans[0]
-    except:
+        text = ast.literal_eval(t.group(1))
+    except (AttributeError, ValueError, SyntaxError):
         # Fallback if ast fails (e.g. complex string)
-        # Remove [u' and ']
-        text = trans_part[3:-2]
-        
+        # Remove u' and '
+        text = trans_part.lstrip('u')[1:-1]
+
     return x, y, text
 
-def crop_and_save(image_path, annotation_path, output_dir, gt_file):
-    if not os.path.exists(image_path):
-        print(f"Image not found: {image_path}")
-        return
 
-    try:
-        img = cv2.imread(image_path)
-        if img is None:
-            print(f"Failed to read image: {image_path}")
-            return
-    except Exception as e:
-        print(f"Error reading {image_path}: {e}")
-        return
+def polygon_boxes(polygons, width, height):
+    """Bounding boxes (x1, y1, x2, y2) of all polygons of an image, clipped to it, in one pass."""
+    lengths = np.array([len(x) for x, _ in polygons])
+    starts = np.concatenate([[0], np.cumsum(lengths[:-1])])
+    xs = np.concatenate([x for x, _ in polygons])
+    ys = np.concatenate([y for _, y in polygons])
+    boxes = np.stack(
+        [
+            np.minimum.reduceat(xs, starts),
+            np.minimum.reduceat(ys, starts),
+            np.maximum.reduceat(xs, starts) + 1,
+            np.maximum.reduceat(ys, starts) + 1,
+        ],
+        axis=1,
+    )
+    return np.clip(boxes, 0, [width, height, width, height])
 
+
+def crop_image(img_file, img_dir, anno_dir, output_dir=None, mask_background=False):
+    """Crop the words of one image. Returns a list of (crop name, JPEG bytes, label). Runs in the workers."""
+    image_path = os.path.join(img_dir, img_file)
+    base_name = os.path.splitext(img_file)[0]
+    # img1.jpg -> poly_gt_img1.txt
+    annotation_path = os.path.join(anno_dir, f"poly_gt_{base_name}.txt")
     if not os.path.exists(annotation_path):
         print(f"Annotation not found: {annotation_path}")
-        return
+        return []
 
+    words = []
     with open(annotation_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
+        for idx, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                xs, ys, text = parse_line(line)
+            except ValueError as e:
+                print(f"Error parsing line in {annotation_path}: {e}")
+                continue
+            if text == '#' or not text:
+                continue
+            words.append((idx, (xs, ys), text))
+    if not words:
+        return []
 
-    img_name = os.path.basename(image_path)
-    base_name = os.path.splitext(img_name)[0]
+    img = cv2.imread(image_path)
+    if img is None:
+        print(f"Failed to read image: {image_path}")
+        return []
 
-    for idx, line in enumerate(lines):
-        line = line.strip()
-        if not line:
-            continue
-        
-        try:
-            xs, ys, text = parse_line(line)
-        except Exception as e:
-            print(f"Error parsing line in {annotation_path}: {e}")
+    height, width = img.shape[:2]
+    boxes = polygon_boxes([polygon for _, polygon, _ in words], width, height)
+    crops = []
+    for (idx, (xs, ys), text), (x1, y1, x2, y2) in zip(words, boxes):
+        if x2 <= x1 or y2 <= y1:
             continue
+        crop = img[y1:y2, x1:x2]
+        if mask_background:
+            # Black out the pixels outside the polygon, e.g. neighbouring words in the box of a curved word
+            mask = np.zeros(crop.shape[:2], np.uint8)
+            cv2.fillPoly(mask, [np.stack([xs - x1, ys - y1], axis=1)], 255)
+            crop = cv2.bitwise_and(crop, crop, mask=mask)
 
-        if text == '#' or not text:
+        # Encode once, for the image file and/or the LMDB
+        crop_name = f"{base_name}_{idx}.jpg"
+        ok, crop_bin = cv2.imencode('.jpg', crop)
+        if not ok:
+            print(f"Failed to encode crop {crop_name}")
             continue
+        crop_bin = crop_bin.tobytes()
+        if output_dir is not None:
+            with open(os.path.join(output_dir, crop_name), 'wb') as f:
+                f.write(crop_bin)
+        crops.append((crop_name, crop_bin, text))
+    return crops
 
-        # Create polygon
-        pts = np.array(list(zip(xs, ys)), np.int32)
-        
-        # Bounding box
-        rect = cv2.boundingRect(pts)
-        x, y, w, h = rect
-        
-        # Crop
-        # Ensure within bounds
-        x = max(0, x)
-        y = max(0, y)
-        w = min(w, img.shape[1] - x)
-        h = min(h, img.shape[0] - y)
-        
-        if w <= 0 or h <= 0:
-            continue
-            
-        crop = img[y:y+h, x:x+w]
-        
-        # Save crop
-        crop_name = f"{base_name}_{idx}.jpg"
-        crop_path = os.path.join(output_dir, crop_name)
-        cv2.imwrite(crop_path, crop)
-        
-        # Write to GT
-        # GT format: relative_path label
-        # We will run create_lmdb_dataset.py with inputPath = output_dir
-        # So relative path is just crop_name
-        gt_file.write(f"{crop_name} {text}\n")
-
-def process_subset(subset_name, data_root, output_root):
+
+def process_subset(subset_name, data_root, output_root, lmdb_root=None, save_images=True, nproc=1,
+                   mask_background=False):
     # subset_name: 'Train' or 'Test'
-    # data_root: /data1/vivek/parseq/data/Total-Text
-    
+    # Images are in <data_root>/<subset>/imgX.jpg,
+    # annotations in <data_root>/Annotation/groundtruth_polygonal_annotation/<subset>/poly_gt_imgX.txt
     img_dir = os.path.join(data_root, subset_name)
-    # Note: Annotation dir structure is .../groundtruth_polygonal_annotation/{subset_name}
-    # But wait, looking at file list, it is .../groundtruth_polygonal_annotation/Test/poly_gt_img1.txt
-    # And image is .../Test/img1.jpg
-    
     anno_dir = os.path.join(data_root, 'Annotation', 'groundtruth_polygonal_annotation', subset_name)
-    
-    out_dir = os.path.join(output_root, subset_name)
-    os.makedirs(out_dir, exist_ok=True)
-    
-    gt_path = os.path.join(output_root, f"{subset_name}_gt.txt")
-    
-    # List images
+
+    out_dir = os.path.join(output_root, subset_name) if save_images else None
+    if save_images:
+        os.makedirs(out_dir, exist_ok=True)
+
     images = sorted([f for f in os.listdir(img_dir) if f.lower().endswith(('.jpg', '.png', '.jpeg'))])
-    
     print(f"Processing {subset_name}: {len(images)} images")
-    
-    with open(gt_path, 'w', encoding='utf-8') as gt_f:
-        for img_file in tqdm.tqdm(images):
-            img_path = os.path.join(img_dir, img_file)
-            
-            # Construct annotation filename
-            # img1.jpg -> poly_gt_img1.txt
-            # img10.jpg -> poly_gt_img10.txt
-            # img61.JPG -> poly_gt_img61.txt (case insensitive check needed?)
-            # The annotation files seem to be lowercase 'poly_gt_imgX.txt' or matching the number.
-            
-            name_part = os.path.splitext(img_file)[0]
-            # name_part is 'img1'
-            anno_file = f"poly_gt_{name_part}.txt"
-            anno_path = os.path.join(anno_dir, anno_file)
-            
-            # Check if anno file exists, if not try lowercase extension or something?
-            # The file list showed 'poly_gt_img1.txt'.
-            
-            crop_and_save(img_path, anno_path, out_dir, gt_f)
+
+    # The crops go straight into the LMDB, so create_lmdb_dataset.py doesn't have to read them back
+    crop = partial(crop_image, img_dir=img_dir, anno_dir=anno_dir, output_dir=out_dir,
+                   mask_background=mask_background)
+    lmdb_path = os.path.join(lmdb_root, subset_name) if lmdb_root else None
+    num_crops, labels = stream_crops(crop, images, nproc, lmdb_path, len(images), gt=save_images)
+
+    if save_images:
+        # GT format: <crop name> <label>, relative to <output_root>/<subset>
+        with open(os.path.join(output_root, f"{subset_name}_gt.txt"), 'w', encoding='utf-8') as gt_f:
+            gt_f.writelines(f"{line}\n" for line in labels)
+    print(f"{subset_name}: {num_crops} crops")
+
 
 def main():
-    data_root = '/data1/vivek/parseq/data/Total-Text'
-    output_root = '/data1/vivek/parseq/data/totaltext_crops'
-    
-    process_subset('Train', data_root, output_root)
-    process_subset('Test', data_root, output_root)
+    parser = argparse.ArgumentParser(description='Crop the words of Total-Text')
+    parser.add_argument('--data_root', required=True,
+                        help='Total-Text root, containing <subset>/ and Annotation/groundtruth_polygonal_annotation/')
+    parser.add_argument('--output_root',
+                        help='Write the crops to <output_root>/<subset>/ and <output_root>/<subset>_gt.txt')
+    parser.add_argument('--lmdb_root', help='Also write the crops of each subset to an LMDB in this directory')
+    parser.add_argument('--no_images', action='store_true',
+                        help='Do not write the crops as image files (requires --lmdb_root)')
+    parser.add_argument('--subsets', nargs='+', default=['Train', 'Test'])
+    parser.add_argument('--n_proc', type=int, default=os.cpu_count(), help='Number of processes to run')
+    parser.add_argument('--mask_background', action='store_true',
+                        help='Black out the pixels of each crop that are outside the word polygon')
+    args = parser.parse_args()
+    if args.no_images and not args.lmdb_root:
+        parser.error('--no_images requires --lmdb_root')
+    if not args.no_images and not args.output_root:
+        parser.error('--output_root is required unless --no_images is given')
+
+    # One image per process; OpenCV's own threads would only compete with the other workers
+    cv2.setNumThreads(1)
+    for subset in args.subsets:
+        process_subset(subset, args.data_root, args.output_root, args.lmdb_root, not args.no_images, args.n_proc,
+                       args.mask_background)
+
 
 if __name__ == '__main__':
     main()
@@ -2,12 +2,17 @@
 """a modified version of CRNN torch repository https://github.com/bgshih/crnn/blob/master/tool/create_dataset.py"""
 import io
 import os
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 
 import fire
-import lmdb
 import numpy as np
 from PIL import Image
 
+from strhub.data.image_header import check_image
+from strhub.data.lmdb_utils import LmdbWriter
+
 
 def checkImageIsValid(imageBin):
     if imageBin is None:
@@ -16,13 +21,36 @@ def checkImageIsValid(imageBin):
     return np.prod(img.size) > 0
 
 
-def writeCache(env, cache):
-    with env.begin(write=True) as txn:
-        for k, v in cache.items():
-            txn.put(k, v)
+def loadSample(line, inputPath, checkValid, fullDecode):
+    """Read (and optionally validate) one gt line. Runs in the worker processes."""
+    imagePath, label = line.strip().split(maxsplit=1)
+    imagePath = os.path.join(inputPath, imagePath)
+    with open(imagePath, 'rb') as f:
+        imageBin = f.read()
+    size = None
+    if checkValid:
+        try:
+            size = check_image(imageBin, fullDecode)
+        except IOError as e:
+            return imagePath, None, label, e
+    return imagePath, imageBin, label, size
+
+
+def iterChunks(f, size, offset=0):
+    """Yield chunks of (line, byte offset after the line) from a binary file, starting at `offset`."""
+    f.seek(offset)
+    it = iter(f)
+    while chunk := list(islice(it, size)):
+        lines = []
+        for raw in chunk:
+            offset += len(raw)
+            lines.append((raw.decode('utf-8'), offset))
+        yield lines
 
 
-def createDataset(inputPath, gtFile, outputPath, checkValid=True):
+def createDataset(
+    inputPath, gtFile, outputPath, checkValid=True, fullDecode=False, numWorkers=None, chunkSize=4096, append=False
+):
     """
     Create LMDB dataset for training and evaluation.
     ARGS:
@@ -30,47 +58,53 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
         outputPath : LMDB output path
         gtFile     : list of image path and label
         checkValid : if true, check the validity of every image
+        fullDecode : if true, fully decode every image during validation instead of only checking its header
+        numWorkers : number of processes used to read and validate images (default: all CPUs)
+        chunkSize  : number of gt lines handed out to the pool at a time
+        append     : if true, add the samples after those already in outputPath. An interrupted build (appending or
+                     not) of the same gtFile resumes from its last checkpoint when re-run with append.
     """
-    os.makedirs(outputPath, exist_ok=True)
-    env = lmdb.open(outputPath, map_size=1099511627776)
-
-    cache = {}
-    cnt = 1
-
-    with open(gtFile, 'r', encoding='utf-8') as f:
-        data = f.readlines()
+    with open(gtFile, 'rb') as f:
+        nSamples = sum(chunk.count(b'\n') for chunk in iter(partial(f.read, 1 << 20), b''))
 
-    nSamples = len(data)
-    for i, line in enumerate(data):
-        imagePath, label = line.strip().split(maxsplit=1)
-        imagePath = os.path.join(inputPath, imagePath)
-        with open(imagePath, 'rb') as f:
-            imageBin = f.read()
-        if checkValid:
-            try:
-                img = Image.open(io.BytesIO(imageBin)).convert('RGB')
-            except IOError as e:
-                with open(outputPath + '/error_image_log.txt', 'a') as log:
-                    log.write('{}-th image data occured error: {}, {}\n'.format(i, imagePath, e))
-                continue
-            if np.prod(img.size) == 0:
-                print('%s is not a valid image' % imagePath)
-                continue
+    source = os.path.abspath(gtFile)
+    load = partial(loadSample, inputPath=inputPath, checkValid=checkValid, fullDecode=fullDecode)
+    with open(gtFile, 'rb') as f, Pool(numWorkers) as pool, LmdbWriter(outputPath, append=append) as writer:
+        progress = writer.get_progress(source) or {'offset': 0, 'lines': 0}
+        if progress.get('done'):
+            print('%s has already been added to %s' % (gtFile, outputPath))
+            return
+        if progress['lines']:
+            print('Resuming from line %d' % progress['lines'])
+        i = progress['lines']
 
-        imageKey = 'image-%09d'.encode() % cnt
-        labelKey = 'label-%09d'.encode() % cnt
-        cache[imageKey] = imageBin
-        cache[labelKey] = label.encode()
+        def write(results, offsets):
+            nonlocal i
+            for (imagePath, imageBin, label, status), offset in zip(results, offsets):
+                if imageBin is None:
+                    with open(outputPath + '/error_image_log.txt', 'a') as log:
+                        log.write('{}-th image data occured error: {}, {}\n'.format(i, imagePath, status))
+                elif status is not None and np.prod(status) == 0:
+                    print('%s is not a valid image' % imagePath)
+                else:
+                    cnt = writer.write(imageBin, label, path=imagePath, size=status)
+                    if cnt % 1000 == 0:
+                        print('Written %d / %d' % (cnt, nSamples))
+                i += 1
+                writer.set_progress(source, {'offset': offset, 'lines': i})
 
-        if cnt % 1000 == 0:
-            writeCache(env, cache)
-            cache = {}
-            print('Written %d / %d' % (cnt, nSamples))
-        cnt += 1
-    nSamples = cnt - 1
-    cache['num-samples'.encode()] = str(nSamples).encode()
-    writeCache(env, cache)
-    env.close()
+        # Keep one chunk in flight while the previous one is written, which bounds memory to two chunks of images.
+        pending = None
+        for chunk in iterChunks(f, chunkSize, progress['offset']):
+            lines, offsets = zip(*chunk)
+            result = pool.map_async(load, lines, chunksize=64)
+            if pending is not None:
+                write(pending[0].get(), pending[1])
+            pending = result, offsets
+        if pending is not None:
+            write(pending[0].get(), pending[1])
+        writer.set_progress(source, {'offset': f.tell(), 'lines': i, 'done': True})
+        nSamples = writer.num_samples
     print('Created dataset with %d samples' % nSamples)
 
 
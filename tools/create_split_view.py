@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Create a view (see strhub.data.split_view) of LMDB datasets: all their samples, or a random subset of them.
+
+Nothing is copied, so subsets and debug samples are created instantly. With --sample, the subset is stratified by
+source: each input contributes in proportion to its size.
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+
+from strhub.data.lmdb_utils import open_readonly, read_num_samples
+from strhub.data.split_view import write_view
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to input LMDBs')
+    parser.add_argument('--output', required=True, help='Path to the output view')
+    parser.add_argument('--sample', type=int, help='Number of samples to draw (default: all samples)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = []
+    for lmdb_in in args.inputs:
+        with open_readonly(lmdb_in) as env:
+            sizes.append(read_num_samples(env))
+    total = sum(sizes)
+    sample = total if args.sample is None else min(args.sample, total)
+
+    rng = np.random.default_rng(args.seed)
+    # Largest remainder apportionment of the sample among the inputs
+    quotas = np.asarray(sizes, dtype=np.float64) * sample / max(total, 1)
+    counts = np.floor(quotas).astype(np.int64)
+    counts[np.argsort(counts - quotas)[: sample - counts.sum()]] += 1
+    source_ids, indices = [], []
+    for source, (size, count) in enumerate(zip(sizes, counts)):
+        # Sorted, so that reading the view walks each source in key order
+        chosen = np.sort(rng.choice(size, count, replace=False)) + 1 if count < size else np.arange(1, size + 1)
+        source_ids.append(np.full(len(chosen), source))
+        indices.append(chosen)
+    write_view(args.output, args.inputs, np.concatenate(source_ids), np.concatenate(indices))
+    for lmdb_in, size, count in zip(args.inputs, sizes, counts):
+        print(f'{lmdb_in}: {count} of {size} samples')
+    print(f'Wrote a view of {sample} samples to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Convert LMDB datasets into one pre-decoded, pre-resized tensor store (see strhub.data.tensor_store)."""
+import io
+import os
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool
+
+from PIL import Image
+
+from strhub.data.lmdb_utils import get_image, label_key, open_readonly, read_num_samples
+from strhub.data.tensor_store import TensorStoreWriter, resize
+
+_env = None
+_images = None
+
+
+def _init_worker(lmdb_path, root, num_samples, img_size):
+    global _env, _images
+    _env = open_readonly(lmdb_path)
+    _images = TensorStoreWriter.open_images(root, num_samples, img_size)
+
+
+def _convert(chunk, offset, img_size):
+    """Decode and resize the index range straight into the store. Runs in the workers."""
+    start, end = chunk
+    labels, sizes, invalid = [], [], []
+    with _env.begin(buffers=True) as txn:
+        for index in range(start, end + 1):
+            label = txn.get(label_key(index))
+            labels.append(bytes(label).decode() if label is not None else '')
+            try:
+                if label is None:
+                    raise ValueError(f'sample {index} has no label')
+                img = Image.open(io.BytesIO(get_image(txn, index)))
+                sizes.append(img.size)
+                _images[offset + index - 1] = resize(img, img_size)
+            except (IOError, ValueError, TypeError):
+                # Invalid images and samples without a label are both marked invalid
+                sizes.append((0, 0))
+                invalid.append(offset + index)
+    _images.flush()
+    return labels, sizes, invalid
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to input LMDBs. Their samples are concatenated.')
+    parser.add_argument('--output', required=True, help='Path to the output store')
+    parser.add_argument('--img_size', type=int, nargs=2, default=[32, 128], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=2000, help='Number of samples per work item')
+    args = parser.parse_args()
+
+    # Only read the sizes here: the LMDBs must not be open when the workers are forked.
+    sizes = []
+    for lmdb_in in args.inputs:
+        with open_readonly(lmdb_in) as env:
+            sizes.append(read_num_samples(env))
+    num_samples = sum(sizes)
+    img_size = tuple(args.img_size)
+    writer = TensorStoreWriter(args.output, num_samples, img_size, [os.path.abspath(p) for p in args.inputs])
+
+    labels, image_sizes, invalid = [], [], []
+    offset = 0
+    for lmdb_in, size in zip(args.inputs, sizes):
+        chunks = [(start, min(start + args.chunk_size - 1, size)) for start in range(1, size + 1, args.chunk_size)]
+        init_args = (lmdb_in, args.output, num_samples, img_size)
+        with Pool(args.num_workers, _init_worker, init_args) as pool:
+            for chunk_labels, chunk_sizes, chunk_invalid in pool.imap(
+                partial(_convert, offset=offset, img_size=img_size), chunks
+            ):
+                labels += chunk_labels
+                image_sizes += chunk_sizes
+                invalid += chunk_invalid
+        offset += size
+        print(f'Converted {size} samples of {lmdb_in}')
+    writer.finish(labels, image_sizes, invalid)
+
+    print(
+        f'Wrote {num_samples} images of size {img_size[0]}x{img_size[1]} to {args.output}'
+        f' ({num_samples * img_size[0] * img_size[1] * 3 / 1024**2:.1f} MB)'
+    )
+    if invalid:
+        print(f'{len(invalid)} samples have no label or an undecodable image and will be skipped by TensorStoreDataset')
+
+
+if __name__ == '__main__':
+    main()
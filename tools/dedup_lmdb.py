@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Rewrite LMDB datasets in the deduplicated layout (see strhub.data.lmdb_utils), or back to the standard one.
+
+In the deduplicated layout, the bytes of each distinct image are stored once, under their content hash; samples
+refer to them by hash. The inputs are concatenated, so images shared between them (e.g. overlapping scenes of two
+datasets) are stored once as well. Labels, image paths and the metadata sidecar are carried over unchanged.
+"""
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from strhub.data.lmdb_utils import LmdbWriter, iter_images, label_key, open_readonly, read_num_samples, used_bytes
+from strhub.data.metadata import SampleMetadata
+
+
+def copy_samples(writer: LmdbWriter, lmdb_path: str) -> int:
+    """Append all samples of the LMDB to the writer. Returns the number of samples copied."""
+    meta = SampleMetadata(lmdb_path) if SampleMetadata.exists(lmdb_path) else None
+    with open_readonly(lmdb_path) as env, env.begin() as txn:
+        num_samples = read_num_samples(env)
+        copied = 0
+        for index, image_bin in tqdm(iter_images(txn, 1, num_samples), total=num_samples, desc=lmdb_path):
+            image_path = txn.get(f'imagepath-{index:09d}'.encode())
+            path = image_path.decode() if image_path is not None else None
+            size = None
+            if meta is not None:
+                path = meta.path(index) or path
+                size = (int(meta.width[index - 1]), int(meta.height[index - 1]))
+            new_index = writer.write(image_bin, txn.get(label_key(index)), path, size)
+            if image_path is not None:
+                writer.put(f'imagepath-{new_index:09d}'.encode(), image_path)
+            copied += 1
+    return copied
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to input LMDBs, in either layout')
+    parser.add_argument('--output', required=True, help='Path to output LMDB. Any existing content is replaced.')
+    parser.add_argument('--expand', action='store_true', help='Write the standard image-%%09d layout instead')
+    parser.add_argument('--no_metadata', action='store_true', help='Do not write the metadata sidecar')
+    args = parser.parse_args()
+
+    in_bytes = 0
+    for lmdb_in in args.inputs:
+        with open_readonly(lmdb_in) as env:
+            in_bytes += used_bytes(env)
+    with LmdbWriter(args.output, metadata=not args.no_metadata, dedup=not args.expand) as writer:
+        for lmdb_in in args.inputs:
+            copied = copy_samples(writer, lmdb_in)
+            print(f'Copied {copied} samples of {lmdb_in}')
+        writer.commit()
+        num_samples = writer.num_samples
+        out_bytes = used_bytes(writer.env)
+        if not args.expand:
+            print(
+                f'{writer.num_duplicates} of {num_samples} images were duplicates'
+                f' ({writer.duplicate_bytes / 1024**2:.1f} MB not stored again)'
+            )
+    print(
+        f'Wrote {num_samples} samples to {args.output}: {out_bytes / 1024**2:.1f} MB'
+        f' (inputs: {in_bytes / 1024**2:.1f} MB)'
+    )
+
+
+if __name__ == '__main__':
+    main()
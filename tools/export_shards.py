@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Export LMDB datasets as size-bounded tar shards (see strhub.data.shards), for training with sequential reads only.
+
+The inputs are read in key order and their samples concatenated; images are copied byte-for-byte. Load the result
+with `strhub.data.shard_dataset.ShardDataset`, which shuffles at the shard level and through a buffer.
+"""
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from strhub.data.lmdb_utils import iter_images, label_key, open_readonly, read_num_samples
+from strhub.data.shards import ShardWriter
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to input LMDBs')
+    parser.add_argument('--output', required=True, help='Path to the output directory')
+    parser.add_argument('--shard_size', type=float, default=256, help='Maximum size of a shard, in MB')
+    args = parser.parse_args()
+
+    num_skipped = 0
+    with ShardWriter(args.output, int(args.shard_size * 1024**2), args.inputs) as writer:
+        for lmdb_in in args.inputs:
+            with open_readonly(lmdb_in) as env, env.begin(buffers=True) as txn:
+                num_samples = read_num_samples(env)
+                for index, image_bin in tqdm(iter_images(txn, 1, num_samples), total=num_samples, desc=lmdb_in):
+                    # Copy the image: with buffers=True, it is only valid until the next read
+                    image_bin = bytes(image_bin)
+                    label = txn.get(label_key(index))
+                    if label is None:
+                        num_skipped += 1
+                        continue
+                    writer.write(image_bin, bytes(label).decode())
+        writer.finish()
+    mb = sum(shard['bytes'] for shard in writer.shards) / 1024**2
+    print(f'Wrote {writer.num_samples} samples in {len(writer.shards)} shards to {args.output} ({mb:.1f} MB)')
+    if num_skipped:
+        print(f'Skipped {num_skipped} samples without a label')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,55 +2,197 @@
 import io
 import os
 from argparse import ArgumentParser
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
 
-import lmdb
 import numpy as np
 from PIL import Image
 
+from strhub.data.image_header import get_image_size
+from strhub.data.lmdb_utils import LmdbWriter, get_image, iter_images, label_key, open_readonly, read_num_samples
+from strhub.data.metadata import CHARSETS, SampleMetadata, normalize_label
+
+
+class SampleFilter:
+    """Predicates on the image size, (normalized) label and encoded size of a sample."""
+
+    def __init__(
+        self,
+        min_image_dim=0,
+        min_label_length=0,
+        max_label_length=None,
+        charset=None,
+        min_aspect_ratio=None,
+        max_aspect_ratio=None,
+        max_bytes=None,
+    ):
+        self.min_image_dim = min_image_dim
+        self.min_label_length = min_label_length
+        self.max_label_length = max_label_length
+        self.charset = CHARSETS.get(charset, charset)
+        self.min_aspect_ratio = min_aspect_ratio
+        self.max_aspect_ratio = max_aspect_ratio
+        self.max_bytes = max_bytes
+
+    def _in_charset(self, label):
+        if self.charset == self.charset.lower():
+            label = label.lower()
+        return set(label).issubset(self.charset)
+
+    def __call__(self, w, h, label, num_bytes):
+        if w < self.min_image_dim or h < self.min_image_dim:
+            return False
+        if self.max_bytes is not None and num_bytes > self.max_bytes:
+            return False
+        aspect_ratio = w / max(h, 1)
+        if self.min_aspect_ratio is not None and aspect_ratio < self.min_aspect_ratio:
+            return False
+        if self.max_aspect_ratio is not None and aspect_ratio > self.max_aspect_ratio:
+            return False
+        if self.min_label_length or self.max_label_length is not None or self.charset:
+            label = normalize_label(label)
+            if len(label) < self.min_label_length:
+                return False
+            if self.max_label_length is not None and len(label) > self.max_label_length:
+                return False
+            if self.charset and not self._in_charset(label):
+                return False
+        return True
+
+    def select(self, meta: SampleMetadata) -> np.ndarray:
+        """Vectorized version of the predicates over the metadata sidecar. Returns the 1-based indices to keep."""
+        w = meta.width.astype(np.float64)
+        h = meta.height.astype(np.float64)
+        keep = (w >= self.min_image_dim) & (h >= self.min_image_dim)
+        keep &= meta.label_length >= self.min_label_length
+        if self.max_label_length is not None:
+            keep &= meta.label_length <= self.max_label_length
+        if self.max_bytes is not None:
+            keep &= meta.num_bytes <= self.max_bytes
+        aspect_ratio = w / np.maximum(h, 1)
+        if self.min_aspect_ratio is not None:
+            keep &= aspect_ratio >= self.min_aspect_ratio
+        if self.max_aspect_ratio is not None:
+            keep &= aspect_ratio <= self.max_aspect_ratio
+        if self.charset:
+            bit = meta.charset_bit(self.charset)
+            if bit is not None:
+                keep &= (meta.charsets & bit) != 0
+            else:
+                for i in np.flatnonzero(keep):
+                    keep[i] = self._in_charset(meta.label(i + 1))
+        return np.flatnonzero(keep) + 1
+
+
+# Inputs opened by this worker, by path. The workers are started before any LMDB is opened, and open each input lazily.
+_envs = {}
+
+
+def _scan(chunk, lmdb_path, sample_filter):
+    """Return the samples of the index range which pass the filter, with their image sizes. Runs in the workers.
+
+    Samples without an image or without a label are skipped.
+    """
+    start, end = chunk
+    if lmdb_path not in _envs:
+        _envs[lmdb_path] = open_readonly(lmdb_path)
+    accepted = []
+    with _envs[lmdb_path].begin(buffers=True) as txn:
+        for index, image_bin in iter_images(txn, start, end):
+            num_bytes = len(image_bin)
+            size = get_image_size(image_bin) or Image.open(io.BytesIO(image_bin)).size
+            # image_bin is only valid until this read
+            label = txn.get(label_key(index))
+            if label is not None and sample_filter(*size, bytes(label).decode(), num_bytes):
+                accepted.append((index, size))
+    return end, accepted
+
 
 def main():
     parser = ArgumentParser()
     parser.add_argument('inputs', nargs='+', help='Path to input LMDBs')
     parser.add_argument('--output', help='Path to output LMDB')
     parser.add_argument('--min_image_dim', type=int, default=8)
+    parser.add_argument('--min_label_length', type=int, default=0, help='Minimum length of the normalized label')
+    parser.add_argument('--max_label_length', type=int, help='Maximum length of the normalized label')
+    parser.add_argument(
+        '--charset',
+        help=f'Keep only labels fully within this charset. Either one of {list(CHARSETS)} or the characters',
+    )
+    parser.add_argument('--min_aspect_ratio', type=float, help='Minimum width / height')
+    parser.add_argument('--max_aspect_ratio', type=float, help='Maximum width / height')
+    parser.add_argument('--max_bytes', type=int, help='Maximum size of the encoded image')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Number of samples per work item')
+    parser.add_argument(
+        '--append',
+        action='store_true',
+        help='Add to the samples already in the output LMDB, resuming any input which was only partially processed',
+    )
     args = parser.parse_args()
 
-    os.makedirs(args.output, exist_ok=True)
-    with lmdb.open(args.output, map_size=1099511627776) as env_out:
+    sample_filter = SampleFilter(
+        args.min_image_dim,
+        args.min_label_length,
+        args.max_label_length,
+        args.charset,
+        args.min_aspect_ratio,
+        args.max_aspect_ratio,
+        args.max_bytes,
+    )
+    has_metadata = {lmdb_in: SampleMetadata.exists(lmdb_in) for lmdb_in in args.inputs}
+    # Start the workers before opening any LMDB here, the output included: an LMDB environment must not be inherited
+    # through fork. They are only needed for inputs without a metadata sidecar.
+    pool = nullcontext() if all(has_metadata.values()) else Pool(args.num_workers)
+    with pool, LmdbWriter(args.output, append=args.append) as writer:
         in_samples = 0
-        out_samples = 0
-        samples_per_chunk = 1000
+        start_samples = writer.num_samples
         for lmdb_in in args.inputs:
-            with lmdb.open(lmdb_in, readonly=True, max_readers=1, lock=False) as env_in:
-                with env_in.begin() as txn:
-                    num_samples = int(txn.get('num-samples'.encode()))
-                in_samples += num_samples
-                chunks = np.array_split(range(num_samples), num_samples // samples_per_chunk)
-                for chunk in chunks:
-                    cache = {}
-                    with env_in.begin() as txn:
-                        for index in chunk:
-                            index += 1  # lmdb starts at 1
-                            image_key = f'image-{index:09d}'.encode()
-                            image_bin = txn.get(image_key)
-                            img = Image.open(io.BytesIO(image_bin))
-                            w, h = img.size
-                            if w < args.min_image_dim or h < args.min_image_dim:
-                                print(f'Skipping: {index}, w = {w}, h = {h}')
-                                continue
-                            out_samples += 1  # increment. start at 1
-                            label_key = f'label-{index:09d}'.encode()
-                            out_label_key = f'label-{out_samples:09d}'.encode()
-                            out_image_key = f'image-{out_samples:09d}'.encode()
-                            cache[out_label_key] = txn.get(label_key)
-                            cache[out_image_key] = image_bin
-                    with env_out.begin(write=True) as txn:
-                        for k, v in cache.items():
-                            txn.put(k, v)
-                    print(f'Written samples from {chunk[0]} to {chunk[-1]}')
-        with env_out.begin(write=True) as txn:
-            txn.put('num-samples'.encode(), str(out_samples).encode())
-        print(f'Written {out_samples} samples to {args.output} out of {in_samples} input samples.')
+            source = os.path.abspath(lmdb_in)
+            progress = writer.get_progress(source) or {'index': 0}
+            if progress.get('done'):
+                print(f'Skipping {lmdb_in}: already added to {args.output}')
+                continue
+            if progress['index']:
+                print(f'Resuming {lmdb_in} from sample {progress["index"] + 1}')
+            with open_readonly(lmdb_in) as env_in, env_in.begin() as txn:
+                num_samples = read_num_samples(env_in)
+                in_samples += num_samples - progress['index']
+
+                def copy(accepted, meta=None):
+                    for index, size in accepted:
+                        image_bin, label = get_image(txn, index), txn.get(label_key(index))
+                        if image_bin is None or label is None:
+                            continue
+                        path = (meta.path(index) or None) if meta is not None else None
+                        writer.write(image_bin, label, path, size)
+                        writer.set_progress(source, {'index': index})
+
+                if has_metadata[lmdb_in]:
+                    # Everything needed is in the metadata sidecar. The images are not even decoded.
+                    meta = SampleMetadata(lmdb_in, env_in)
+                    indices = sample_filter.select(meta)
+                    indices = indices[indices > progress['index']]
+                    sizes = zip(meta.width[indices - 1].tolist(), meta.height[indices - 1].tolist())
+                    copy(zip(indices.tolist(), sizes), meta)
+                    print(f'Kept {len(indices)} samples of {lmdb_in} based on its metadata')
+                else:
+                    chunks = [
+                        (start, min(start + args.chunk_size - 1, num_samples))
+                        for start in range(progress['index'] + 1, num_samples + 1, args.chunk_size)
+                    ]
+                    scan = partial(_scan, lmdb_path=lmdb_in, sample_filter=sample_filter)
+                    for end, accepted in pool.imap(scan, chunks):
+                        copy(accepted)
+                        writer.set_progress(source, {'index': end})
+                        print(f'Filtered samples up to {end} / {num_samples}')
+            writer.set_progress(source, {'index': num_samples, 'done': True})
+        out_samples = writer.num_samples
+    print(
+        f'Written {out_samples - start_samples} samples to {args.output} out of {in_samples} input samples.'
+        f' The output now has {out_samples} samples.'
+    )
 
 
 if __name__ == '__main__':
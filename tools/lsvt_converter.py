@@ -8,27 +8,43 @@ from functools import partial
 import mmcv
 import numpy as np
 from mmocr.utils.fileio import list_to_file
-from PIL import Image
+
+from strhub.data.crop_writer import SceneImage, save_crop, split_lmdb, stream_crops
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Generate training set of LSVT ' 'by cropping box image.')
     parser.add_argument('root_path', help='Root dir path of LSVT')
     parser.add_argument('n_proc', default=1, type=int, help='Number of processes to run')
+    parser.add_argument('--lmdb_root', help='Also write the crops of each split to an LMDB in this directory')
+    parser.add_argument(
+        '--no_images', action='store_true', help='Do not write the crops as image files (requires --lmdb_root)'
+    )
+    parser.add_argument(
+        '--lossless_crop', action='store_true', help='Cut crops in the DCT domain when possible (needs PyTurboJPEG)'
+    )
+    parser.add_argument(
+        '--max_slack',
+        type=int,
+        default=0,
+        help='With --lossless_crop, keep up to this many extra pixels left of and above a crop instead of trimming',
+    )
     args = parser.parse_args()
+    if args.no_images and not args.lmdb_root:
+        parser.error('--no_images requires --lmdb_root')
     return args
 
 
-def process_img(args, src_image_root, dst_image_root):
+def process_img(args, src_image_root, dst_image_root, lossless=False, max_slack=0):
     # Dirty hack for multiprocessing
     img_idx, img_info, anns = args
     try:
-        src_img = Image.open(osp.join(src_image_root, 'train_full_images_0/{}.jpg'.format(img_info)))
+        src = SceneImage(osp.join(src_image_root, 'train_full_images_0/{}.jpg'.format(img_info)), lossless, max_slack)
     except IOError:
-        src_img = Image.open(osp.join(src_image_root, 'train_full_images_1/{}.jpg'.format(img_info)))
+        src = SceneImage(osp.join(src_image_root, 'train_full_images_1/{}.jpg'.format(img_info)), lossless, max_slack)
     blacklist = ['LOFTINESS*']
     whitelist = ['#Find YOUR Fun#', 'Story #', '*0#']
-    labels = []
+    crops = []
     for ann_idx, ann in enumerate(anns):
         text_label = ann['transcription']
 
@@ -45,17 +61,27 @@ def process_img(args, src_image_root, dst_image_root):
         x1, y1 = points.min(axis=0)
         x2, y2 = points.max(axis=0)
 
-        dst_img = src_img.crop((x1, y1, x2, y2))
+        image_bin = src.crop((x1, y1, x2, y2))
+        if image_bin is None:
+            continue
         dst_img_name = f'img_{img_idx}_{ann_idx}.jpg'
-        dst_img_path = osp.join(dst_image_root, dst_img_name)
-        # Preserve JPEG quality
-        dst_img.save(dst_img_path, qtables=src_img.quantization)
-        labels.append(f'{osp.basename(dst_image_root)}/{dst_img_name}' f' {text_label}')
-    src_img.close()
-    return labels
-
-
-def convert_lsvt(root_path, dst_image_path, dst_label_filename, annotation_filename, img_start_idx=0, nproc=1):
+        crops.append((save_crop(image_bin, dst_image_root, dst_img_name), image_bin, text_label))
+    src.close()
+    return crops
+
+
+def convert_lsvt(
+    root_path,
+    dst_image_path,
+    dst_label_filename,
+    annotation_filename,
+    img_start_idx=0,
+    nproc=1,
+    lmdb_path=None,
+    save_images=True,
+    lossless=False,
+    max_slack=0,
+):
     annotation_path = osp.join(root_path, annotation_filename)
     if not osp.exists(annotation_path):
         raise Exception(f'{annotation_path} not exists, please check and try again.')
@@ -63,8 +89,9 @@ def convert_lsvt(root_path, dst_image_path, dst_label_filename, annotation_filen
 
     # outputs
     dst_label_file = osp.join(root_path, dst_label_filename)
-    dst_image_root = osp.join(root_path, dst_image_path)
-    os.makedirs(dst_image_root, exist_ok=True)
+    dst_image_root = osp.join(root_path, dst_image_path) if save_images else None
+    if save_images:
+        os.makedirs(dst_image_root, exist_ok=True)
 
     annotation = mmcv.load(annotation_path)
 
@@ -72,11 +99,9 @@ def convert_lsvt(root_path, dst_image_path, dst_label_filename, annotation_filen
     tasks = []
     for img_idx, (img_info, anns) in enumerate(annotation.items()):
         tasks.append((img_idx + img_start_idx, img_info, anns))
-    labels_list = mmcv.track_parallel_progress(process_img_with_path, tasks, keep_order=True, nproc=nproc)
-    final_labels = []
-    for label_list in labels_list:
-        final_labels += label_list
-    list_to_file(dst_label_file, final_labels)
+    _, labels = stream_crops(process_img_with_path, tasks, nproc, lmdb_path, len(tasks), gt=save_images)
+    if save_images:
+        list_to_file(dst_label_file, labels)
     return len(annotation)
 
 
@@ -90,6 +115,10 @@ def main():
         dst_label_filename='train_label.txt',
         annotation_filename='train_full_labels.json',
         nproc=args.n_proc,
+        lmdb_path=split_lmdb(args.lmdb_root, 'train'),
+        save_images=not args.no_images,
+        lossless=args.lossless_crop,
+        max_slack=args.max_slack,
     )
     print('Finish')
 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Merge LMDB datasets into one compact, densely numbered LMDB without decoding any image.
+
+Values are copied raw, reading each source sequentially with a cursor and writing in global key order with
+MDB_APPEND, which fills every B-tree page. The result is a single contiguous file which is usually smaller than the
+sum of its sources and reads sequentially faster than several scattered ones. Merging a single source compacts it.
+
+Deduplicated LMDBs (see strhub.data.lmdb_utils) can be merged too: their image blobs are merged by content hash, so
+an image shared by several sources is stored once in the output.
+"""
+import heapq
+import os
+import shutil
+import zlib
+from argparse import ArgumentParser
+from operator import itemgetter
+
+import lmdb
+import numpy as np
+
+from strhub.data.lmdb_utils import (
+    BLOB_PREFIX,
+    BUILD_ID_KEY,
+    CHECKSUM_PREFIX,
+    CONFIDENCE_PREFIX,
+    IMAGE_REF_PREFIX,
+    MANIFEST_KEY,
+    NUM_SAMPLES_KEY,
+    make_manifest,
+    open_readonly,
+    read_manifest,
+    read_num_samples,
+    used_bytes,
+)
+from strhub.data.metadata import METADATA_DIR, SampleMetadata, merge_metadata
+
+# Per-sample keys, in sorted order
+PREFIXES = (CONFIDENCE_PREFIX, CHECKSUM_PREFIX, b'image-', b'imagepath-', IMAGE_REF_PREFIX, b'label-')
+
+
+def merge_order(sizes, interleave=False):
+    """Return the (source, 1-based index) of each output sample.
+
+    Sources are concatenated, or interleaved so that each is spread evenly across the output.
+    """
+    sources = np.repeat(np.arange(len(sizes)), sizes)
+    indices = np.concatenate([np.arange(1, n + 1) for n in sizes]) if sizes else np.empty(0, np.int64)
+    if interleave:
+        order = np.argsort((indices - 0.5) / np.repeat(np.maximum(sizes, 1), sizes), kind='stable')
+        sources, indices = sources[order], indices[order]
+    return sources, indices
+
+
+def iter_prefix(txn, prefix, out_index):
+    """Yield (output index, raw value) of the source keys with the given prefix, in key order."""
+    cursor = txn.cursor()
+    if not cursor.set_range(prefix):
+        return
+    for key, value in cursor:
+        key = bytes(key)
+        if not key.startswith(prefix):
+            break
+        suffix = key[len(prefix) :]
+        if suffix.isdigit():
+            yield out_index[int(suffix) - 1], value
+
+
+def iter_blobs(txn):
+    """Yield (key, raw value) of the image blobs of a deduplicated source, in key order."""
+    cursor = txn.cursor()
+    if not cursor.set_range(BLOB_PREFIX):
+        return
+    for key, value in cursor:
+        key = bytes(key)
+        if not key.startswith(BLOB_PREFIX):
+            break
+        yield key, value
+
+
+def put_batch(env, batch):
+    """Append the sorted batch in one transaction, growing the map in the unlikely case the estimate was short."""
+    while True:
+        try:
+            with env.begin(write=True) as txn:
+                txn.cursor().putmulti(batch, append=True)
+            return
+        except lmdb.MapFullError:
+            env.set_mapsize(int(env.info()['map_size'] * 1.25))
+
+
+def merge_lmdbs(inputs, output, interleave=False, commit_bytes=1024**3, metadata=True):
+    envs = [open_readonly(path) for path in inputs]
+    try:
+        sizes = [read_num_samples(env) for env in envs]
+        # The per-sample checksums are copied along. The output has a manifest only if they cover all samples.
+        checksums = all(read_manifest(env) is not None for env in envs)
+        sources, indices = merge_order(sizes, interleave)
+        out_index = [np.flatnonzero(sources == s) + 1 for s in range(len(inputs))]
+        # With MDB_APPEND the pages are filled completely, so the output never takes more space than the sources.
+        # Only the tree roots and the meta pages are extra, hence the small fixed margin.
+        in_bytes = sum(used_bytes(env) for env in envs)
+        map_size = in_bytes + 16 * 1024**2
+        os.makedirs(output, exist_ok=True)
+        with lmdb.open(output, map_size=map_size, meminit=False, sync=False) as env_out:
+            with env_out.begin(write=True) as txn_out:
+                txn_out.drop(env_out.open_db(), delete=False)
+            txns = [env.begin(buffers=True) for env in envs]
+            try:
+                # Blobs sort before everything else. Equal keys have equal content: only the first is kept.
+                batch, batch_bytes, last_key = [], 0, None
+                for key, value in heapq.merge(*(iter_blobs(txn) for txn in txns), key=itemgetter(0)):
+                    if key == last_key:
+                        continue
+                    last_key = key
+                    batch.append((key, value))
+                    batch_bytes += len(value)
+                    if batch_bytes >= commit_bytes:
+                        put_batch(env_out, batch)
+                        batch, batch_bytes = [], 0
+                put_batch(env_out, batch)
+                build_id = os.urandom(16).hex()
+                with env_out.begin(write=True) as txn_out:
+                    txn_out.put(BUILD_ID_KEY, build_id.encode(), append=True)
+                for prefix in PREFIXES:
+                    # Merge the sorted streams of all sources by output index, i.e. in output key order
+                    checksum = 0
+                    merged = heapq.merge(
+                        *(iter_prefix(txn, prefix, idx) for txn, idx in zip(txns, out_index)), key=itemgetter(0)
+                    )
+                    batch, batch_bytes = [], 0
+                    for index, value in merged:
+                        if prefix == CHECKSUM_PREFIX:
+                            checksum = zlib.crc32(value, checksum)
+                        batch.append((b'%s%09d' % (prefix, index), value))
+                        batch_bytes += len(value)
+                        if batch_bytes >= commit_bytes:
+                            put_batch(env_out, batch)
+                            batch, batch_bytes = [], 0
+                    put_batch(env_out, batch)
+                    print(f'Copied the {prefix.decode()} keys')
+                    if prefix == CHECKSUM_PREFIX and checksums:
+                        manifest = make_manifest(len(sources), build_id, checksum)
+            finally:
+                for txn in txns:
+                    txn.abort()
+            # Written last, so an interrupted merge is not mistaken for a complete dataset
+            with env_out.begin(write=True) as txn_out:
+                if checksums:
+                    txn_out.put(MANIFEST_KEY, manifest, append=True)
+                txn_out.put(NUM_SAMPLES_KEY, str(len(sources)).encode(), append=True)
+            env_out.sync(True)
+            out_bytes = used_bytes(env_out)
+    finally:
+        for env in envs:
+            env.close()
+
+    # Any sidecar left in the output by a previous build describes other samples
+    shutil.rmtree(os.path.join(output, METADATA_DIR), ignore_errors=True)
+    if metadata and all(SampleMetadata.exists(path) for path in inputs):
+        merge_metadata(inputs, output, sources, indices, build_id)
+    elif metadata and any(SampleMetadata.exists(path) for path in inputs):
+        print('Not all inputs have a metadata sidecar; the output has none')
+    return len(sources), in_bytes, out_bytes
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to input LMDBs')
+    parser.add_argument('--output', required=True, help='Path to output LMDB. Any existing content is replaced.')
+    parser.add_argument(
+        '--interleave', action='store_true', help='Spread the samples of each input evenly instead of concatenating'
+    )
+    parser.add_argument('--commit_mb', type=int, default=1024, help='Size of the write transactions')
+    parser.add_argument('--no_metadata', action='store_true', help='Do not carry the metadata sidecars across')
+    args = parser.parse_args()
+
+    if os.path.abspath(args.output) in map(os.path.abspath, args.inputs):
+        parser.error('The output must not be one of the inputs')
+    num_samples, in_bytes, out_bytes = merge_lmdbs(
+        args.inputs, args.output, args.interleave, args.commit_mb * 1024**2, not args.no_metadata
+    )
+    print(
+        f'Merged {len(args.inputs)} LMDBs into {args.output}: {num_samples} samples,'
+        f' {out_bytes / 1024**2:.1f} MB (inputs: {in_bytes / 1024**2:.1f} MB)'
+    )
+
+
+if __name__ == '__main__':
+    main()
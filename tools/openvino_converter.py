@@ -5,9 +5,10 @@ import os.path as osp
 from argparse import ArgumentParser
 from functools import partial
 
-import mmcv
 from mmocr.utils.fileio import list_to_file
-from PIL import Image
+
+from strhub.data.annotation_index import AnnotationIndex
+from strhub.data.crop_writer import SceneImage, save_crop, split_lmdb, stream_crops
 
 
 def parse_args():
@@ -18,15 +19,31 @@ def parse_args():
     )
     parser.add_argument('root_path', help='Root dir containing images and annotations')
     parser.add_argument('n_proc', default=1, type=int, help='Number of processes to run')
+    parser.add_argument('--lmdb_root', help='Also write the crops of each split to an LMDB in this directory')
+    parser.add_argument(
+        '--no_images', action='store_true', help='Do not write the crops as image files (requires --lmdb_root)'
+    )
+    parser.add_argument(
+        '--lossless_crop', action='store_true', help='Cut crops in the DCT domain when possible (needs PyTurboJPEG)'
+    )
+    parser.add_argument(
+        '--max_slack',
+        type=int,
+        default=0,
+        help='With --lossless_crop, keep up to this many extra pixels left of and above a crop instead of trimming',
+    )
     args = parser.parse_args()
+    if args.no_images and not args.lmdb_root:
+        parser.error('--no_images requires --lmdb_root')
     return args
 
 
-def process_img(args, src_image_root, dst_image_root):
-    # Dirty hack for multiprocessing
-    img_idx, img_info, anns = args
-    src_img = Image.open(osp.join(src_image_root, img_info['file_name']))
-    labels = []
+def process_img(pos, index, img_start_idx, src_image_root, dst_image_root, lossless=False, max_slack=0):
+    # Only the position of the image is sent to the workers; its annotations are read from the file here.
+    img_info, anns = index.image(pos)
+    img_idx = pos + img_start_idx
+    src = SceneImage(osp.join(src_image_root, img_info['file_name']), lossless, max_slack)
+    crops = []
     for ann_idx, ann in enumerate(anns):
         attrs = ann['attributes']
         text_label = attrs['transcription']
@@ -38,17 +55,27 @@ def process_img(args, src_image_root, dst_image_root):
         x, y, w, h = ann['bbox']
         x, y = max(0, math.floor(x)), max(0, math.floor(y))
         w, h = math.ceil(w), math.ceil(h)
-        dst_img = src_img.crop((x, y, x + w, y + h))
+        image_bin = src.crop((x, y, x + w, y + h))
+        if image_bin is None:
+            continue
         dst_img_name = f'img_{img_idx}_{ann_idx}.jpg'
-        dst_img_path = osp.join(dst_image_root, dst_img_name)
-        # Preserve JPEG quality
-        dst_img.save(dst_img_path, qtables=src_img.quantization)
-        labels.append(f'{osp.basename(dst_image_root)}/{dst_img_name}' f' {text_label}')
-    src_img.close()
-    return labels
-
-
-def convert_openimages(root_path, dst_image_path, dst_label_filename, annotation_filename, img_start_idx=0, nproc=1):
+        crops.append((save_crop(image_bin, dst_image_root, dst_img_name), image_bin, text_label))
+    src.close()
+    return crops
+
+
+def convert_openimages(
+    root_path,
+    dst_image_path,
+    dst_label_filename,
+    annotation_filename,
+    img_start_idx=0,
+    nproc=1,
+    lmdb_path=None,
+    save_images=True,
+    lossless=False,
+    max_slack=0,
+):
     annotation_path = osp.join(root_path, annotation_filename)
     if not osp.exists(annotation_path):
         raise Exception(f'{annotation_path} not exists, please check and try again.')
@@ -56,24 +83,26 @@ def convert_openimages(root_path, dst_image_path, dst_label_filename, annotation
 
     # outputs
     dst_label_file = osp.join(root_path, dst_label_filename)
-    dst_image_root = osp.join(root_path, dst_image_path)
-    os.makedirs(dst_image_root, exist_ok=True)
-
-    annotation = mmcv.load(annotation_path)
-
-    process_img_with_path = partial(process_img, src_image_root=src_image_root, dst_image_root=dst_image_root)
-    tasks = []
-    anns = {}
-    for ann in annotation['annotations']:
-        anns.setdefault(ann['image_id'], []).append(ann)
-    for img_idx, img_info in enumerate(annotation['images']):
-        tasks.append((img_idx + img_start_idx, img_info, anns[img_info['id']]))
-    labels_list = mmcv.track_parallel_progress(process_img_with_path, tasks, keep_order=True, nproc=nproc)
-    final_labels = []
-    for label_list in labels_list:
-        final_labels += label_list
-    list_to_file(dst_label_file, final_labels)
-    return len(annotation['images'])
+    dst_image_root = osp.join(root_path, dst_image_path) if save_images else None
+    if save_images:
+        os.makedirs(dst_image_root, exist_ok=True)
+
+    index = AnnotationIndex(annotation_path, 'images', 'annotations')
+
+    process_img_with_path = partial(
+        process_img,
+        index=index,
+        img_start_idx=img_start_idx,
+        src_image_root=src_image_root,
+        dst_image_root=dst_image_root,
+        lossless=lossless,
+        max_slack=max_slack,
+    )
+    num_imgs = len(index)
+    _, labels = stream_crops(process_img_with_path, range(num_imgs), nproc, lmdb_path, num_imgs, gt=save_images)
+    if save_images:
+        list_to_file(dst_label_file, labels)
+    return num_imgs
 
 
 def main():
@@ -89,6 +118,10 @@ def main():
             annotation_filename=f'text_spotting_openimages_v5_train_{s}.json',
             img_start_idx=num_train_imgs,
             nproc=args.n_proc,
+            lmdb_path=split_lmdb(args.lmdb_root, f'train_{s}'),
+            save_images=not args.no_images,
+            lossless=args.lossless_crop,
+            max_slack=args.max_slack,
         )
     print('Processing validation set...')
     convert_openimages(
@@ -98,6 +131,10 @@ def main():
         annotation_filename='text_spotting_openimages_v5_validation.json',
         img_start_idx=num_train_imgs,
         nproc=args.n_proc,
+        lmdb_path=split_lmdb(args.lmdb_root, 'val'),
+        save_images=not args.no_images,
+        lossless=args.lossless_crop,
+        max_slack=args.max_slack,
     )
     print('Finish')
 
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Pseudo-label an LMDB of (unlabeled) crops with a model, for mining training data.
+
+The input is streamed through batched inference by a pool of worker processes, each with its own copy of the model
+and a share of the CPU threads. Samples whose prediction has a confidence of at least --threshold are written to the
+output LMDB in the standard layout, with the prediction as label and its confidence under ``confidence-%09d`` (see
+strhub.data.lmdb_utils). Labels of the input, if any, are ignored; its image paths are carried over.
+
+Progress is checkpointed together with the samples: re-run with --resume to continue an interrupted run.
+"""
+import io
+import os
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool
+
+from PIL import Image
+
+import torch
+
+from strhub.data.lmdb_utils import (
+    LmdbWriter,
+    confidence_key,
+    get_image,
+    open_readonly,
+    read_num_samples,
+    read_progress,
+)
+from strhub.data.module import SceneTextDataModule
+from strhub.models.utils import load_from_checkpoint, parse_model_args
+
+_env = None
+_model = None
+_transform = None
+
+
+def _init_worker(lmdb_path, checkpoint, model_kwargs, num_threads):
+    global _env, _model, _transform
+    torch.set_num_threads(num_threads)
+    _env = open_readonly(lmdb_path)
+    _model = load_from_checkpoint(checkpoint, **model_kwargs).eval()
+    _transform = SceneTextDataModule.get_transform(_model.hparams.img_size)
+
+
+def _predict(images, indices):
+    p = _model(torch.stack(images)).softmax(-1)
+    preds, probs = _model.tokenizer.decode(p)
+    # Same confidence as test.py: the product of the character probabilities, end-of-sequence included
+    return [(index, pred, prob.prod().item()) for index, pred, prob in zip(indices, preds, probs)]
+
+
+@torch.inference_mode()
+def _label_chunk(chunk, batch_size):
+    """Predict the labels of the index range. Runs in the workers.
+
+    Returns (index, label, confidence) for each sample, in order. Images which cannot be decoded get no label.
+    """
+    start, end = chunk
+    results = []
+    images, indices = [], []
+    with _env.begin() as txn:
+        for index in range(start, end + 1):
+            try:
+                img = Image.open(io.BytesIO(get_image(txn, index))).convert('RGB')
+            except (IOError, ValueError, TypeError):
+                results.append((index, None, 0.0))
+                continue
+            images.append(_transform(img))
+            indices.append(index)
+            if len(images) == batch_size:
+                results += _predict(images, indices)
+                images, indices = [], []
+    if images:
+        results += _predict(images, indices)
+    results.sort()
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('checkpoint', help="Model checkpoint (or 'pretrained=<model_id>')")
+    parser.add_argument('input', help='Path to input LMDB')
+    parser.add_argument('--output', required=True, help='Path to output LMDB')
+    parser.add_argument('--threshold', type=float, default=0.9, help='Minimum confidence of the kept predictions')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run')
+    parser.add_argument('--num_workers', type=int, default=4, help='Worker processes, each with a copy of the model')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--chunk_size', type=int, default=2048, help='Number of samples per work item')
+    args, unknown = parser.parse_known_args()
+    model_kwargs = parse_model_args(unknown)
+    print(f'Additional keyword arguments: {model_kwargs}')
+
+    # Only read the size here: the LMDB must not be open when the workers are forked.
+    with open_readonly(args.input) as env:
+        num_samples = read_num_samples(env)
+    source = os.path.abspath(args.input)
+    if args.resume and os.path.exists(os.path.join(args.output, 'data.mdb')):
+        # Checked before loading any model, and without opening the output for writing
+        with open_readonly(args.output) as env:
+            if read_progress(env).get(source, {}).get('done'):
+                print(f'{args.input} has already been labeled into {args.output}')
+                return
+    num_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+    init_args = (args.input, args.checkpoint, model_kwargs, num_threads)
+    pool = Pool(args.num_workers, _init_worker, init_args)
+    with pool, LmdbWriter(args.output, append=args.resume) as writer:
+        progress = writer.get_progress(source) or {'index': 0}
+        if progress['index']:
+            print(f'Resuming after sample {progress["index"]}')
+        chunks = [
+            (start, min(start + args.chunk_size - 1, num_samples))
+            for start in range(progress['index'] + 1, num_samples + 1, args.chunk_size)
+        ]
+        kept = invalid = 0
+        with open_readonly(args.input) as env_in, env_in.begin() as txn:
+            for results in pool.imap(partial(_label_chunk, batch_size=args.batch_size), chunks):
+                for index, label, confidence in results:
+                    if label is None:
+                        invalid += 1
+                    elif label and confidence >= args.threshold:
+                        image_path = txn.get(f'imagepath-{index:09d}'.encode())
+                        path = image_path.decode() if image_path is not None else None
+                        # The extra keys and the progress below are committed together with the sample
+                        new_index = writer.write(get_image(txn, index), label, path)
+                        writer.put(confidence_key(new_index), f'{confidence:.6f}'.encode())
+                        if image_path is not None:
+                            writer.put(f'imagepath-{new_index:09d}'.encode(), image_path)
+                        kept += 1
+                    # After every sample: the writer commits before its next write, or when interrupted
+                    writer.set_progress(source, {'index': index})
+                print(f'Labeled samples up to {results[-1][0]} / {num_samples}: kept {kept}')
+        writer.set_progress(source, {'index': num_samples, 'done': True})
+        total = writer.num_samples
+    print(f'Kept {kept} of {num_samples - progress["index"]} samples (confidence >= {args.threshold})')
+    if invalid:
+        print(f'{invalid} images could not be decoded')
+    print(f'{args.output} has {total} samples')
+
+
+if __name__ == '__main__':
+    main()
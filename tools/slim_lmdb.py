@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Re-encode the images of an LMDB dataset with capped resolution, preserving aspect ratio and labels.
+
+Images larger than --max_height x --max_width are downscaled to fit and re-encoded. All other images are kept
+byte-for-byte, as are re-encoded images which would not get smaller. Reports the size and decode time savings and,
+given a checkpoint, the accuracy of the model on the input and on the output (measured by test.py).
+"""
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool
+
+from PIL import Image
+
+from strhub.data.lmdb_utils import LmdbWriter, get_image, label_key, open_readonly, read_num_samples
+from strhub.data.metadata import SampleMetadata
+
+_env = None
+
+
+def _init_worker(lmdb_path):
+    global _env
+    _env = open_readonly(lmdb_path)
+
+
+def _decode_time(image_bin):
+    start = time.perf_counter()
+    Image.open(io.BytesIO(image_bin)).convert('RGB')
+    return time.perf_counter() - start
+
+
+def fit_size(size, max_height, max_width):
+    """Largest size with the same aspect ratio as `size` (w, h) which fits in max_width x max_height."""
+    w, h = size
+    scale = min(1.0, max_height / h, max_width / w)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def slim(image_bin, max_height, max_width, image_format, quality):
+    """Returns the new encoded image (or the original one) and its (width, height)."""
+    img = Image.open(io.BytesIO(image_bin))
+    new_size = fit_size(img.size, max_height, max_width)
+    if new_size == img.size:
+        return image_bin, img.size
+    img = img.convert('RGB').resize(new_size, Image.BICUBIC)
+    buf = io.BytesIO()
+    img.save(buf, image_format, quality=quality)
+    new_bin = buf.getvalue()
+    if len(new_bin) >= len(image_bin):
+        return image_bin, Image.open(io.BytesIO(image_bin)).size
+    return new_bin, new_size
+
+
+def _slim_chunk(chunk, max_height, max_width, image_format, quality, time_decode):
+    """Slim the images of the index range. Runs in the workers."""
+    start, end = chunk
+    samples = []
+    stats = {
+        'resized': 0, 'invalid': 0, 'missing': 0, 'bytes_in': 0, 'bytes_out': 0, 'decode_in': 0.0, 'decode_out': 0.0
+    }
+    with _env.begin() as txn:
+        for index in range(start, end + 1):
+            image_bin = get_image(txn, index)
+            if image_bin is None:
+                # Not written: the output only holds samples with an image
+                stats['missing'] += 1
+                continue
+            try:
+                new_bin, size = slim(image_bin, max_height, max_width, image_format, quality)
+            except (IOError, ValueError):
+                # Kept as is: the dataset skips images which cannot be decoded
+                new_bin, size = image_bin, None
+                stats['invalid'] += 1
+            else:
+                if time_decode:
+                    decode_in = _decode_time(image_bin)
+                    stats['decode_in'] += decode_in
+                    stats['decode_out'] += _decode_time(new_bin) if new_bin is not image_bin else decode_in
+            stats['resized'] += new_bin is not image_bin
+            stats['bytes_in'] += len(image_bin)
+            stats['bytes_out'] += len(new_bin)
+            samples.append((index, new_bin, size))
+    return samples, stats
+
+
+def _evaluate(checkpoint, datasets, test_args):
+    """Accuracy of `checkpoint` on each of the named LMDBs, as reported by test.py."""
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        # test.py reads <data_root>/test/<name>, and writes its log next to the checkpoint: keep both in here.
+        os.makedirs(os.path.join(tmp, 'test'))
+        for name, path in datasets.items():
+            os.symlink(os.path.abspath(path), os.path.join(tmp, 'test', name))
+        if not checkpoint.startswith('pretrained='):
+            os.symlink(os.path.abspath(checkpoint), os.path.join(tmp, 'model.ckpt'))
+            checkpoint = 'model.ckpt'
+        cmd = [sys.executable, os.path.join(repo, 'test.py'), checkpoint, '--data_root', tmp]
+        cmd += ['--test_set', ','.join(datasets)] + test_args
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [repo, os.environ.get('PYTHONPATH')]))}
+        out = subprocess.run(cmd, cwd=tmp, env=env, check=True, capture_output=True, text=True).stdout
+    accuracy = {}
+    for name in datasets:
+        m = re.search(rf'^\| {name}\s*\|\s*\d+\s*\|\s*([\d.]+)\s*\|', out, re.MULTILINE)
+        accuracy[name] = float(m.group(1)) if m else None
+    return accuracy
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('input', help='Path to input LMDB')
+    parser.add_argument('--output', required=True, help='Path to output LMDB')
+    parser.add_argument('--max_height', type=int, default=64)
+    parser.add_argument('--max_width', type=int, default=512)
+    parser.add_argument('--format', default='JPEG', choices=['JPEG', 'WEBP'], help='Codec of re-encoded images')
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--no_timing', action='store_true', help='Do not measure the decode time savings')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=2000, help='Number of samples per work item')
+    parser.add_argument('--checkpoint', help="Also report the accuracy of this model (or 'pretrained=<model_id>')")
+    parser.add_argument(
+        '--test_args', nargs='...', default=[], help='Further arguments to test.py, e.g. --cased --punctuation'
+    )
+    args = parser.parse_args()
+
+    # Only read the size here: the LMDB must not be open when the workers are forked.
+    with open_readonly(args.input) as env:
+        num_samples = read_num_samples(env)
+    meta = SampleMetadata(args.input) if SampleMetadata.exists(args.input) else None
+    chunks = [
+        (start, min(start + args.chunk_size - 1, num_samples)) for start in range(1, num_samples + 1, args.chunk_size)
+    ]
+    slim_chunk = partial(
+        _slim_chunk,
+        max_height=args.max_height,
+        max_width=args.max_width,
+        image_format=args.format,
+        quality=args.quality,
+        time_decode=not args.no_timing,
+    )
+    totals = {}
+    with Pool(args.num_workers, _init_worker, (args.input,)) as pool, LmdbWriter(args.output) as writer:
+        with open_readonly(args.input) as env_in, env_in.begin() as txn:
+            for (_, end), (samples, stats) in zip(chunks, pool.imap(slim_chunk, chunks)):
+                for index, image_bin, size in samples:
+                    path = (meta.path(index) or None) if meta is not None else None
+                    new_index = writer.write(image_bin, txn.get(label_key(index)), path, size)
+                    image_path = txn.get(f'imagepath-{index:09d}'.encode())
+                    if image_path is not None:
+                        writer.put(f'imagepath-{new_index:09d}'.encode(), image_path)
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
+                print(f'Processed samples up to {end} / {num_samples}')
+
+    mb_in, mb_out = totals.get('bytes_in', 0) / 1024**2, totals.get('bytes_out', 0) / 1024**2
+    max_size = f'{args.max_height}x{args.max_width}'
+    num_images = num_samples - totals.get('missing', 0)
+    print(f'Re-encoded {totals.get("resized", 0)} of {num_images} images to at most {max_size}')
+    if totals.get('missing'):
+        print(f'{totals["missing"]} samples without an image were not written')
+    if totals.get('invalid'):
+        print(f'{totals["invalid"]} images could not be decoded and were copied as is')
+    print(f'Image bytes: {mb_in:.1f} MB -> {mb_out:.1f} MB ({100 * (1 - mb_out / max(mb_in, 1e-9)):.1f}% saved)')
+    num_decoded = num_images - totals.get('invalid', 0)
+    if not args.no_timing and num_decoded:
+        t_in, t_out = 1000 * totals['decode_in'] / num_decoded, 1000 * totals['decode_out'] / num_decoded
+        saved = 100 * (1 - t_out / max(t_in, 1e-9))
+        print(f'Decode time: {t_in:.3f} ms -> {t_out:.3f} ms per image ({saved:.1f}% saved)')
+
+    if args.checkpoint:
+        accuracy = _evaluate(args.checkpoint, {'original': args.input, 'slim': args.output}, args.test_args)
+        if None in accuracy.values():
+            print(f'Could not parse the accuracy from the output of test.py: {accuracy}')
+        else:
+            delta = accuracy['slim'] - accuracy['original']
+            print(f'Accuracy: {accuracy["original"]:.2f} -> {accuracy["slim"]:.2f} ({delta:+.2f})')
+
+
+if __name__ == '__main__':
+    main()
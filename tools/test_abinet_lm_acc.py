@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import string
 import sys
 
@@ -9,7 +10,9 @@ import torch
 import torch.nn.functional as F
 from torch import Tensor
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
 
+from strhub.data.label_dataset import LabelDataset
 from strhub.data.module import SceneTextDataModule
 from strhub.models.abinet.system import ABINet
 
@@ -46,7 +49,7 @@ def main():
     parser.add_argument('checkpoint', help='Official pretrained weights for ABINet-LV (best-train-abinet.pth)')
     parser.add_argument('--data_root', default='data')
     parser.add_argument('--batch_size', type=int, default=512)
-    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--num_workers', type=int, default=0, help='Only labels are loaded: workers do not help')
     parser.add_argument('--new', action='store_true', default=False, help='Evaluate on new benchmark datasets')
     parser.add_argument('--device', default='cuda')
     args = parser.parse_args()
@@ -62,17 +65,6 @@ def main():
     model = model.eval().to(args.device)
     model.freeze()  # disable autograd
     hp = model.hparams
-    datamodule = SceneTextDataModule(
-        args.data_root,
-        '_unused_',
-        hp.img_size,
-        hp.max_label_length,
-        hp.charset_train,
-        hp.charset_test,
-        args.batch_size,
-        args.num_workers,
-        False,
-    )
 
     test_set = SceneTextDataModule.TEST_BENCHMARK
     if args.new:
@@ -81,13 +73,16 @@ def main():
 
     results = {}
     max_width = max(map(len, test_set))
-    for name, dataloader in datamodule.test_dataloaders(test_set).items():
+    for name in test_set:
+        # The LM only needs the labels: the images are never read
+        dataset = LabelDataset(os.path.join(args.data_root, 'test', name), hp.charset_test, hp.max_label_length)
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers)
         total = 0
         correct = 0
         ned = 0
         confidence = 0
         label_length = 0
-        for _, labels in tqdm(iter(dataloader), desc=f'{name:>{max_width}}'):
+        for labels in tqdm(iter(dataloader), desc=f'{name:>{max_width}}'):
             res = model.test_step((labels, labels), -1)['output']
             total += res.num_samples
             correct += res.correct
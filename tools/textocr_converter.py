@@ -6,10 +6,11 @@ import os
 import os.path as osp
 from functools import partial
 
-import mmcv
 import numpy as np
 from mmocr.utils.fileio import list_to_file
-from PIL import Image
+
+from strhub.data.annotation_index import AnnotationIndex
+from strhub.data.crop_writer import SceneImage, encode_crop, save_crop, split_lmdb, stream_crops
 
 
 def parse_args():
@@ -18,8 +19,23 @@ def parse_args():
     )
     parser.add_argument('root_path', help='Root dir path of TextOCR')
     parser.add_argument('n_proc', default=1, type=int, help='Number of processes to run')
+    parser.add_argument('--lmdb_root', help='Also write the crops of each split to an LMDB in this directory')
+    parser.add_argument(
+        '--no_images', action='store_true', help='Do not write the crops as image files (requires --lmdb_root)'
+    )
+    parser.add_argument(
+        '--lossless_crop', action='store_true', help='Cut crops in the DCT domain when possible (needs PyTurboJPEG)'
+    )
+    parser.add_argument(
+        '--max_slack',
+        type=int,
+        default=0,
+        help='With --lossless_crop, keep up to this many extra pixels left of and above a crop instead of trimming',
+    )
     parser.add_argument('--rectify_pose', action='store_true', help='Fix pose of rotated text to make them horizontal')
     args = parser.parse_args()
+    if args.no_images and not args.lmdb_root:
+        parser.error('--no_images requires --lmdb_root')
     return args
 
 
@@ -47,11 +63,12 @@ def rectify_image_pose(image, top_left, points):
     return image
 
 
-def process_img(args, src_image_root, dst_image_root):
-    # Dirty hack for multiprocessing
-    img_idx, img_info, anns, rectify_pose = args
-    src_img = Image.open(osp.join(src_image_root, img_info['file_name']))
-    labels = []
+def process_img(pos, index, img_start_idx, rectify_pose, src_image_root, dst_image_root, lossless=False, max_slack=0):
+    # Only the position of the image is sent to the workers; its annotations are read from the file here.
+    img_info, anns = index.image(pos)
+    img_idx = pos + img_start_idx
+    src = SceneImage(osp.join(src_image_root, img_info['file_name']), lossless, max_slack)
+    crops = []
     for ann_idx, ann in enumerate(anns):
         text_label = ann['utf8_string']
 
@@ -62,20 +79,32 @@ def process_img(args, src_image_root, dst_image_root):
         x, y, w, h = ann['bbox']
         x, y = max(0, math.floor(x)), max(0, math.floor(y))
         w, h = math.ceil(w), math.ceil(h)
-        dst_img = src_img.crop((x, y, x + w, y + h))
         if rectify_pose:
-            dst_img = rectify_image_pose(dst_img, (x, y), ann['points'])
+            dst_img = rectify_image_pose(src.image.crop((x, y, x + w, y + h)), (x, y), ann['points'])
+            # Preserve JPEG quality
+            image_bin = encode_crop(dst_img, src.image.quantization)
+        else:
+            image_bin = src.crop((x, y, x + w, y + h))
+        if image_bin is None:
+            continue
         dst_img_name = f'img_{img_idx}_{ann_idx}.jpg'
-        dst_img_path = osp.join(dst_image_root, dst_img_name)
-        # Preserve JPEG quality
-        dst_img.save(dst_img_path, qtables=src_img.quantization)
-        labels.append(f'{osp.basename(dst_image_root)}/{dst_img_name}' f' {text_label}')
-    src_img.close()
-    return labels
+        crops.append((save_crop(image_bin, dst_image_root, dst_img_name), image_bin, text_label))
+    src.close()
+    return crops
 
 
 def convert_textocr(
-    root_path, dst_image_path, dst_label_filename, annotation_filename, img_start_idx=0, nproc=1, rectify_pose=False
+    root_path,
+    dst_image_path,
+    dst_label_filename,
+    annotation_filename,
+    img_start_idx=0,
+    nproc=1,
+    rectify_pose=False,
+    lmdb_path=None,
+    save_images=True,
+    lossless=False,
+    max_slack=0,
 ):
     annotation_path = osp.join(root_path, annotation_filename)
     if not osp.exists(annotation_path):
@@ -84,23 +113,27 @@ def convert_textocr(
 
     # outputs
     dst_label_file = osp.join(root_path, dst_label_filename)
-    dst_image_root = osp.join(root_path, dst_image_path)
-    os.makedirs(dst_image_root, exist_ok=True)
-
-    annotation = mmcv.load(annotation_path)
-
-    process_img_with_path = partial(process_img, src_image_root=src_image_root, dst_image_root=dst_image_root)
-    tasks = []
-    for img_idx, img_info in enumerate(annotation['imgs'].values()):
-        ann_ids = annotation['imgToAnns'][img_info['id']]
-        anns = [annotation['anns'][ann_id] for ann_id in ann_ids]
-        tasks.append((img_idx + img_start_idx, img_info, anns, rectify_pose))
-    labels_list = mmcv.track_parallel_progress(process_img_with_path, tasks, keep_order=True, nproc=nproc)
-    final_labels = []
-    for label_list in labels_list:
-        final_labels += label_list
-    list_to_file(dst_label_file, final_labels)
-    return len(annotation['imgs'])
+    dst_image_root = osp.join(root_path, dst_image_path) if save_images else None
+    if save_images:
+        os.makedirs(dst_image_root, exist_ok=True)
+
+    index = AnnotationIndex(annotation_path, 'imgs', 'anns', 'imgToAnns')
+
+    process_img_with_path = partial(
+        process_img,
+        index=index,
+        img_start_idx=img_start_idx,
+        rectify_pose=rectify_pose,
+        src_image_root=src_image_root,
+        dst_image_root=dst_image_root,
+        lossless=lossless,
+        max_slack=max_slack,
+    )
+    num_imgs = len(index)
+    _, labels = stream_crops(process_img_with_path, range(num_imgs), nproc, lmdb_path, num_imgs, gt=save_images)
+    if save_images:
+        list_to_file(dst_label_file, labels)
+    return num_imgs
 
 
 def main():
@@ -113,6 +146,10 @@ def main():
         dst_label_filename='train_label.txt',
         annotation_filename='TextOCR_0.1_train.json',
         nproc=args.n_proc,
+        lmdb_path=split_lmdb(args.lmdb_root, 'train'),
+        save_images=not args.no_images,
+        lossless=args.lossless_crop,
+        max_slack=args.max_slack,
         rectify_pose=args.rectify_pose,
     )
     print('Processing validation set...')
@@ -123,6 +160,10 @@ def main():
         annotation_filename='TextOCR_0.1_val.json',
         img_start_idx=num_train_imgs,
         nproc=args.n_proc,
+        lmdb_path=split_lmdb(args.lmdb_root, 'val'),
+        save_images=not args.no_images,
+        lossless=args.lossless_crop,
+        max_slack=args.max_slack,
         rectify_pose=args.rectify_pose,
     )
     print('Finish')
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Verify the integrity of LMDB datasets against their per-sample checksums (see strhub.data.lmdb_utils).
+
+No image is decoded: the workers read disjoint index ranges sequentially and compare the CRC-32 of the stored bytes
+with the crc-%09d keys, naming every key which is missing or does not match. The manifest is checked against the
+number of samples and the build id, and its overall checksum against the crc- keys themselves.
+
+With --add, the checksums and the manifest are written for LMDBs which were built without them instead.
+"""
+import os
+import struct
+import sys
+import zlib
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool
+
+import lmdb
+
+from strhub.data.lmdb_utils import (
+    BLOB_PREFIX,
+    MANIFEST_KEY,
+    checksum_key,
+    image_key,
+    image_ref_key,
+    label_key,
+    make_manifest,
+    open_readonly,
+    read_build_id,
+    read_manifest,
+    read_num_samples,
+    used_bytes,
+)
+
+_env = None
+
+
+def _init_worker(lmdb_path):
+    global _env
+    _env = open_readonly(lmdb_path)
+
+
+def _check_chunk(chunk, add=False):
+    """Check the samples of the index range. Runs in the workers.
+
+    Returns the start of the range, the crc- values of its samples concatenated (the stored ones, or with `add` the
+    computed ones) and the problems found.
+    """
+    start, end = chunk
+    records, problems = [], []
+    with _env.begin(buffers=True) as txn:
+        for index in range(start, end + 1):
+            # With buffers=True, a value is only valid until the next read: take its CRC right away.
+            image_name = image_key(index).decode()
+            image_bin = txn.get(image_key(index))
+            if image_bin is None:
+                ref = txn.get(image_ref_key(index))
+                if ref is not None:
+                    ref = bytes(ref)
+                    image_name = f'{image_ref_key(index).decode()} ({(BLOB_PREFIX + ref).decode()})'
+                    image_bin = txn.get(BLOB_PREFIX + ref)
+            image_crc = None if image_bin is None else zlib.crc32(image_bin)
+            label = txn.get(label_key(index))
+            label_crc = None if label is None else zlib.crc32(label)
+            if image_crc is None:
+                problems.append(f'{image_name}: missing')
+            if label_crc is None:
+                problems.append(f'{label_key(index).decode()}: missing')
+            if add:
+                records.append(struct.pack('<II', image_crc or 0, label_crc or 0))
+                continue
+            stored = txn.get(checksum_key(index))
+            if stored is None or len(stored) != 8:
+                problems.append(f'{checksum_key(index).decode()}: missing or malformed')
+                continue
+            stored = bytes(stored)
+            records.append(stored)
+            stored_image_crc, stored_label_crc = struct.unpack('<II', stored)
+            if image_crc is not None and image_crc != stored_image_crc:
+                problems.append(f'{image_name}: checksum mismatch')
+            if label_crc is not None and label_crc != stored_label_crc:
+                problems.append(f'{label_key(index).decode()}: checksum mismatch')
+    return start, b''.join(records), problems
+
+
+def verify(lmdb_path, num_workers, chunk_size, add=False):
+    """Returns the list of problems found. With `add`, also writes the checksums and the manifest."""
+    # Only read the header keys here: the LMDB must not be open when the workers are forked.
+    with open_readonly(lmdb_path) as env:
+        num_samples = read_num_samples(env)
+        build_id = read_build_id(env)
+        manifest = read_manifest(env)
+    problems = []
+    if not add:
+        if manifest is None:
+            return ['manifest: missing (build the LMDB with checksums, or add them with --add)']
+        if manifest['num_samples'] != num_samples:
+            problems.append(f'manifest: {manifest["num_samples"]} samples, but num-samples is {num_samples}')
+        if manifest['build_id'] != build_id:
+            problems.append(f'manifest: build id {manifest["build_id"]}, but build-id is {build_id}')
+    chunks = [(start, min(start + chunk_size - 1, num_samples)) for start in range(1, num_samples + 1, chunk_size)]
+    checksum = 0
+    records = []
+    with Pool(num_workers, _init_worker, (lmdb_path,)) as pool:
+        # imap keeps the order of the chunks, which the overall checksum depends on
+        for start, chunk_records, chunk_problems in pool.imap(partial(_check_chunk, add=add), chunks):
+            checksum = zlib.crc32(chunk_records, checksum)
+            problems.extend(chunk_problems)
+            if add:
+                records.append((start, chunk_records))
+            print(f'Checked samples up to {min(start + chunk_size - 1, num_samples)} / {num_samples}')
+    if add:
+        if not problems:
+            _write_checksums(lmdb_path, records, make_manifest(num_samples, build_id, checksum))
+    elif manifest['num_samples'] == num_samples and manifest['checksum'] != checksum:
+        problems.append('manifest: checksum of the crc- keys does not match')
+    return problems
+
+
+def _write_checksums(lmdb_path, records, manifest):
+    num_records = sum(len(chunk_records) // 8 for _, chunk_records in records)
+    with open_readonly(lmdb_path) as env:
+        # Each crc- entry takes less than 64 bytes, including its share of the tree pages
+        map_size = max(env.info()['map_size'], used_bytes(env) + 64 * num_records + 16 * 1024**2)
+    with lmdb.open(lmdb_path, map_size=map_size) as env:
+        for start, chunk_records in records:
+            with env.begin(write=True) as txn:
+                for offset in range(0, len(chunk_records), 8):
+                    txn.put(checksum_key(start + offset // 8), chunk_records[offset : offset + 8])
+        # The build id is kept: the samples did not change.
+        with env.begin(write=True) as txn:
+            txn.put(MANIFEST_KEY, manifest)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='+', help='Path to LMDBs')
+    parser.add_argument('--add', action='store_true', help='Write the checksums of LMDBs built without them')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Number of samples per work item')
+    args = parser.parse_args()
+
+    failed = False
+    for lmdb_path in args.inputs:
+        problems = verify(lmdb_path, args.num_workers, args.chunk_size, args.add)
+        for problem in problems:
+            print(f'{lmdb_path}: {problem}')
+        if problems:
+            failed = True
+            print(f'{lmdb_path}: FAILED ({len(problems)} problems)' + (', checksums not written' if args.add else ''))
+        else:
+            print(f'{lmdb_path}: ' + ('checksums written' if args.add else 'OK'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
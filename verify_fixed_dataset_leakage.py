@@ -1,150 +1,208 @@
 #!/usr/bin/env python3
 """
 Verify ZERO Data Leakage in Fixed Datasets
-Checks for image content overlap using MD5 hashes
+Checks for image content overlap using content hashes, and optionally for near-duplicates (re-encoded, re-cropped or
+resized copies) using perceptual hashes
+
+Hashes are computed by multiple processes and cached next to each LMDB (see strhub.data.content_hash), so only
+datasets which changed since the last run are hashed again.
+
+Usage:
+  verify_fixed_dataset_leakage.py                       # Total-Text, ArT and curved mix splits under --base_dir
+  verify_fixed_dataset_leakage.py train=a/train val=a/val test=a/test+b/test
+                                                        # any N datasets, checked pairwise. A dataset can be the
+                                                        # union of several LMDBs joined with '+'
 """
 
-import lmdb
-import hashlib
+import argparse
 import os
-from collections import defaultdict
-from tqdm import tqdm
+import sys
+from contextlib import nullcontext
+from itertools import combinations
+
+import numpy as np
 
-def get_dataset_hashes(lmdb_path, name):
-    """Get MD5 hashes of all images in an LMDB dataset"""
+from strhub.data.content_hash import DEFAULT_DIGEST, DIGESTS, HASH_DTYPE, content_hashes, valid_hashes
+from strhub.data.lmdb_utils import image_key
+from strhub.data.perceptual_hash import near_duplicate_pairs, perceptual_hashes
+from strhub.data.split_view import SplitView
+
+def get_dataset_hashes(lmdb_paths, name, args):
+    """Get the unique content hashes of all images in one or more LMDB datasets (or split views).
+    Returns the hashes, the number of samples and the number of paths which could not be read."""
     print(f"Scanning {name}...")
-    print(f"  Path: {lmdb_path}")
-    
-    hashes = set()
+
+    hashes = []
     count = 0
-    
-    if not os.path.exists(lmdb_path):
-        print(f"  ❌ Path does not exist: {lmdb_path}")
-        return hashes, 0
-
-    try:
-        env = lmdb.open(lmdb_path, readonly=True, lock=False, readahead=False, meminit=False)
-        with env.begin(write=False) as txn:
-            num_samples = int(txn.get('num-samples'.encode()))
-            
-            for i in tqdm(range(1, num_samples + 1), desc=f"  Hashing {name}", leave=False):
-                image_key = f'image-{i:09d}'.encode()
-                image_data = txn.get(image_key)
-                
-                if image_data:
-                    # Calculate MD5 hash of image content
-                    img_hash = hashlib.md5(image_data).hexdigest()
-                    hashes.add(img_hash)
-                    count += 1
-                    
-        env.close()
+    errors = 0
+
+    for lmdb_path in lmdb_paths:
+        print(f"  Path: {lmdb_path}")
+        if not os.path.exists(lmdb_path):
+            print(f"  ❌ Path does not exist: {lmdb_path}")
+            errors += 1
+            continue
+        try:
+            lmdb_hashes = valid_hashes(content_hashes(lmdb_path, args.digest, args.num_workers, refresh=args.refresh))
+        except Exception as e:
+            print(f"  ❌ Error reading LMDB: {e}")
+            errors += 1
+            continue
+        hashes.append(lmdb_hashes)
+        count += len(lmdb_hashes)
+
+    hashes = np.unique(np.concatenate(hashes)) if hashes else np.empty(0, HASH_DTYPE)
+    if errors:
+        print(f"  ❌ Found {count} samples ({len(hashes)} unique images), but {errors} path(s) could not be read")
+    else:
         print(f"  ✅ Found {count} samples ({len(hashes)} unique images)")
-        
-    except Exception as e:
-        print(f"  ❌ Error reading LMDB: {e}")
-        
-    return hashes, count
+
+    return hashes, count, errors
 
 def check_overlap(set1, name1, set2, name2):
     """Check for overlap between two sets of hashes"""
-    overlap = set1.intersection(set2)
-    num_overlap = len(overlap)
-    
+    num_overlap = len(np.intersect1d(set1, set2, assume_unique=True))
+
     print(f"\nComparing {name1} vs {name2}:")
     if num_overlap == 0:
         print(f"  ✅ ZERO OVERLAP (Clean)")
     else:
         print(f"  🚨 FOUND {num_overlap} OVERLAPPING IMAGES! (Leakage Detected)")
         print(f"  Overlap Rate: {num_overlap/len(set1):.2%} of {name1}")
-        
+
     return num_overlap
 
-def main():
-    print("=" * 100)
-    print("VERIFYING FIXED DATASET INTEGRITY")
-    print("Checking for Data Leakage via Image Content Hashing")
-    print("=" * 100)
-    print()
-    
-    base_dir = "/data1/vivek/parseq/data_fixed"
-    
-    # 1. Verify Total-Text
-    print("█" * 50)
-    print("1. Checking Total-Text Splits")
-    print("█" * 50)
-    
-    tt_train_path = f"{base_dir}/totaltext_lmdb/train/totaltext"
-    tt_val_path = f"{base_dir}/totaltext_lmdb/val/totaltext"
-    tt_test_path = f"{base_dir}/totaltext_lmdb/test/totaltext"
-    
-    tt_train_hashes, _ = get_dataset_hashes(tt_train_path, "TT Train")
-    tt_val_hashes, _ = get_dataset_hashes(tt_val_path, "TT Val")
-    tt_test_hashes, _ = get_dataset_hashes(tt_test_path, "TT Test")
-    
-    leaks = 0
-    leaks += check_overlap(tt_train_hashes, "TT Train", tt_val_hashes, "TT Val")
-    leaks += check_overlap(tt_train_hashes, "TT Train", tt_test_hashes, "TT Test")
-    leaks += check_overlap(tt_val_hashes, "TT Val", tt_test_hashes, "TT Test")
-    
-    if leaks == 0:
-        print("\n✅ Total-Text is CLEAN (No Leakage)")
+def get_perceptual_hashes(lmdb_paths, args):
+    """Get the perceptual hashes of all images in one or more LMDB datasets, and the (LMDB path, index) of each"""
+    hashes, sources = [], []
+    for lmdb_path in lmdb_paths:
+        if not os.path.exists(lmdb_path):
+            continue
+        lmdb_hashes = perceptual_hashes(lmdb_path, args.num_workers, refresh=args.refresh)
+        hashes.append(lmdb_hashes)
+        if SplitView.exists(lmdb_path):
+            # Report the samples of a view by their source LMDB
+            view = SplitView(lmdb_path)
+            sources += [(view.sources[s], i) for s, i in zip(view.source_ids.tolist(), view.indices.tolist())]
+        else:
+            sources += [(lmdb_path, i) for i in range(1, len(lmdb_hashes) + 1)]
+    return (np.concatenate(hashes) if hashes else np.empty(0, np.uint64)), sources
+
+def check_near_duplicates(dataset1, name1, dataset2, name2, args, pairs_file):
+    """Check for near-duplicate images between two datasets, writing the pairs found to pairs_file"""
+    (hashes1, sources1), (hashes2, sources2) = dataset1, dataset2
+    i, j, distance = near_duplicate_pairs(hashes1, hashes2, args.near_duplicates)
+
+    if len(i) == 0:
+        print(f"  ✅ ZERO NEAR-DUPLICATES within {args.near_duplicates} bits")
     else:
-        print(f"\n❌ Total-Text has {leaks} leakage instances!")
+        print(f"  🚨 FOUND {len(i)} NEAR-DUPLICATE PAIRS within {args.near_duplicates} bits! (Possible Leakage)")
+        print(f"  {len(np.unique(i))} of the {len(hashes1)} images of {name1} are involved")
+    rows = []
+    for a, b, d in zip(i.tolist(), j.tolist(), distance.tolist()):
+        (path1, index1), (path2, index2) = sources1[a], sources2[b]
+        rows.append([name1, path1, image_key(index1).decode(), name2, path2, image_key(index2).decode(), str(d)])
+    if pairs_file is not None:
+        pairs_file.writelines("\t".join(row) + "\n" for row in rows)
+    elif rows:
+        row = rows[0]
+        print(f"  e.g. {row[1]}:{row[2]} ~ {row[4]}:{row[5]} (distance {row[6]}). Use --pairs_file for the full list")
 
+    return len(i)
+
+def check_group(title, datasets, args, pairs_file=None):
+    """Hash each (name, LMDB paths) dataset and check all of them against each other.
+    Returns the number of leaks and the number of paths which could not be read."""
     print("\n" + "█" * 50)
-    print("2. Checking ArT Splits")
+    print(title)
     print("█" * 50)
-    
-    art_train_path = f"{base_dir}/art_lmdb/train/art"
-    art_val_path = f"{base_dir}/art_lmdb/val/art"
-    art_test_path = f"{base_dir}/art_lmdb/test/art"
-    
-    art_train_hashes, _ = get_dataset_hashes(art_train_path, "ArT Train")
-    art_val_hashes, _ = get_dataset_hashes(art_val_path, "ArT Val")
-    art_test_hashes, _ = get_dataset_hashes(art_test_path, "ArT Test")
-    
+
+    hashes = {}
+    errors = 0
+    for name, paths in datasets:
+        hashes[name], _, dataset_errors = get_dataset_hashes(paths, name, args)
+        errors += dataset_errors
+    if errors:
+        # Without all the data, a clean result would mean nothing
+        print(f"\n❌ {title} could not be checked: {errors} path(s) could not be read")
+        return 0, errors
+    if args.near_duplicates is not None:
+        near = {name: get_perceptual_hashes(paths, args) for name, paths in datasets}
+
     leaks = 0
-    leaks += check_overlap(art_train_hashes, "ArT Train", art_val_hashes, "ArT Val")
-    leaks += check_overlap(art_train_hashes, "ArT Train", art_test_hashes, "ArT Test")
-    leaks += check_overlap(art_val_hashes, "ArT Val", art_test_hashes, "ArT Test")
-    
+    for name1, name2 in combinations(hashes, 2):
+        leaks += check_overlap(hashes[name1], name1, hashes[name2], name2)
+        if args.near_duplicates is not None:
+            leaks += check_near_duplicates(near[name1], name1, near[name2], name2, args, pairs_file)
+
     if leaks == 0:
-        print("\n✅ ArT is CLEAN (No Leakage)")
+        print(f"\n✅ {title} is CLEAN (No Leakage)")
     else:
-        print(f"\n❌ ArT has {leaks} leakage instances!")
-        
-    print("\n" + "█" * 50)
-    print("3. Checking Curved Mix (Combined)")
-    print("█" * 50)
-    
-    # Curved mix is just symlinks, but let's verify the aggregate
-    # Train = TT Train + ArT Train
-    # Val = TT Val + ArT Val
-    
-    mix_train_hashes = tt_train_hashes.union(art_train_hashes)
-    mix_val_hashes = tt_val_hashes.union(art_val_hashes)
-    # We don't strictly have a 'mix test' folder, but conceptually it's TT Test + ArT Test
-    mix_test_hashes = tt_test_hashes.union(art_test_hashes)
-    
-    print(f"Combined Train Unique Images: {len(mix_train_hashes)}")
-    print(f"Combined Val Unique Images:   {len(mix_val_hashes)}")
-    print(f"Combined Test Unique Images:  {len(mix_test_hashes)}")
-    
-    leaks = 0
-    leaks += check_overlap(mix_train_hashes, "Mix Train", mix_val_hashes, "Mix Val")
-    leaks += check_overlap(mix_train_hashes, "Mix Train", mix_test_hashes, "Mix Test")
-    leaks += check_overlap(mix_val_hashes, "Mix Val", mix_test_hashes, "Mix Test")
-    
+        print(f"\n❌ {title} has {leaks} leakage instances!")
+    return leaks, 0
+
+def parse_dataset(spec):
+    """name=path[+path...] or just path"""
+    name, sep, paths = spec.partition("=")
+    if not sep:
+        name, paths = spec, spec
+    return name, paths.split("+")
+
+def default_groups(base_dir):
+    """Total-Text, ArT and curved mix (TT + ArT) splits, as created by create_fixed_lmdbs.py"""
+    splits = ("Train", "Val", "Test")
+    tt = [(f"TT {s}", [f"{base_dir}/totaltext_lmdb/{s.lower()}/totaltext"]) for s in splits]
+    art = [(f"ArT {s}", [f"{base_dir}/art_lmdb/{s.lower()}/art"]) for s in splits]
+    # Curved mix is just symlinks, but let's verify the aggregate. The hashes of its parts are already cached.
+    mix = [(f"Mix {s}", tt_paths + art_paths) for s, (_, tt_paths), (_, art_paths) in zip(splits, tt, art)]
+    return [("Total-Text Splits", tt), ("ArT Splits", art), ("Curved Mix (Combined)", mix)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datasets', nargs='*', help="Datasets to check against each other: name=path[+path...]")
+    parser.add_argument('--base_dir', default="/data1/vivek/parseq/data_fixed",
+                        help="Root of the fixed datasets, checked if no datasets are given")
+    parser.add_argument('--digest', default=DEFAULT_DIGEST, choices=list(DIGESTS))
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--refresh', action='store_true', help="Ignore the cached hashes")
+    parser.add_argument('--near_duplicates', type=int, metavar='RADIUS',
+                        help="Also check for near-duplicates: perceptual hashes differing in at most RADIUS of 64 bits")
+    parser.add_argument('--pairs_file', help="Write the near-duplicate pairs found here (TSV)")
+    args = parser.parse_args()
+
+    print("=" * 100)
+    print("VERIFYING FIXED DATASET INTEGRITY")
+    print("Checking for Data Leakage via Image Content Hashing")
+    print("=" * 100)
+
+    if args.datasets:
+        groups = [("Datasets", [parse_dataset(spec) for spec in args.datasets])]
+    else:
+        groups = default_groups(args.base_dir)
+
+    leaks = errors = 0
+    with open(args.pairs_file, "w") if args.pairs_file else nullcontext() as pairs_file:
+        if pairs_file is not None:
+            pairs_file.write("dataset1\tlmdb1\tkey1\tdataset2\tlmdb2\tkey2\tdistance\n")
+        for i, (title, datasets) in enumerate(groups, 1):
+            group_leaks, group_errors = check_group(f"{i}. {title}", datasets, args, pairs_file)
+            leaks += group_leaks
+            errors += group_errors
+
     print("\n" + "=" * 100)
     print("FINAL VERDICT")
     print("=" * 100)
-    
-    if leaks == 0:
+
+    if errors:
+        print(f"\n❌❌❌ FAILED: {errors} DATASET PATH(S) COULD NOT BE READ ❌❌❌")
+        print("The check is incomplete. Fix the paths above and run it again.")
+    elif leaks == 0:
         print("\n✅✅✅ PASSED: NO DATA LEAKAGE DETECTED ✅✅✅")
         print("The dataset is safe for training and evaluation.")
     else:
         print("\n❌❌❌ FAILED: DATA LEAKAGE DETECTED ❌❌❌")
         print("Do not use this dataset!")
+    return 1 if leaks or errors else 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())